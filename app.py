@@ -1,59 +1,105 @@
 import gradio as gr
-import google.generativeai as genai
-from setup_db import execute_query
+from setup_db import close_page_cursor
+from query_guard import execute_guarded
 from config import (
-    GOOGLE_API_KEY,
-    DATABASE_SCHEMA,
-    COT_TEXT2SQL_EXAMPLE,
-    LANGCHAIN_API_KEY,
     EXAMPLE_QUERIES,
+    RESULT_PAGE_SIZE,
+    METRICS_HOST,
+    METRICS_PORT,
 )
-import os
-from langchain_google_genai import ChatGoogleGenerativeAI
-import re
 import pandas as pd
-from text2sql import process_query, validate_nl_query
-
-# Configure API keys
-genai.configure(api_key=GOOGLE_API_KEY)
-os.environ["LANGCHAIN_API_KEY"] = LANGCHAIN_API_KEY
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_PROJECT"] = "text2sql"
-os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
-
-
-LANGCHAIN_PROJECT = os.getenv("LANGCHAIN_PROJECT", "text2sql")
-LANGCHAIN_ENDPOINT = os.getenv("LANGCHAIN_ENDPOINT", "https://api.smith.langchain.com")
+from text2sql import confirm_answer, process_query, validate_nl_query
+from profiling import timed
+from speculation import get_speculator
+from sql_cache import normalize_question
+from schema_introspection import get_database_schema
+from tracing import start_metrics_server
+
+# API keys and tracing are configured by text2sql when the first LLM is created
+
+
+@timed("format_results")
+def results_page(sql, results):
+    """Format one page of results as a DataFrame, plus the state for the next page"""
+    if results is not None and not results.ok:
+        df = pd.DataFrame({"Error": [results.error]})
+    elif results is None:
+        df = pd.DataFrame({"Error": ["Error executing query"]})
+    elif results.row_count:
+        df = results.to_dataframe()
+    else:
+        df = pd.DataFrame({"results": ["No results found"]})
+
+    # Only the key of the result's open cursor is kept, never the rows
+    # already shown
+    page = (
+        {"sql": sql, "next_key": results.next_key}
+        if results is not None and results.has_more
+        else None
+    )
+    return df, page
+
+
+def guard_notes(results):
+    """Execution guard decisions shown under the results"""
+    if results is None or not results.notices:
+        return ""
+    return "\n".join(f"- {notice}" for notice in results.notices)
+
+
+def answer_query(query_text):
+    """Run the query through the pipeline and return its first page"""
+    return process_query(query_text, page_size=RESULT_PAGE_SIZE, interactive=True)
 
 
 def process_input_query(query, choice):
-    """Process the query and return results"""
+    """Process the query and return the first page of results"""
     try:
         # Use example if selected
         query_text = query if choice == "Use example query" else query
 
-        # Use the imported process_query function
-        sql, results = process_query(query_text)
-
-        # Format results as DataFrame
-        if results:
-            results_lines = results.strip().split("\n")
-            if len(results_lines) > 2:
-                headers = [h.strip() for h in results_lines[0].split("|")]
-                data = []
-                for line in results_lines[2:]:
-                    if "|" in line:
-                        row = [cell.strip() for cell in line.split("|")]
-                        data.append(row)
-                df = pd.DataFrame(data, columns=headers)
-            else:
-                df = pd.DataFrame({"results": ["No results found"]})
-        else:
-            df = pd.DataFrame({"Error": ["Error executing query"]})
-
-        return sql, df
+        # Reuse the answer started while the query was being validated
+        speculator = get_speculator()
+        answer = speculator.take(query_text) if speculator is not None else None
+        sql, results = answer if answer is not None else answer_query(query_text)
+
+        df, page = results_page(sql, results)
+        return (
+            sql,
+            df,
+            guard_notes(results),
+            page,
+            gr.update(visible=page is not None),
+            gr.update(visible=results is not None and results.ok),
+        )
     except Exception as e:
-        return str(e), pd.DataFrame({"Error": [str(e)]})
+        return (
+            str(e),
+            pd.DataFrame({"Error": [str(e)]}),
+            "",
+            None,
+            gr.update(visible=False),
+            gr.update(visible=False),
+        )
+
+
+def next_results_page(page):
+    """Fetch the page of results following the one on screen"""
+    if not page:
+        return (
+            pd.DataFrame({"results": ["No more results"]}),
+            "",
+            None,
+            gr.update(visible=False),
+        )
+    results = execute_guarded(
+        page["sql"].replace("\n", " "),
+        interactive=True,
+        page_size=RESULT_PAGE_SIZE,
+        after=page["next_key"],
+    )
+    df, page = results_page(page["sql"], results)
+    return df, guard_notes(results), page, gr.update(visible=page is not None)
 
 
 def create_interface():
@@ -111,10 +157,15 @@ def create_interface():
                 )  # Hidden state to store improved query
                 sql_output = gr.Code(label="Generated SQL Query", language="sql")
                 results_output = gr.Dataframe(label="Query results", wrap=True)
+                guard_output = gr.Markdown()  # Execution guard decisions
+                page_holder = gr.State()  # Hidden state with the next page's key
+                next_page_btn = gr.Button("Next page", visible=False)
+                # Only answers confirmed here become few-shot examples
+                correct_btn = gr.Button("Mark answer as correct", visible=False)
 
         # Show database schema
         with gr.Accordion("View Database Schema", open=False):
-            gr.Code(value=DATABASE_SCHEMA, language="sql")
+            gr.Code(value=get_database_schema(), language="sql")
 
         # Handle query type selection
         def toggle_input(choice):
@@ -128,15 +179,25 @@ def create_interface():
         )
 
         # Handle query submission
-        def handle_submit(query_text, example_text, choice):
+        def handle_submit(query_text, example_text, choice, speculate=True):
             query = example_text if choice == "Use example query" else query_text
 
             print(f"\nQuery: {query}")
+            # Answer the query as typed while it is validated, it usually
+            # comes back unchanged
+            speculator = get_speculator() if speculate else None
+            if speculator is not None:
+                speculator.start(query, answer_query, query)
+
             # First validate the query
             validation_result = validate_nl_query(query)
             original_query = validation_result["original_query"]
             improved_query = validation_result["corrected_input"]
             feedback = validation_result["feedback"]
+            if speculator is not None and normalize_question(
+                improved_query
+            ) != normalize_question(query):
+                speculator.discard(query)
 
             # Allow user input if improved query is different
             show_buttons = improved_query.lower() != query.lower()
@@ -157,9 +218,16 @@ def create_interface():
             )
 
         # Handle confirmation
-        def process_confirmed_query(improved_query):
-            sql, results = process_input_query(improved_query, "Type custom query")
-            return sql, results
+        def process_confirmed_query(improved_query, page):
+            # The pages of the previous answer are no longer reachable
+            if page:
+                close_page_cursor(page["next_key"])
+            return process_input_query(improved_query, "Type custom query")
+
+        # Handle confirmation of the answer
+        def mark_correct(improved_query, sql):
+            confirm_answer(improved_query, sql)
+            return gr.update(visible=False)
 
         # Handle revalidation
         def revalidate_query(query_text, example_text, choice, user_suggestion):
@@ -170,7 +238,8 @@ def create_interface():
                 else query_text
             )
             print(f"\nModified Query: {modified_query}")
-            return handle_submit(modified_query, example_text, choice)
+            # The instructions always change the query, so don't speculate
+            return handle_submit(modified_query, example_text, choice, speculate=False)
 
         submit_btn.click(
             handle_submit,
@@ -188,8 +257,27 @@ def create_interface():
 
         confirm_btn.click(
             process_confirmed_query,
-            inputs=[improved_query_holder],
-            outputs=[sql_output, results_output],
+            inputs=[improved_query_holder, page_holder],
+            outputs=[
+                sql_output,
+                results_output,
+                guard_output,
+                page_holder,
+                next_page_btn,
+                correct_btn,
+            ],
+        )
+
+        correct_btn.click(
+            mark_correct,
+            inputs=[improved_query_holder, sql_output],
+            outputs=[correct_btn],
+        )
+
+        next_page_btn.click(
+            next_results_page,
+            inputs=[page_holder],
+            outputs=[results_output, guard_output, page_holder, next_page_btn],
         )
 
         revalidate_btn.click(
@@ -210,5 +298,7 @@ def create_interface():
 
 
 if __name__ == "__main__":
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT, METRICS_HOST)
     app = create_interface()
     app.launch(share=True)
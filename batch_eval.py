@@ -0,0 +1,309 @@
+## Concurrent, rate-limited batch runner for process_query
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import pandas as pd
+
+from config import RUN_STORE_PATH
+from db_engine import use_engine
+
+
+EVAL_DATASET_PATH = "Pagila Evals Dataset(Sheet1).csv"
+RESULT_FIELDS = [
+    "Query Number",
+    "Natural Language Query",
+    "Difficulty",
+    "sql_gen_query",
+    "result_hash",
+    "row_count",
+    "preview",
+    "error",
+    "seconds",
+]
+
+
+def read_eval_dataset(path=EVAL_DATASET_PATH):
+    """Reads the evals dataset, which is saved with Windows-1252 curly quotes."""
+    try:
+        return pd.read_csv(path, encoding="utf-8")
+    except UnicodeDecodeError:
+        return pd.read_csv(path, encoding="cp1252")
+
+
+class TokenBucket:
+    """Blocking token bucket allowing `rate_per_minute` acquisitions on average,
+    with bursts of up to `burst`."""
+
+    def __init__(self, rate_per_minute, burst=1):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CheckpointWriter:
+    """Appends one record per finished question to a .jsonl or .csv file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.lower().endswith(".csv")
+        self._lock = threading.Lock()
+
+    def completed(self, retry_failed=False):
+        """Query numbers already in the checkpoint (optionally only successes)."""
+        if not os.path.exists(self.path):
+            return set()
+        records = load_results(self.path)
+        if retry_failed:
+            records = records[records["error"].isna() | (records["error"] == "")]
+        return set(records["Query Number"].astype(int))
+
+    def write(self, record):
+        with self._lock:
+            if self.is_csv:
+                new_file = not os.path.exists(self.path)
+                fields = RESULT_FIELDS
+                if not new_file:  # resumed files keep their own columns
+                    with open(self.path, newline="", encoding="utf-8") as f:
+                        fields = next(csv.reader(f), RESULT_FIELDS)
+                with open(self.path, "a", newline="", encoding="utf-8") as f:
+                    writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+                    if new_file:
+                        writer.writeheader()
+                    writer.writerow(record)
+            else:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+
+def load_results(path):
+    """Loads a checkpoint file, keeping the latest record per question."""
+    # Hex digests made only of digits would otherwise be read as numbers
+    dtype = {"result_hash": str}
+    if path.lower().endswith(".csv"):
+        df = pd.read_csv(path, encoding="utf-8", dtype=dtype)
+    else:
+        df = pd.read_json(path, lines=True, dtype=dtype)
+    return (
+        df.drop_duplicates("Query Number", keep="last")
+        .sort_values("Query Number")
+        .reset_index(drop=True)
+    )
+
+
+def failed_question(row, error, seconds=0.0):
+    """Record of a question that could not be answered."""
+    return {
+        "Query Number": int(row["Query Number"]),
+        "Natural Language Query": row["Natural Language Query"],
+        "Difficulty": row.get("Difficulty"),
+        "sql_gen_query": None,
+        "result_hash": None,
+        "row_count": None,
+        "preview": None,
+        "error": error,
+        "seconds": round(seconds, 3),
+    }
+
+
+def run_question(row, max_retries):
+    """Answers one question. Its results are kept as their hash, row count
+    and a short preview, never as rows."""
+    from run_store import summarize_result
+    from text2sql import process_query
+
+    start = time.perf_counter()
+    error = None
+    try:
+        sql, results = process_query(
+            row["Natural Language Query"], max_retries=max_retries, show_print=False
+        )
+        if sql is None:
+            error = "Max retries reached"
+    except Exception as e:
+        sql, results, error = None, None, f"{type(e).__name__}: {e}"
+    digest, row_count, preview, _ = summarize_result(results)
+    return {
+        "Query Number": int(row["Query Number"]),
+        "Natural Language Query": row["Natural Language Query"],
+        "Difficulty": row.get("Difficulty"),
+        "sql_gen_query": sql,
+        "result_hash": digest,
+        "row_count": row_count,
+        "preview": preview,
+        "error": error,
+        "seconds": round(time.perf_counter() - start, 3),
+    }
+
+
+def run_batch(
+    questions,
+    output_path,
+    workers=4,
+    rate_per_minute=30,
+    burst=None,
+    max_retries=5,
+    retry_failed=False,
+    isolate=False,
+    store_path=None,
+):
+    """Runs process_query over a DataFrame of questions.
+
+    Every finished question is appended to `output_path` straight away, so a
+    crashed run picks up where it stopped: questions already present in the
+    file are skipped (or only the failed ones re-run with `retry_failed`).
+    With `isolate`, each worker runs against its own copy of the database
+    (see db_clones.py), so generated SQL that writes cannot affect other
+    questions. With `store_path`, records are also appended to that run store
+    (see run_store.py), as the run named after `output_path`. Returns a
+    summary with the throughput in questions per minute.
+    """
+    writer = CheckpointWriter(output_path)
+    store = run_id = None
+    if store_path:
+        from run_store import RunStore
+
+        store = RunStore(store_path)
+        run_id = store.start_run(
+            os.path.splitext(os.path.basename(output_path))[0], source="batch_eval"
+        )
+    done = writer.completed(retry_failed=retry_failed)
+    pending = [
+        row
+        for _, row in questions.iterrows()
+        if int(row["Query Number"]) not in done
+    ]
+    print(f"{len(done)} questions already done, {len(pending)} to run")
+
+    bucket = TokenBucket(rate_per_minute, burst=burst or workers)
+    clones = None
+    if isolate and pending:
+        from db_clones import ClonePool
+
+        clones = ClonePool(min(workers, len(pending)))
+
+    def rate_limited(row):
+        bucket.acquire()
+        if clones is None:
+            return run_question(row, max_retries)
+        start = time.perf_counter()
+        try:
+            with clones.acquire() as clone, use_engine(clone):
+                return run_question(row, max_retries)
+        except Exception as e:
+            # No clone free in time (PoolTimeout) or one that could not be
+            # rebuilt: this question fails, the batch goes on
+            return failed_question(
+                row, f"{type(e).__name__}: {e}", time.perf_counter() - start
+            )
+
+    start = time.perf_counter()
+    failed = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(rate_limited, row) for row in pending]
+            for i, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                writer.write(record)
+                if store is not None:
+                    store.append_results(run_id, [record])
+                failed += record["error"] is not None
+                print(
+                    f"[{i}/{len(pending)}] #{record['Query Number']} "
+                    f"{'FAILED' if record['error'] else 'ok'} in {record['seconds']}s"
+                )
+    finally:
+        if clones is not None:
+            clones.close()
+        if store is not None:
+            store.close()
+
+    elapsed = time.perf_counter() - start
+    summary = {
+        "completed": len(pending),
+        "failed": failed,
+        "elapsed_seconds": round(elapsed, 2),
+        "questions_per_minute": round(len(pending) / elapsed * 60, 2)
+        if elapsed
+        else 0.0,
+    }
+    if clones is not None:
+        summary["clones_recycled"] = clones.recycled
+    print(
+        f"\nFinished {summary['completed']} questions ({failed} failed) in "
+        f"{summary['elapsed_seconds']}s: {summary['questions_per_minute']} questions/min"
+    )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run process_query over the evals dataset concurrently"
+    )
+    parser.add_argument("--input", default=EVAL_DATASET_PATH)
+    parser.add_argument(
+        "--output",
+        default="inference_results.jsonl",
+        help="checkpoint file, .jsonl or .csv; existing results are resumed",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--rate", type=float, default=30, help="questions started per minute"
+    )
+    parser.add_argument("--burst", type=int, default=None)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument(
+        "--retry-failed", action="store_true", help="re-run failed questions"
+    )
+    parser.add_argument(
+        "--isolate",
+        action="store_true",
+        help="give every worker its own copy of the database",
+    )
+    parser.add_argument(
+        "--store",
+        default=RUN_STORE_PATH,
+        help="run store the results are also appended to, empty for none",
+    )
+    parser.add_argument(
+        "--export-csv", default=None, help="write the merged results to this CSV"
+    )
+    args = parser.parse_args()
+
+    run_batch(
+        read_eval_dataset(args.input),
+        args.output,
+        workers=args.workers,
+        rate_per_minute=args.rate,
+        burst=args.burst,
+        max_retries=args.max_retries,
+        retry_failed=args.retry_failed,
+        isolate=args.isolate,
+        store_path=args.store,
+    )
+    if args.export_csv:
+        load_results(args.output).to_csv(args.export_csv, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+## End-to-end benchmark of process_query over the Pagila evals dataset
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+from batch_eval import EVAL_DATASET_PATH, read_eval_dataset
+from config import LLM_BACKEND, LLM_MODEL
+from profiling import profile_request, timed_step
+
+
+DEFAULT_BASELINE_PATH = "benchmark_baseline.json"
+# A step regresses when its p95 grows by more than this share of the baseline
+# and by more than MIN_REGRESSION_MS (so sub-millisecond noise is ignored)
+DEFAULT_TOLERANCE = 0.2
+MIN_REGRESSION_MS = 5.0
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (q in 0-100)."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * q // 100))  # ceil
+    return values[int(rank) - 1]
+
+
+def latency_summary(seconds):
+    ms = [value * 1000 for value in seconds]
+    return {
+        "count": len(ms),
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else None,
+        "p50_ms": round(percentile(ms, 50), 2) if ms else None,
+        "p95_ms": round(percentile(ms, 95), 2) if ms else None,
+        "p99_ms": round(percentile(ms, 99), 2) if ms else None,
+    }
+
+
+def run_question(row, nl_validation=False, max_retries=5, warm=False):
+    """Runs one question through process_query and returns its measurements."""
+    from setup_db import result_cache
+    from text2sql import process_query, validate_nl_query
+
+    if result_cache is not None and not warm:
+        result_cache.clear()
+    question = row["Natural Language Query"]
+    error = None
+    rows = None
+    with profile_request() as profile:
+        start = time.perf_counter()
+        try:
+            if nl_validation:
+                validate_nl_query(question)
+            sql, results = process_query(
+                question, max_retries=max_retries, show_print=False, use_cache=warm
+            )
+            if results is None:
+                error = "Max retries reached"
+            else:
+                rows = results.row_count
+                with timed_step("format_results"):
+                    results.to_dataframe()
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        profile.add_step("total", time.perf_counter() - start)
+
+    return {
+        "Query Number": int(row["Query Number"]),
+        "Difficulty": row.get("Difficulty"),
+        "steps": {name: round(seconds, 6) for name, seconds in profile.steps.items()},
+        "calls": profile.calls,
+        "repairs": profile.values.get("repairs", 0),
+        "graph_restarts": profile.values.get("graph_restarts", 0),
+        "prompt_chars": {
+            name.split(".", 1)[1]: value
+            for name, value in profile.values.items()
+            if name.startswith("prompt_chars.")
+        },
+        "rows": rows,
+        "error": error,
+    }
+
+
+def summarize(records):
+    """Aggregates per-question records into the baseline summary."""
+    steps = sorted({name for record in records for name in record["steps"]})
+    difficulties = sorted({str(record["Difficulty"]) for record in records})
+
+    def step_summary(subset):
+        return {
+            name: latency_summary(
+                [record["steps"][name] for record in subset if name in record["steps"]]
+            )
+            for name in steps
+        }
+
+    prompt_chars = {}
+    for record in records:
+        for role, chars in record["prompt_chars"].items():
+            prompt_chars.setdefault(role, []).append(chars)
+    repairs = [record["repairs"] for record in records]
+    rows = [record["rows"] for record in records if record["rows"] is not None]
+    return {
+        "questions": len(records),
+        "failed": sum(record["error"] is not None for record in records),
+        "steps": step_summary(records),
+        "by_difficulty": {
+            difficulty: step_summary(
+                [record for record in records if str(record["Difficulty"]) == difficulty]
+            )
+            for difficulty in difficulties
+        },
+        "repairs": {
+            "mean": round(sum(repairs) / len(repairs), 3) if repairs else 0,
+            "max": max(repairs, default=0),
+            "questions_repaired": sum(1 for count in repairs if count),
+        },
+        "graph_restarts": sum(record["graph_restarts"] for record in records),
+        "prompt_chars": {
+            role: {"mean": round(sum(values) / len(values)), "max": max(values)}
+            for role, values in sorted(prompt_chars.items())
+        },
+        "rows": {
+            "mean": round(sum(rows) / len(rows), 1) if rows else 0,
+            "max": max(rows, default=0),
+            "total": sum(rows),
+        },
+    }
+
+
+def print_summary(summary):
+    print(f"\n{summary['questions']} questions, {summary['failed']} failed")
+    print(f"\n{'step':<22}{'n':>5}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+    for name, stats in summary["steps"].items():
+        print(
+            f"{name:<22}{stats['count']:>5}{stats['p50_ms']:>11.1f}"
+            f"{stats['p95_ms']:>11.1f}{stats['p99_ms']:>11.1f}"
+        )
+    print(f"\n{'total by difficulty':<22}{'n':>5}{'p50 ms':>11}{'p95 ms':>11}{'p99 ms':>11}")
+    for difficulty, steps in summary["by_difficulty"].items():
+        stats = steps["total"]
+        print(
+            f"{difficulty:<22}{stats['count']:>5}{stats['p50_ms']:>11.1f}"
+            f"{stats['p95_ms']:>11.1f}{stats['p99_ms']:>11.1f}"
+        )
+    repairs = summary["repairs"]
+    print(
+        f"\nRepairs: mean {repairs['mean']}, max {repairs['max']}, "
+        f"{repairs['questions_repaired']} questions repaired; "
+        f"graph restarts: {summary['graph_restarts']}"
+    )
+    for role, chars in summary["prompt_chars"].items():
+        print(f"Prompt chars {role}: mean {chars['mean']}, max {chars['max']}")
+    rows = summary["rows"]
+    print(f"Rows returned: mean {rows['mean']}, max {rows['max']}")
+
+
+def find_regressions(summary, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Steps (overall and per difficulty) whose p95 grew beyond the tolerance."""
+    regressions = []
+
+    def compare(label, current, previous):
+        for name, stats in current.items():
+            old = previous.get(name)
+            if not old or old["p95_ms"] is None or stats["p95_ms"] is None:
+                continue
+            growth = stats["p95_ms"] - old["p95_ms"]
+            if growth > MIN_REGRESSION_MS and growth > old["p95_ms"] * tolerance:
+                regressions.append(
+                    f"{label}{name}: p95 {old['p95_ms']:.1f}ms -> {stats['p95_ms']:.1f}ms"
+                )
+
+    compare("", summary["steps"], baseline["summary"]["steps"])
+    for difficulty, steps in summary["by_difficulty"].items():
+        previous = baseline["summary"]["by_difficulty"].get(difficulty, {})
+        compare(f"[{difficulty}] ", steps, previous)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark process_query per node over the evals dataset"
+    )
+    parser.add_argument("--input", default=EVAL_DATASET_PATH)
+    parser.add_argument("--limit", type=int, default=None, help="first N questions only")
+    parser.add_argument("--difficulty", default=None, help="Easy, Medium or Hard")
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument(
+        "--nl-validation", action="store_true", help="also time validate_nl_query"
+    )
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="keep the SQL and result caches (cold pipeline by default)",
+    )
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline", action="store_true", help="write this run as the baseline"
+    )
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--output", default=None, help="write this run's JSON here")
+    args = parser.parse_args()
+
+    questions = read_eval_dataset(args.input)
+    if args.difficulty:
+        questions = questions[questions["Difficulty"] == args.difficulty]
+    if args.limit:
+        questions = questions.head(args.limit)
+
+    records = []
+    for i, (_, row) in enumerate(questions.iterrows(), 1):
+        record = run_question(
+            row,
+            nl_validation=args.nl_validation,
+            max_retries=args.max_retries,
+            warm=args.warm,
+        )
+        records.append(record)
+        print(
+            f"[{i}/{len(questions)}] #{record['Query Number']} "
+            f"{record['steps']['total'] * 1000:.0f}ms"
+            + (f" FAILED: {record['error']}" if record["error"] else "")
+        )
+
+    summary = summarize(records)
+    print_summary(summary)
+    run = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "environment": {
+            "llm_backend": LLM_BACKEND,
+            "llm_model": LLM_MODEL,
+            "python": platform.python_version(),
+            "warm": args.warm,
+            "nl_validation": args.nl_validation,
+        },
+        "summary": summary,
+        "records": records,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2, default=str)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2, default=str)
+        print(f"\nSaved baseline to {args.baseline}")
+        return
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(summary, baseline, args.tolerance)
+        if regressions:
+            print(f"\nRegressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+## Per-query latency: pooled connection engine vs docker exec + psql
+import argparse
+import statistics
+import time
+
+from db_engine import get_engine
+from setup_db import execute_query_docker
+
+
+BENCHMARK_QUERIES = [
+    "SELECT COUNT(*) FROM actor",
+    "SELECT first_name, last_name FROM actor WHERE last_name ILIKE 'S%'",
+    "SELECT c.name, COUNT(*) FROM film_category fc JOIN category c ON fc.category_id = c.category_id GROUP BY c.name",
+]
+
+
+def time_path(run, queries, iterations):
+    """Runs every query `iterations` times and returns per-query latencies in ms."""
+    latencies = []
+    for _ in range(iterations):
+        for query in queries:
+            start = time.perf_counter()
+            run(query)
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(name, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"{name:<8} n={len(latencies):<5} "
+        f"mean={statistics.mean(latencies):8.2f}ms "
+        f"p50={statistics.median(latencies):8.2f}ms "
+        f"p95={p95:8.2f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare per-query latency of the pool and docker paths"
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--skip-docker", action="store_true")
+    args = parser.parse_args()
+
+    engine = get_engine()
+    if engine is None:
+        raise SystemExit("Connection pool unavailable, check DATABASE_URL")
+
+    # Warm up the pool so connection setup is not counted
+    engine.execute("SELECT 1")
+
+    pool_latencies = time_path(engine.execute, BENCHMARK_QUERIES, args.iterations)
+    summarize("pool", pool_latencies)
+
+    if not args.skip_docker:
+        docker_latencies = time_path(
+            execute_query_docker, BENCHMARK_QUERIES, args.iterations
+        )
+        summarize("docker", docker_latencies)
+        speedup = statistics.median(docker_latencies) / statistics.median(
+            pool_latencies
+        )
+        print(f"\nMedian speedup of pool over docker: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+## Cold-start import time of text2sql / app, measured with python -X importtime
+import argparse
+import subprocess
+import sys
+
+
+# Importing text2sql must not pull these in, they load on the first LLM call
+LAZY_MODULES = ["google.generativeai", "langchain_google_genai", "langchain", "langgraph"]
+
+# Cold import of text2sql above this many milliseconds is a regression
+DEFAULT_MAX_MS = 500
+
+
+def measure(module):
+    """Imports `module` in a fresh interpreter.
+
+    Returns ({imported module: cumulative microseconds}, lazily-loaded
+    modules that were imported anyway).
+    """
+    check = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    )
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check],
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    # stderr lines look like "import time:  self [us] | cumulative | package"
+    cumulative = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, total, name = line[len("import time:") :].split("|")
+        cumulative[name.strip()] = int(total)
+    loaded = [name for name in completed.stdout.strip().split(",") if name]
+    return cumulative, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the cold import time of a module and fail on regressions"
+    )
+    parser.add_argument("--module", default="text2sql")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list")
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        default=DEFAULT_MAX_MS,
+        help="fail when the best run is slower than this",
+    )
+    args = parser.parse_args()
+
+    # The best of several runs, so a busy machine does not fail the check
+    best, loaded = None, []
+    for _ in range(args.runs):
+        cumulative, loaded = measure(args.module)
+        if best is None or cumulative[args.module] < best[args.module]:
+            best = cumulative
+
+    print(f"Slowest imports under {args.module} (cumulative):")
+    for name, total in sorted(best.items(), key=lambda item: -item[1])[: args.top]:
+        print(f"  {total / 1000:8.1f}ms  {name}")
+
+    total_ms = best[args.module] / 1000
+    print(f"\nimport {args.module}: {total_ms:.1f}ms (limit {args.max_ms:.0f}ms)")
+    failed = False
+    if total_ms > args.max_ms:
+        print("FAIL: cold import is slower than the limit")
+        failed = True
+    if loaded:
+        print(f"FAIL: imported eagerly: {', '.join(loaded)}")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
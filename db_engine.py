@@ -0,0 +1,426 @@
+## Pooled PostgreSQL execution engine
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config import (
+    DATABASE_URL,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_HEALTH_CHECK_INTERVAL,
+    DB_POOL_CHECKOUT_TIMEOUT,
+    STATEMENT_TIMEOUT_MS,
+)
+from query_result import QueryResult
+
+try:
+    import psycopg2
+    from psycopg2 import pool as pg_pool
+except ImportError:  # psycopg2 is optional, setup_db falls back to docker/psql
+    psycopg2 = None
+    pg_pool = None
+
+
+# Seconds to wait before trying to build the pool again after a failed attempt
+ENGINE_RETRY_INTERVAL = 30
+
+
+# Built-in type OIDs, anything else (enums, domains) is looked up in pg_type
+PG_TYPE_NAMES = {
+    16: "bool",
+    17: "bytea",
+    20: "int8",
+    21: "int2",
+    23: "int4",
+    25: "text",
+    700: "float4",
+    701: "float8",
+    1009: "_text",
+    1042: "bpchar",
+    1043: "varchar",
+    1082: "date",
+    1083: "time",
+    1114: "timestamp",
+    1184: "timestamptz",
+    1700: "numeric",
+    3614: "tsvector",
+}
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes free within the checkout timeout."""
+
+
+class Cancelled(Exception):
+    """Raised by work that finds its CancelScope cancelled before starting."""
+
+
+_cancel_scope = contextvars.ContextVar("cancel_scope", default=None)
+
+
+class CancelScope:
+    """Lets another thread cancel the queries run under this scope.
+
+    Work started with ``scope.run(fn, ...)`` registers each connection while
+    its statement runs; ``cancel()`` sends a cancel request for all of them
+    (they fail with SQLSTATE 57014) and makes later queries in the scope fail
+    without running.
+
+    A scope created under another one is cancelled along with it.
+    """
+
+    def __init__(self):
+        self._parent = _cancel_scope.get()
+        self._cancelled = False
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancelled or (
+            self._parent is not None and self._parent.cancelled
+        )
+
+    def run(self, fn, *args, **kwargs):
+        token = _cancel_scope.set(self)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _cancel_scope.reset(token)
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            for conn in self._connections:
+                try:
+                    conn.cancel()
+                except psycopg2.Error:
+                    pass
+
+    def _register(self, conn):
+        if self._parent is not None and not self._parent._register(conn):
+            return False
+        with self._lock:
+            if self._cancelled:
+                registered = False
+            else:
+                self._connections.add(conn)
+                registered = True
+        if not registered and self._parent is not None:
+            self._parent._unregister(conn)
+        return registered
+
+    def _unregister(self, conn):
+        with self._lock:
+            self._connections.discard(conn)
+        if self._parent is not None:
+            self._parent._unregister(conn)
+
+
+def cancel_requested():
+    """True when the current work runs under a CancelScope that was cancelled."""
+    scope = _cancel_scope.get()
+    return scope is not None and scope.cancelled
+
+
+class ConnectionEngine:
+    """Thread-safe pool of connections to the Pagila database.
+
+    Connections are checked out with ``connection()``; callers block (up to
+    ``checkout_timeout`` seconds) when all ``max_size`` connections are in use.
+    Connections idle for longer than ``health_check_interval`` are pinged before
+    being handed out and replaced transparently if the ping fails. Every
+    connection starts with ``statement_timeout`` (milliseconds, 0 for none).
+    """
+
+    def __init__(
+        self,
+        dsn=DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+        checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+        statement_timeout=STATEMENT_TIMEOUT_MS,
+    ):
+        if psycopg2 is None:
+            raise RuntimeError("psycopg2 is not installed")
+        self.dsn = dsn
+        self.max_size = max_size
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+        self._pool = pg_pool.ThreadedConnectionPool(
+            min_size,
+            max_size,
+            dsn,
+            options=f"-c statement_timeout={int(statement_timeout)}",
+        )
+        # ThreadedConnectionPool raises instead of waiting when exhausted,
+        # so the semaphore turns an exhausted pool into a bounded wait.
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._last_used = {}
+        self._type_cache = dict(PG_TYPE_NAMES)
+        self._lock = threading.Lock()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+        if not self._is_healthy(conn):
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+        conn.autocommit = True  # match `psql -c`, every statement commits
+        return conn
+
+    def _release(self, conn, broken=False):
+        broken = broken or conn.closed
+        if not broken:
+            with self._lock:
+                self._last_used[id(conn)] = time.monotonic()
+        else:
+            with self._lock:
+                self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=broken)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the ``with`` block."""
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            raise PoolTimeout(
+                f"No database connection free after {self.checkout_timeout}s"
+            )
+        conn = None
+        broken = False
+        try:
+            conn = self._checkout()
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            if conn is not None:
+                self._release(conn, broken=broken)
+            self._slots.release()
+
+    def _type_names(self, conn, type_codes):
+        missing = [oid for oid in set(type_codes) if oid not in self._type_cache]
+        if missing:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT oid, typname FROM pg_type WHERE oid = ANY(%s)", (missing,)
+                )
+                with self._lock:
+                    self._type_cache.update(cursor.fetchall())
+        return [self._type_cache.get(oid, "unknown") for oid in type_codes]
+
+    def execute(self, query, timeout_ms=None):
+        """Runs a SQL statement and returns a QueryResult.
+
+        `timeout_ms` overrides the connection's statement_timeout for this
+        statement only. Inside a CancelScope, the statement can be cancelled
+        from another thread.
+        """
+        scope = _cancel_scope.get()
+        try:
+            with self.connection() as conn:
+                if scope is not None and not scope._register(conn):
+                    return QueryResult.from_error(
+                        "ERROR:  canceling statement due to user request", "57014"
+                    )
+                with conn.cursor() as cursor:
+                    try:
+                        if timeout_ms is not None:
+                            cursor.execute(
+                                "SET statement_timeout = %s", (int(timeout_ms),)
+                            )
+                        cursor.execute(query)
+                        if cursor.description is None:
+                            return QueryResult(status=cursor.statusmessage)
+                        columns = [column.name for column in cursor.description]
+                        rows = cursor.fetchall()
+                        types = self._type_names(
+                            conn, [column.type_code for column in cursor.description]
+                        )
+                        return QueryResult.from_rows(
+                            columns, types, rows, status=cursor.statusmessage
+                        )
+                    finally:
+                        if scope is not None:
+                            scope._unregister(conn)
+                        if timeout_ms is not None and not conn.closed:
+                            cursor.execute("RESET statement_timeout")
+        except psycopg2.Error as e:
+            return QueryResult.from_error(e.pgerror or f"ERROR:  {e}", e.pgcode)
+        except PoolTimeout as e:
+            return QueryResult.from_error(f"ERROR:  {e}")
+
+    def stream(self, query, batch_size):
+        """Yields QueryResults of up to `batch_size` rows from a named
+        (server-side) cursor, so only one batch is held in memory at a time."""
+        with self.connection() as conn:
+            conn.autocommit = False  # named cursors live inside a transaction
+            try:
+                with conn.cursor(name=f"stream_{uuid.uuid4().hex}") as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query)
+                    types = None
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if types is None:
+                            columns = [column.name for column in cursor.description]
+                            types = self._type_names(
+                                conn,
+                                [column.type_code for column in cursor.description],
+                            )
+                        if not rows:
+                            break
+                        yield QueryResult.from_rows(columns, types, rows)
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def open_cursor(self, query, timeout_ms=None):
+        """Opens a ServerCursor on `query`, holding one of the pool's
+        connections until the cursor is closed."""
+        return ServerCursor(self, query, timeout_ms)
+
+    def close(self):
+        self._pool.closeall()
+
+
+class ServerCursor:
+    """A named cursor kept open between fetches, for paging a result.
+
+    Each ``fetch(n)`` continues where the previous one stopped (FETCH n), so
+    the query runs once and a deep page costs as much as the first one. The
+    cursor holds its connection (and its open transaction) until ``close()``.
+    """
+
+    def __init__(self, engine, query, timeout_ms=None):
+        if not engine._slots.acquire(timeout=engine.checkout_timeout):
+            raise PoolTimeout(
+                f"No database connection free after {engine.checkout_timeout}s"
+            )
+        self._engine = engine
+        self._conn = None
+        self._next_rows = []
+        self._columns = None
+        self._types = None
+        self.position = 0  # rows fetched so far
+        try:
+            self._conn = engine._checkout()
+            self._conn.autocommit = False  # named cursors live inside a transaction
+            if timeout_ms is not None:
+                with self._conn.cursor() as cursor:
+                    cursor.execute("SET LOCAL statement_timeout = %s", (int(timeout_ms),))
+            self._cursor = self._conn.cursor(name=f"page_{uuid.uuid4().hex}")
+            self._cursor.execute(query)
+        except Exception:
+            self.close()
+            raise
+
+    def fetch(self, size):
+        """QueryResult of the next `size` rows, with `offset` set to the rows
+        fetched before them and `has_more` to whether any follow."""
+        # One row more than asked tells whether the result goes on
+        rows = self._next_rows + self._cursor.fetchmany(size + 1 - len(self._next_rows))
+        rows, self._next_rows = rows[:size], rows[size:]
+        if self._types is None:
+            self._columns = [column.name for column in self._cursor.description]
+            self._types = self._engine._type_names(
+                self._conn, [column.type_code for column in self._cursor.description]
+            )
+        page = QueryResult.from_rows(self._columns, self._types, rows)
+        page.offset = self.position
+        page.has_more = bool(self._next_rows)
+        self.position += len(rows)
+        return page
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if self._engine is None:
+            return
+        if conn is not None:
+            broken = conn.closed
+            if not broken:
+                try:
+                    conn.rollback()
+                    conn.autocommit = True
+                except psycopg2.Error:
+                    broken = True
+            self._engine._release(conn, broken=broken)
+        self._engine._slots.release()
+        self._engine = None
+
+
+_engine = None
+_engine_failed_at = None
+_engine_lock = threading.Lock()
+_engine_override = contextvars.ContextVar("engine_override", default=None)
+
+
+@contextmanager
+def use_engine(engine):
+    """Sends the queries of the ``with`` block (and of work started from it
+    with a copied context) to `engine` instead of the shared one."""
+    token = _engine_override.set(engine)
+    try:
+        yield engine
+    finally:
+        _engine_override.reset(token)
+
+
+def engine_override():
+    """The engine set by use_engine for the current work, or None."""
+    return _engine_override.get()
+
+
+def get_engine():
+    """Returns the shared engine, or None when the pool cannot be created.
+    Under use_engine, returns that engine instead."""
+    global _engine, _engine_failed_at
+    override = _engine_override.get()
+    if override is not None:
+        return override
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+        if psycopg2 is None:
+            return None
+        if (
+            _engine_failed_at is not None
+            and time.monotonic() - _engine_failed_at < ENGINE_RETRY_INTERVAL
+        ):
+            return None
+        try:
+            _engine = ConnectionEngine()
+            _engine_failed_at = None
+        except psycopg2.Error as e:
+            print(f"Could not create connection pool, falling back to docker: {e}")
+            _engine_failed_at = time.monotonic()
+        return _engine
+
+
+def close_engine():
+    """Closes the shared engine's connections; the next get_engine() opens a
+    new pool. CREATE DATABASE ... TEMPLATE needs the template to be unused."""
+    global _engine
+    with _engine_lock:
+        if _engine is not None:
+            _engine.close()
+            _engine = None
@@ -0,0 +1,125 @@
+## LLM judge for generated SQL (moved here from text2sql.ipynb)
+import argparse
+import re
+
+from config import DATABASE_SCHEMA, JUDGE_BATCH_SIZE
+from llm_backend import get_llm_backend
+from prompts import render_prompt
+
+
+def judge_prompt(nl_query, sql_query, DATABASE_SCHEMA=DATABASE_SCHEMA):
+    return render_prompt(
+        "judge", DATABASE_SCHEMA, nl_query=nl_query, sql_query=sql_query
+    )
+
+
+def parse_judgement(text):
+    """Reads the score and reasoning out of the judge's reply."""
+    score = re.search(r"Score:\s*\"?'?(\d+)", text)
+    reasoning = re.search(r"Reasoning:\s*(.*)", text)
+    if score is None:
+        raise ValueError(f"No score in judge response: {text[:200]!r}")
+    return {
+        "score": int(score.group(1)),
+        "reasoning": reasoning.group(1).strip("\"' ") if reasoning else "",
+    }
+
+
+def judge_sql_logic(nl_query: str, sql_query: str, DATABASE_SCHEMA=DATABASE_SCHEMA):
+    """
+    Uses the LLM backend to verify if the given SQL query correctly implements the natural language query logic.
+
+    Args:
+        nl_query (str): The natural language query.
+        sql_query (str): The SQL query to check.
+
+    Returns:
+        dict: The score (100, 50 or 0) and the reasoning behind it.
+    """
+    response = get_llm_backend().complete(
+        "judge",
+        judge_prompt(nl_query, sql_query, DATABASE_SCHEMA).text,
+        f"{nl_query}\n{sql_query}",
+    )
+    return parse_judgement(response)
+
+
+def evaluate_results(df, batch_size=JUDGE_BATCH_SIZE, pause_seconds=5):
+    """Judges every row of an inference results DataFrame that has no score yet,
+    filling in its "score" and "reasoning" columns.
+
+    Rows go to the LLM `batch_size` at a time, `pause_seconds` apart, and
+    verdicts are cached by question and SQL (see judge.py), so rows judged
+    in an earlier run cost nothing. Rows without SQL score 0 without a call.
+    """
+    from judge import BatchJudge
+    from schema_introspection import get_database_schema
+
+    for column in ("score", "reasoning"):
+        if column not in df.columns:
+            df[column] = None
+    pending = df[df["score"].isna()]
+    has_sql = pending["sql_gen_query"].map(
+        lambda sql: isinstance(sql, str) and bool(sql.strip())
+    )
+    df.loc[pending.index[~has_sql], "score"] = 0
+    df.loc[pending.index[~has_sql], "reasoning"] = "No SQL was generated"
+    pending = pending[has_sql]
+
+    judge = BatchJudge(get_database_schema(), batch_size, pause_seconds)
+    verdicts = judge.judge(
+        list(zip(pending["Natural Language Query"], pending["sql_gen_query"]))
+    )
+    for (index, row), verdict in zip(pending.iterrows(), verdicts):
+        df.at[index, "score"] = verdict["score"]
+        df.at[index, "reasoning"] = verdict["reasoning"]
+        print(f"#{row['Query Number']}: {verdict['score']}")
+    stats = judge.stats()
+    print(
+        f"Judged {len(pending)} rows with {stats['calls']} LLM calls "
+        f"({stats['cached']} cached, {stats['single']} judged alone, "
+        f"{stats['failed']} left unscored)"
+    )
+    return df
+
+
+def main():
+    from batch_eval import read_eval_dataset
+
+    parser = argparse.ArgumentParser(description="Judge generated SQL with the LLM")
+    parser.add_argument("--input", default="inference_results.csv")
+    parser.add_argument("--output", default="evaluation_results.csv")
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=JUDGE_BATCH_SIZE,
+        help="questions judged per LLM call",
+    )
+    parser.add_argument(
+        "--pause", type=float, default=5, help="seconds between LLM calls"
+    )
+    parser.add_argument(
+        "--run",
+        default=None,
+        help="also add the scores to this run of the run store (imported "
+        "from --input if missing)",
+    )
+    args = parser.parse_args()
+
+    df = evaluate_results(
+        read_eval_dataset(args.input), args.batch_size, pause_seconds=args.pause
+    )
+    df.to_csv(args.output, index=False)
+    if args.run:
+        from run_store import RunStore, import_csv
+
+        store = RunStore()
+        if not store.has_run(args.run):
+            import_csv(store, args.input, args.run)
+        store.append_scores(args.run, df, "llm")
+        store.close()
+    print(f"\nMean score: {df['score'].astype(float).mean():.1f}")
+
+
+if __name__ == "__main__":
+    main()
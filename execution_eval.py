@@ -0,0 +1,243 @@
+## Execution accuracy: runs the generated and the gold SQL and compares their results locally
+import argparse
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from config import EVAL_FLOAT_TOLERANCE
+from result_cache import is_read_only
+
+
+GOLD_COLUMN = "Gold SQL"
+
+# Scores on the judge's scale (see evaluation.py)
+SCORES = {"exact": 100, "columns": 50, "set": 50, "mismatch": 0, "error": 0}
+_NULL = "\x00null"
+_NUMERIC_KINDS = {
+    "integer", "floating", "decimal", "mixed-integer-float", "string", "empty",
+}
+
+
+def result_frame(result, tolerance=EVAL_FLOAT_TOLERANCE):
+    """DataFrame of a QueryResult with comparable columns: numeric ones as
+    floats on a grid of `tolerance`, all others as text (nulls included)."""
+    df = result.to_dataframe()
+    df.columns = range(len(df.columns))  # names are not compared
+    for column in df.columns:
+        values = df[column]
+        numbers = None
+        # Text columns of the docker backend may hold numbers too
+        if pd.api.types.infer_dtype(values, skipna=True) in _NUMERIC_KINDS:
+            try:
+                numbers = pd.to_numeric(values)
+            except (ValueError, TypeError):
+                pass
+        if numbers is not None:
+            df[column] = np.round(numbers.astype(float) / tolerance) * tolerance
+        else:
+            df[column] = values.astype(str).where(values.notna(), _NULL)
+    return df
+
+
+def row_hashes(df):
+    """Sorted 64-bit hashes of the rows, equal for the same multiset of rows."""
+    return np.sort(pd.util.hash_pandas_object(df, index=False).to_numpy())
+
+
+def result_hash(df):
+    """Short hex digest of a result_frame that ignores row order."""
+    text = f"{len(df.columns)}:".encode() + row_hashes(df).tobytes()
+    return hashlib.sha256(text).hexdigest()[:16]
+
+
+def _sorted_rows(df):
+    text = [column for column in df.columns if df[column].dtype == object]
+    numeric = [column for column in df.columns if column not in text]
+    return df.sort_values(text + numeric, kind="mergesort").reset_index(drop=True)
+
+
+def same_rows(gold, predicted, tolerance=EVAL_FLOAT_TOLERANCE):
+    """True when both frames hold the same multiset of rows, numbers
+    compared within `tolerance`. Equal row hashes settle it at once; values
+    rounded to different sides of a grid step are compared row by row."""
+    if gold.shape != predicted.shape:
+        return False
+    if np.array_equal(row_hashes(gold), row_hashes(predicted)):
+        return True
+    gold, predicted = _sorted_rows(gold), _sorted_rows(predicted)
+    for column in gold.columns:
+        a, b = gold[column].to_numpy(), predicted[column].to_numpy()
+        if a.dtype == object or b.dtype == object:
+            if a.dtype != b.dtype or not np.array_equal(a, b):
+                return False
+        elif not np.allclose(a, b, rtol=0, atol=tolerance * 1.5, equal_nan=True):
+            return False
+    return True
+
+
+def _same_values(a, b, tolerance):
+    a, b = np.unique(a.to_numpy()), np.unique(b.to_numpy())
+    if a.dtype == object or b.dtype == object:
+        return a.dtype == b.dtype and np.array_equal(a, b)
+    return len(a) == len(b) and np.allclose(
+        a, b, rtol=0, atol=tolerance * 1.5, equal_nan=True
+    )
+
+
+def match_columns(gold, predicted, tolerance=EVAL_FLOAT_TOLERANCE):
+    """For each gold column, the predicted column with the same distinct
+    values (so column order and aliases do not matter), or None when some
+    gold column has no counterpart."""
+    mapping = []
+    for column in gold.columns:
+        match = next(
+            (
+                candidate
+                for candidate in predicted.columns
+                if candidate not in mapping
+                and _same_values(gold[column], predicted[candidate], tolerance)
+            ),
+            None,
+        )
+        if match is None:
+            return None
+        mapping.append(match)
+    return mapping
+
+
+def compare_results(gold, predicted, tolerance=EVAL_FLOAT_TOLERANCE):
+    """Compares two successful QueryResults, ignoring row and column order.
+
+    Returns (match, reasoning) where match is "exact" (same rows),
+    "columns" (same rows once extra predicted columns are left out), "set"
+    (same distinct rows, but not as many duplicates) or "mismatch".
+    """
+    gold, predicted = result_frame(gold, tolerance), result_frame(predicted, tolerance)
+    if gold.empty and predicted.empty:
+        return "exact", "No rows, like the gold SQL"
+    if same_rows(gold, predicted, tolerance):
+        return "exact", "Same rows as the gold SQL"
+    mapping = match_columns(gold, predicted, tolerance)
+    if mapping is None:
+        return "mismatch", (
+            f"Different values: {predicted.shape[0]} rows x {predicted.shape[1]} "
+            f"columns, gold has {gold.shape[0]} x {gold.shape[1]}"
+        )
+    projected = predicted[mapping].set_axis(gold.columns, axis=1)
+    extra = predicted.shape[1] - gold.shape[1]
+    if same_rows(gold, projected, tolerance):
+        if not extra:
+            return "exact", "Same rows as the gold SQL, in another column order"
+        return "columns", f"Same rows as the gold SQL, with {extra} extra columns"
+    if same_rows(
+        gold.drop_duplicates(), projected.drop_duplicates(), tolerance
+    ):
+        return "set", (
+            f"Same distinct rows as the gold SQL, but {len(projected)} rows "
+            f"instead of {len(gold)}"
+        )
+    return "mismatch", (
+        f"Different rows: {len(projected)} rows, gold has {len(gold)}"
+    )
+
+
+def score_row(gold_sql, sql, tolerance=EVAL_FLOAT_TOLERANCE):
+    """(match, reasoning) for one generated query against its gold SQL."""
+    from setup_db import execute_query
+
+    if not isinstance(gold_sql, str) or not gold_sql.strip():
+        return None, "No gold SQL"
+    if not isinstance(sql, str) or not sql.strip():
+        return "error", "No SQL was generated"
+    if not is_read_only(sql):
+        return "error", "Not run: the generated SQL may write"
+    gold = execute_query(gold_sql)
+    if not gold.ok:
+        return None, f"Gold SQL failed: {gold.error}"
+    predicted = execute_query(sql)
+    if not predicted.ok:
+        return "error", predicted.error.splitlines()[0]
+    return compare_results(gold, predicted, tolerance)
+
+
+def evaluate_execution(df, gold, workers=4, tolerance=EVAL_FLOAT_TOLERANCE):
+    """Scores every row of an inference results DataFrame against the gold
+    SQL of the same "Query Number" in `gold` (the evals dataset), filling in
+    its "match", "score" and "reasoning" columns. Rows without gold SQL get
+    no score."""
+    gold_sql = dict(zip(gold["Query Number"].astype(int), gold[GOLD_COLUMN]))
+    rows = [
+        (gold_sql.get(int(number)), sql)
+        for number, sql in zip(df["Query Number"], df["sql_gen_query"])
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(lambda row: score_row(*row, tolerance), rows))
+    df["match"] = [match for match, _ in outcomes]
+    df["score"] = [SCORES.get(match) for match, _ in outcomes]
+    df["reasoning"] = [reasoning for _, reasoning in outcomes]
+    return df
+
+
+def main():
+    from batch_eval import EVAL_DATASET_PATH, load_results, read_eval_dataset
+
+    parser = argparse.ArgumentParser(
+        description="Score generated SQL by running it against the gold SQL"
+    )
+    parser.add_argument(
+        "--input",
+        default="inference_results.csv",
+        help="inference results (.csv, or a batch_eval .jsonl checkpoint)",
+    )
+    parser.add_argument("--gold", default=EVAL_DATASET_PATH)
+    parser.add_argument("--output", default="execution_results.csv")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=EVAL_FLOAT_TOLERANCE,
+        help="absolute difference under which numbers are equal",
+    )
+    parser.add_argument(
+        "--run",
+        default=None,
+        help="also add the scores to this run of the run store (imported "
+        "from --input if missing)",
+    )
+    args = parser.parse_args()
+
+    if args.input.lower().endswith(".jsonl"):
+        df = load_results(args.input)
+    else:
+        df = read_eval_dataset(args.input)
+    start = time.perf_counter()
+    df = evaluate_execution(
+        df, read_eval_dataset(args.gold), args.workers, args.tolerance
+    )
+    elapsed = time.perf_counter() - start
+    df.to_csv(args.output, index=False)
+    if args.run:
+        from run_store import RunStore, import_csv
+
+        store = RunStore()
+        if not store.has_run(args.run):
+            import_csv(store, args.input, args.run)
+        store.append_scores(args.run, df, "execution")
+        store.close()
+
+    scored = df[df["score"].notna()]
+    print(df.groupby("match", dropna=False).size().to_string())
+    if "Difficulty" in scored.columns:
+        print(scored.groupby("Difficulty")["score"].mean().round(1).to_string())
+    print(
+        f"\nExecution accuracy {(scored['match'] == 'exact').mean() * 100:.1f}%, "
+        f"mean score {scored['score'].mean():.1f} over {len(scored)} questions "
+        f"in {elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+## BM25 index of answered questions, used as few-shot examples for generate_sql
+import json
+import math
+import os
+import threading
+from collections import Counter
+
+from config import (
+    COT_TEXT2SQL_EXAMPLE,
+    FEWSHOT_ENABLED,
+    FEWSHOT_K,
+    FEWSHOT_PATH,
+    FEWSHOT_SEED_FILE,
+)
+from schema_linking import tokenize
+from sql_cache import normalize_question
+
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+class FewShotIndex:
+    """BM25 index over question -> SQL pairs.
+
+    Questions are tokenized like schema linking does (stemmed, synonyms such
+    as movie -> film, stopwords dropped). With ``path`` set, pairs added at
+    run time are appended to that JSONL file and loaded back on start-up.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.examples = []  # (question, sql, term counts, length)
+        self.document_frequency = Counter()
+        self._questions = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.examples)
+
+    def _add(self, question, sql):
+        key = normalize_question(question)
+        if key in self._questions:
+            return False
+        terms = Counter(tokenize(question))
+        self.examples.append((question, sql.strip(), terms, sum(terms.values())))
+        self.document_frequency.update(terms.keys())
+        self._questions.add(key)
+        return True
+
+    def add(self, question, sql, persist=True):
+        """Adds a pair (once per question); returns whether it was new."""
+        with self._lock:
+            added = self._add(question, sql)
+            if added and persist and self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"question": question, "sql": sql}) + "\n")
+        return added
+
+    def load(self, path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self._add(record["question"], record["sql"])
+        return self
+
+    def load_evaluations(self, path, min_score=100):
+        """Adds the pairs of an evaluation results CSV scoring at least `min_score`."""
+        from batch_eval import read_eval_dataset
+
+        df = read_eval_dataset(path)
+        verified = df[df["score"] >= min_score].dropna(subset=["sql_gen_query"])
+        for _, row in verified.iterrows():
+            self._add(row["Natural Language Query"], row["sql_gen_query"])
+        return self
+
+    def search(self, question, k=FEWSHOT_K):
+        """Top-k (question, sql, score) pairs for the question.
+
+        The question itself is never returned: repeated questions are served
+        by the SQL cache, and evaluating on seeded questions stays honest.
+        """
+        terms = tokenize(question)
+        key = normalize_question(question)
+        with self._lock:
+            count = len(self.examples)
+            if not count or not terms:
+                return []
+            average_length = sum(example[3] for example in self.examples) / count
+            scored = []
+            for example_question, sql, counts, length in self.examples:
+                if normalize_question(example_question) == key:
+                    continue
+                score = 0.0
+                for term in terms:
+                    frequency = counts.get(term)
+                    if not frequency:
+                        continue
+                    df = self.document_frequency[term]
+                    idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+                    score += idf * frequency * (BM25_K1 + 1) / (
+                        frequency
+                        + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+                    )
+                if score > 0:
+                    scored.append((example_question, sql, score))
+        scored.sort(key=lambda example: -example[2])
+        return scored[:k]
+
+
+def render_examples(examples):
+    """Formats retrieved pairs for the generate_sql prompt."""
+    return "\n\n".join(
+        f"Question: {question}\nSQL Query: {sql}" for question, sql, _ in examples
+    )
+
+
+_fewshot_index = None
+_fewshot_index_lock = threading.Lock()
+
+
+def get_fewshot_index():
+    """Returns the shared index, seeded from FEWSHOT_SEED_FILE and FEWSHOT_PATH,
+    or None when FEWSHOT_ENABLED is off."""
+    global _fewshot_index
+    if not FEWSHOT_ENABLED:
+        return None
+    with _fewshot_index_lock:
+        if _fewshot_index is None:
+            index = FewShotIndex(FEWSHOT_PATH or None)
+            if FEWSHOT_SEED_FILE and os.path.exists(FEWSHOT_SEED_FILE):
+                index.load_evaluations(FEWSHOT_SEED_FILE)
+            if FEWSHOT_PATH and os.path.exists(FEWSHOT_PATH):
+                index.load(FEWSHOT_PATH)
+            _fewshot_index = index
+        return _fewshot_index
+
+
+def fewshot_examples(question, k=FEWSHOT_K):
+    """Examples for the generate_sql prompt: the k most similar answered
+    questions, or COT_TEXT2SQL_EXAMPLE when the index is off or has no match."""
+    index = get_fewshot_index()
+    examples = index.search(question, k) if index is not None else []
+    return render_examples(examples) if examples else COT_TEXT2SQL_EXAMPLE
+
+
+if __name__ == "__main__":
+    # Leave-one-out over the verified pairs of FEWSHOT_SEED_FILE: how much
+    # smaller the examples are than COT_TEXT2SQL_EXAMPLE, and whether the
+    # retrieved SQL uses the tables the verified SQL needs. With --live, also
+    # compares first-attempt success of generate_sql with either examples
+    # (needs the LLM and the database).
+    import sys
+
+    from result_cache import referenced_tables
+    from schema_linking import get_schema_graph
+    from prompts import count_tokens
+
+    index = FewShotIndex().load_evaluations(FEWSHOT_SEED_FILE)
+    tables = get_schema_graph().tables
+    live = "--live" in sys.argv
+
+    cot_tokens = count_tokens(COT_TEXT2SQL_EXAMPLE)
+    total_tokens = 0
+    needed_tables = 0
+    covered_tables = 0
+    first_attempt = {"cot": 0, "retrieved": 0}
+    for question, sql, _, _ in index.examples:
+        examples = index.search(question)
+        rendered = render_examples(examples) if examples else COT_TEXT2SQL_EXAMPLE
+        total_tokens += count_tokens(rendered)
+        needed = referenced_tables(sql, tables)
+        covered = set()
+        for _, example_sql, _ in examples:
+            covered |= referenced_tables(example_sql, tables)
+        needed_tables += len(needed)
+        covered_tables += len(needed & covered)
+        line = (
+            f"{count_tokens(rendered):>5}/{cot_tokens} tokens "
+            f"tables {len(needed & covered)}/{len(needed)}  {question[:60]}"
+        )
+
+        if live:
+            from query_guard import execute_guarded
+            from self_consistency import result_fingerprint
+            from text2sql import generate_sql
+
+            gold = execute_guarded(sql)
+            for name, prompt_examples in (
+                ("cot", COT_TEXT2SQL_EXAMPLE),
+                ("retrieved", rendered),
+            ):
+                result = execute_guarded(
+                    generate_sql(question, COT_TEXT2SQL_EXAMPLE=prompt_examples)
+                )
+                if result.ok and gold.ok and (
+                    result_fingerprint(result) == result_fingerprint(gold)
+                ):
+                    first_attempt[name] += 1
+                    line += f" {name}=ok"
+        print(line)
+
+    count = len(index)
+    print(
+        f"\nAverage examples size: {total_tokens / count:.0f} tokens "
+        f"vs {cot_tokens} ({1 - total_tokens / (count * cot_tokens):.0%} smaller)"
+    )
+    print(
+        f"Tables of the verified SQL used by the examples: {covered_tables}/"
+        f"{needed_tables} ({covered_tables / needed_tables:.0%})"
+    )
+    if live:
+        print(
+            f"First-attempt success: {first_attempt['cot']}/{count} with the "
+            f"CoT example, {first_attempt['retrieved']}/{count} retrieved"
+        )
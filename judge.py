@@ -0,0 +1,255 @@
+## Batched, cached LLM judging of generated SQL
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from config import JUDGE_BATCH_SIZE, JUDGE_CACHE_PATH, JUDGE_VERSION
+from evaluation import judge_sql_logic, parse_judgement
+from llm_backend import get_llm_backend
+from prompts import PROMPTS, PromptBudgetExceeded, render_prompt
+from sql_cache import normalize_question
+from tracing import metrics
+
+
+# String literals, kept as written when normalizing SQL
+_SQL_LITERAL_RE = re.compile(r"('(?:[^']|'')*')")
+# "Item 3" headings, for replies that are not JSON
+_ITEM_RE = re.compile(r"(?im)^[\s*#\[]*item\s+(\d+)\b[^\n]*")
+
+
+def normalize_sql(sql):
+    """Case-, whitespace- and comment-insensitive form of a query. String
+    literals keep their case, so 'Action' and 'action' stay different."""
+    sql = re.sub(r"--[^\n]*", " ", sql).strip().rstrip(";")
+    parts = _SQL_LITERAL_RE.split(sql)
+    for i in range(0, len(parts), 2):
+        part = " ".join(parts[i].lower().split())
+        parts[i] = re.sub(r" ?([^\w\s]) ?", r"\1", part)
+    return "".join(parts)
+
+
+def format_items(items):
+    return "\n\n".join(
+        f"Item {number}\nNL Query: {question}\nSQL Query: {sql}"
+        for number, (question, sql) in enumerate(items, 1)
+    )
+
+
+def parse_batch_judgement(text, count):
+    """{item number: {"score", "reasoning"}} read from a batch_judge reply.
+
+    The reply should be a JSON array; when it is not, "Item N" blocks in the
+    single judge's "Score: / Reasoning:" format are read instead. Items that
+    are missing, out of range or have no valid score are left out.
+    """
+    verdicts = {}
+    try:
+        items = json.loads(text[text.find("[") : text.rfind("]") + 1])
+    except ValueError:
+        items = []
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict):
+            continue
+        try:
+            number, score = int(item.get("id")), int(float(item.get("score")))
+        except (TypeError, ValueError):
+            continue
+        if 1 <= number <= count and 0 <= score <= 100:
+            verdicts[number] = {
+                "score": score,
+                "reasoning": str(item.get("reasoning") or "").strip(),
+            }
+    if verdicts:
+        return verdicts
+
+    blocks = _ITEM_RE.split(text)
+    for number, block in zip(blocks[1::2], blocks[2::2]):
+        try:
+            verdict = parse_judgement(block)
+        except ValueError:
+            continue
+        if 1 <= int(number) <= count and 0 <= verdict["score"] <= 100:
+            verdicts[int(number)] = verdict
+    return verdicts
+
+
+class JudgeCache:
+    """Verdicts keyed by (question, normalized SQL, judge version).
+
+    The version combines JUDGE_VERSION with the hash of the batch_judge
+    prompt prefix, so a change of instructions or schema judges everything
+    again. With ``path`` set, verdicts are kept in a SQLite file.
+    """
+
+    def __init__(self, version, path=JUDGE_CACHE_PATH):
+        self.version = version
+        self._verdicts = {}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS judge_cache (
+                    key TEXT PRIMARY KEY,
+                    version TEXT,
+                    question TEXT,
+                    sql TEXT,
+                    score INTEGER,
+                    reasoning TEXT,
+                    created_at REAL
+                )"""
+            )
+            self._db.commit()
+            rows = self._db.execute(
+                "SELECT key, score, reasoning FROM judge_cache WHERE version = ?",
+                (version,),
+            ).fetchall()
+            for key, score, reasoning in rows:
+                self._verdicts[key] = {"score": score, "reasoning": reasoning}
+
+    def key(self, question, sql):
+        text = f"{self.version}|{normalize_question(question)}|{normalize_sql(sql)}"
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            return self._verdicts.get(key)
+
+    def put(self, key, question, sql, verdict):
+        with self._lock:
+            self._verdicts[key] = verdict
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO judge_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        key,
+                        self.version,
+                        question,
+                        sql,
+                        verdict["score"],
+                        verdict["reasoning"],
+                        time.time(),
+                    ),
+                )
+                self._db.commit()
+
+
+class BatchJudge:
+    """Judges (question, SQL) pairs `batch_size` at a time.
+
+    Each call sends the schema once, as the cacheable prefix of the
+    batch_judge prompt, followed by the numbered items. Cached verdicts are
+    reused, identical pairs are judged once, a batch over its token budget
+    is split in two, and the items a reply leaves out (or every item, when
+    the call fails) are judged one by one with the single judge. An item the
+    single judge cannot score either gets a None score (not cached, so a
+    later run judges it again) instead of stopping the run. Calls are
+    `pause_seconds` apart, to stay under the API rate limit.
+    """
+
+    def __init__(self, schema, batch_size=JUDGE_BATCH_SIZE, pause_seconds=0,
+                 cache_path=JUDGE_CACHE_PATH):
+        self.schema = schema
+        self.batch_size = max(1, batch_size)
+        self.pause_seconds = pause_seconds
+        prefix_hash = PROMPTS["batch_judge"].prefix(schema)[1]
+        self.cache = JudgeCache(f"{JUDGE_VERSION}:{prefix_hash}", cache_path)
+        self.calls = 0
+        self.cached = 0
+        self.single = 0
+        self.failed = 0
+        self._last_call = None
+
+    def _pace(self):
+        if self._last_call is not None and self.pause_seconds:
+            wait = self._last_call + self.pause_seconds - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+        self._last_call = time.monotonic()
+        self.calls += 1
+
+    def _judge_one(self, question, sql):
+        """Verdict of the single judge, or None when it gives no score."""
+        self._pace()
+        self.single += 1
+        try:
+            verdict = judge_sql_logic(question, sql, self.schema)
+        except Exception as e:
+            print(f"Could not judge {question[:60]!r}: {type(e).__name__}: {e}")
+            self.failed += 1
+            metrics.increment("text2sql_judge_items_total", source="failed")
+            return None
+        metrics.increment("text2sql_judge_items_total", source="single")
+        return verdict
+
+    def _judge_batch(self, items):
+        """{item index: verdict} for `items`, judged in one call if possible."""
+        try:
+            prompt = render_prompt(
+                "batch_judge", self.schema, items=format_items(items)
+            )
+        except PromptBudgetExceeded:
+            if len(items) == 1:
+                raise
+            half = len(items) // 2
+            first = self._judge_batch(items[:half])
+            second = self._judge_batch(items[half:])
+            return {**first, **{index + half: v for index, v in second.items()}}
+
+        self._pace()
+        try:
+            response = get_llm_backend().complete(
+                "batch_judge",
+                prompt.text,
+                "\n\n".join(f"{question}\n{sql}" for question, sql in items),
+            )
+            verdicts = parse_batch_judgement(response, len(items))
+        except Exception as e:
+            print(f"Batch judge call failed, judging its items one by one: {e}")
+            verdicts = {}
+        metrics.increment(
+            "text2sql_judge_items_total", value=len(verdicts), source="batch"
+        )
+        return {number - 1: verdict for number, verdict in verdicts.items()}
+
+    def judge(self, items):
+        """Verdicts ({"score", "reasoning"}) for [(question, sql)], in order.
+        Items that could not be judged have a None score."""
+        keys = [self.cache.key(question, sql) for question, sql in items]
+        failed = {}
+        pending = {}
+        for key, item in zip(keys, items):
+            if self.cache.get(key) is not None:
+                self.cached += 1
+                metrics.increment("text2sql_judge_items_total", source="cache")
+            else:
+                pending.setdefault(key, item)
+
+        pending_keys = list(pending)
+        for start in range(0, len(pending_keys), self.batch_size):
+            batch_keys = pending_keys[start : start + self.batch_size]
+            batch = [pending[key] for key in batch_keys]
+            verdicts = self._judge_batch(batch)
+            for index, (key, (question, sql)) in enumerate(zip(batch_keys, batch)):
+                verdict = verdicts.get(index)
+                if verdict is None:
+                    verdict = self._judge_one(question, sql)
+                if verdict is None:
+                    failed[key] = {
+                        "score": None,
+                        "reasoning": "The judge gave no score",
+                    }
+                else:
+                    self.cache.put(key, question, sql, verdict)
+        return [failed.get(key) or self.cache.get(key) for key in keys]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "cached": self.cached,
+            "single": self.single,
+            "failed": self.failed,
+        }
@@ -0,0 +1,274 @@
+## Pluggable LLM backends: Gemini, and an offline record/replay stand-in
+import json
+import os
+import random
+import threading
+import time
+
+from config import (
+    GOOGLE_API_KEY,
+    LANGCHAIN_API_KEY,
+    LANGCHAIN_PROJECT,
+    LANGCHAIN_ENDPOINT,
+    LLM_MODEL,
+    LLM_BACKEND,
+    LLM_REPLAY_PATH,
+    LLM_REPLAY_SEED_FILES,
+    LLM_REPLAY_LATENCY,
+    LLM_REPLAY_ERROR_RATE,
+    LLM_REPLAY_RANDOM_SEED,
+    SELF_CONSISTENCY_TEMPERATURE,
+)
+from sql_cache import normalize_question
+
+
+# What each call is for. Replay looks responses up by (role, key), where the
+# key is the input that determines the answer: the question for
+# sql_generator/query_validator, the SQL for sql_validator/sql_repair and
+# question + SQL for the judge (and every item's, one per paragraph, for
+# batch_judge). sql_sampler generates SQL like sql_generator, sampled at a
+# higher temperature for self-consistency candidates.
+LLM_ROLES = (
+    "sql_generator",
+    "sql_sampler",
+    "sql_validator",
+    "sql_repair",
+    "query_validator",
+    "judge",
+    "batch_judge",
+)
+
+# Sampling temperature per role, the model default otherwise
+ROLE_TEMPERATURES = {"sql_sampler": SELF_CONSISTENCY_TEMPERATURE}
+
+# Roles whose answer is the SQL they were given when nothing was recorded
+ECHO_ROLES = ("sql_validator", "sql_repair")
+
+
+def replay_key(text):
+    return normalize_question(text)
+
+
+class ReplayMiss(LookupError):
+    """Raised when the replay backend has no response for a call."""
+
+
+class InjectedLLMError(RuntimeError):
+    """Simulated API failure raised by the replay backend."""
+
+
+class LLMBackend:
+    """Interface of the LLM used by text2sql and the judge."""
+
+    def complete(self, role, prompt, key):
+        """Returns the model's reply to `prompt`, sent for `role` (one of
+        LLM_ROLES). `key` identifies the call for recording and replay."""
+        raise NotImplementedError
+
+
+class GeminiBackend(LLMBackend):
+    """Google Gemini through langchain, one chat client per role."""
+
+    def __init__(self, model=LLM_MODEL):
+        self.model = model
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._configured = False
+
+    def _configure(self):
+        import google.generativeai as genai
+
+        genai.configure(api_key=GOOGLE_API_KEY)
+        # Only trace when a LangSmith key is configured
+        if LANGCHAIN_API_KEY:
+            os.environ["LANGCHAIN_API_KEY"] = LANGCHAIN_API_KEY
+            os.environ["LANGCHAIN_TRACING_V2"] = "true"
+            os.environ["LANGCHAIN_PROJECT"] = LANGCHAIN_PROJECT
+            os.environ["LANGCHAIN_ENDPOINT"] = LANGCHAIN_ENDPOINT
+        self._configured = True
+
+    def client(self, role):
+        """Returns the chat model for `role`, creating it on first use."""
+        client = self._clients.get(role)
+        if client is not None:
+            return client
+        if role not in LLM_ROLES:
+            raise ValueError(f"Unknown LLM role: {role}")
+        with self._lock:
+            if role not in self._clients:
+                if not self._configured:
+                    self._configure()
+                from langchain_google_genai import ChatGoogleGenerativeAI
+
+                options = {}
+                if role in ROLE_TEMPERATURES:
+                    options["temperature"] = ROLE_TEMPERATURES[role]
+                self._clients[role] = ChatGoogleGenerativeAI(
+                    model=self.model, **options
+                )
+            return self._clients[role]
+
+    def complete(self, role, prompt, key):
+        from langchain.schema import HumanMessage
+
+        return self.client(role).invoke([HumanMessage(content=prompt)]).content
+
+
+class RecordingBackend(LLMBackend):
+    """Passes calls on to another backend and appends every response to a
+    JSONL file that ReplayBackend can load."""
+
+    def __init__(self, backend, path=LLM_REPLAY_PATH):
+        self.backend = backend
+        self.path = path
+        self._lock = threading.Lock()
+
+    def complete(self, role, prompt, key):
+        response = self.backend.complete(role, prompt, key)
+        record = {"role": role, "key": key, "response": response}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        return response
+
+
+class ReplayBackend(LLMBackend):
+    """Answers from recorded responses, without network access.
+
+    Each call sleeps `latency` seconds (varied by +/- `jitter` of it) and
+    fails with InjectedLLMError at `error_rate`, drawn from a generator
+    seeded with `seed`, so benchmark runs are repeatable. A call with no
+    recorded response echoes its SQL for ECHO_ROLES and raises ReplayMiss
+    otherwise.
+    """
+
+    def __init__(self, responses=None, latency=0.0, jitter=0.0, error_rate=0.0, seed=0):
+        self.responses = {}
+        for (role, key), response in (responses or {}).items():
+            self.add(role, key, response)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.misses = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def add(self, role, key, response):
+        self.responses[(role, replay_key(key))] = response
+
+    def load_recordings(self, path):
+        """Adds the responses of a RecordingBackend JSONL file."""
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.add(record["role"], record["key"], record["response"])
+        return self
+
+    def load_results(self, path):
+        """Adds responses rebuilt from an inference or evaluation results CSV:
+        each question generates its recorded sql_gen_query, which validates
+        to itself, and the judge answers with the recorded score."""
+        import pandas as pd
+
+        from batch_eval import read_eval_dataset
+
+        df = read_eval_dataset(path)
+        for _, row in df.dropna(subset=["sql_gen_query"]).iterrows():
+            question, sql = row["Natural Language Query"], row["sql_gen_query"]
+            self.add("sql_generator", question, sql)
+            self.add("sql_sampler", question, sql)
+            self.add("sql_validator", sql, sql)
+            self.add(
+                "query_validator",
+                question,
+                json.dumps(
+                    {"original_query": question, "corrected_input": question, "feedback": ""}
+                ),
+            )
+            if pd.notna(row.get("score")):
+                self.add(
+                    "judge",
+                    f"{question}\n{sql}",
+                    f"Score: {int(row['score'])}\nReasoning: {row.get('reasoning', '')}",
+                )
+        return self
+
+    def complete(self, role, prompt, key):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self._random.uniform(-self.jitter, self.jitter))
+            fail = self._random.random() < self.error_rate
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            raise InjectedLLMError(f"Injected {role} failure")
+        response = self.responses.get((role, replay_key(key)))
+        if response is not None:
+            return response
+        with self._lock:
+            self.misses += 1
+        if role in ECHO_ROLES:
+            return key
+        raise ReplayMiss(f"No recorded {role} response for {key!r}")
+
+    def stats(self):
+        return {
+            "responses": len(self.responses),
+            "calls": self.calls,
+            "misses": self.misses,
+            "errors": self.errors,
+        }
+
+
+def replay_backend_from_config():
+    """ReplayBackend seeded from LLM_REPLAY_SEED_FILES and the recordings in
+    LLM_REPLAY_PATH, with the configured latency and error rate."""
+    backend = ReplayBackend(
+        latency=LLM_REPLAY_LATENCY,
+        error_rate=LLM_REPLAY_ERROR_RATE,
+        seed=LLM_REPLAY_RANDOM_SEED,
+    )
+    for path in LLM_REPLAY_SEED_FILES:
+        if os.path.exists(path):
+            backend.load_results(path)
+    if os.path.exists(LLM_REPLAY_PATH):
+        backend.load_recordings(LLM_REPLAY_PATH)
+    return backend
+
+
+_gemini_backend = GeminiBackend()
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def gemini_client(role):
+    """The shared Gemini chat model for `role`."""
+    return _gemini_backend.client(role)
+
+
+def get_llm_backend():
+    """Returns the backend selected by LLM_BACKEND ("gemini", "record" or
+    "replay"), created on first use."""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if LLM_BACKEND == "replay":
+                    _backend = replay_backend_from_config()
+                elif LLM_BACKEND == "record":
+                    _backend = RecordingBackend(_gemini_backend)
+                else:
+                    _backend = _gemini_backend
+    return _backend
+
+
+def set_llm_backend(backend):
+    """Replaces the backend, e.g. with a ReplayBackend for benchmarks."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
@@ -0,0 +1,288 @@
+## Bulk loader for the Pagila database: COPY in parallel, keys and indexes after the data
+import io
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DATABASE_URL, DB_READY_TIMEOUT, LOADER_WORKERS
+from db_engine import psycopg2
+from profiling import profile_request, timed_step
+
+
+SCHEMA_PATH = "pagila/pagila-schema.sql"
+DATA_PATH = "pagila/pagila-data.sql"
+
+# Post-data statements built per table, in parallel once the rows are in
+_KEY_OR_INDEX_RE = re.compile(
+    r"^(?:ALTER TABLE ONLY (\S+)\s+ADD CONSTRAINT \S+ (?:PRIMARY KEY|UNIQUE)"
+    r"|CREATE (?:UNIQUE )?INDEX \S+ ON (?:ONLY )?(\S+))"
+)
+# Other post-data statements (foreign keys, triggers, index attachments,
+# grants), run in dump order after the keys and indexes
+_POST_DATA_RE = re.compile(
+    r"^(?:ALTER TABLE ONLY \S+\s+ADD CONSTRAINT|CREATE (?:UNIQUE )?INDEX"
+    r"|ALTER INDEX|CREATE TRIGGER|CREATE RULE|REVOKE|GRANT)"
+)
+_COPY_RE = re.compile(r"^COPY (\S+) \(.*\) FROM stdin;$")
+# The dump creates materialized views WITH NO DATA, pg_restore refreshes
+# them in its post-data step
+MATVIEWS_QUERY = """SELECT matviewname, ispopulated FROM pg_matviews
+WHERE schemaname = 'public' ORDER BY matviewname"""
+# Fails on a materialized view that was never refreshed
+MATVIEW_CHECK_QUERY = "SELECT count(*) FROM public.rental_by_category"
+
+
+def split_statements(sql):
+    """Splits a pg_dump script into statements, keeping $$-quoted function
+    bodies whole and dropping comments between statements."""
+    statements = []
+    current = []
+    dollar_tag = None
+    for line in sql.splitlines(keepends=True):
+        if not current and (not line.strip() or line.startswith("--")):
+            continue
+        current.append(line)
+        for tag in re.findall(r"\$\w*\$", line):
+            if dollar_tag is None:
+                dollar_tag = tag
+            elif tag == dollar_tag:
+                dollar_tag = None
+        if dollar_tag is None and line.rstrip().endswith(";"):
+            statements.append("".join(current).strip())
+            current = []
+    return statements
+
+
+def parse_schema(sql):
+    """Splits the schema dump into (pre-data statements, {table: key and
+    index statements}, other post-data statements)."""
+    pre_data, keys_and_indexes, post_data = [], {}, []
+    for statement in split_statements(sql):
+        match = _KEY_OR_INDEX_RE.match(statement)
+        if match:
+            table = match.group(1) or match.group(2)
+            keys_and_indexes.setdefault(table, []).append(statement)
+        elif _POST_DATA_RE.match(statement):
+            post_data.append(statement)
+        else:
+            pre_data.append(statement)
+    return pre_data, keys_and_indexes, post_data
+
+
+def parse_data(sql):
+    """Splits the data dump into (session settings, COPY blocks, other
+    statements). Each COPY block is (table, COPY statement, rows as text)."""
+    settings, copies, other = [], [], []
+    lines = iter(sql.splitlines(keepends=True))
+    rest = []
+    for line in lines:
+        match = _COPY_RE.match(line.rstrip("\n"))
+        if not match:
+            rest.append(line)
+            continue
+        rows = []
+        for row in lines:
+            if row.rstrip("\n") == "\\.":
+                break
+            rows.append(row)
+        copies.append((match.group(1), line.strip().rstrip(";"), "".join(rows)))
+    for statement in split_statements("".join(rest)):
+        if statement.startswith("SET ") or "set_config" in statement:
+            settings.append(statement)
+        else:
+            other.append(statement)
+    return settings, copies, other
+
+
+def wait_for_server(dsn=DATABASE_URL, timeout=DB_READY_TIMEOUT):
+    """Polls until the server accepts connections to the maintenance database
+    (backing off from 50ms to 1s) and returns that connection."""
+    params = psycopg2.extensions.parse_dsn(dsn)
+    params["dbname"] = "postgres"
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            return psycopg2.connect(connect_timeout=2, **params)
+        except psycopg2.OperationalError:
+            if time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+
+def _connect(dsn, settings=()):
+    conn = psycopg2.connect(dsn)
+    with conn.cursor() as cur:
+        for statement in settings:
+            cur.execute(statement)
+    conn.commit()
+    return conn
+
+
+def _run_in_transaction(dsn, statements, settings=()):
+    conn = _connect(dsn, settings)
+    try:
+        with conn.cursor() as cur:
+            for statement in statements:
+                cur.execute(statement)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _copy_table(dsn, settings, copy_statement, rows):
+    conn = _connect(dsn, settings)
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(copy_statement, io.StringIO(rows))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_pagila(
+    dsn=DATABASE_URL,
+    schema_path=SCHEMA_PATH,
+    data_path=DATA_PATH,
+    workers=LOADER_WORKERS,
+):
+    """Creates and fills the Pagila database, skipping whatever is already
+    there, and returns the seconds spent per phase.
+
+    - wait: until the server accepts connections, polled instead of slept
+    - checks: database, schema, keys and empty tables, over one connection
+    - schema: tables, types, functions and views in one transaction
+    - data: one COPY per table, `workers` tables at a time. Foreign keys
+      only exist after the data (or are disabled while loading into an
+      existing schema), so tables load in any order
+    - indexes: primary keys, unique constraints and indexes, per table in
+      parallel
+    - constraints: foreign keys, triggers and grants, in dump order
+    - matviews: refreshes the materialized views (all of them after a
+      load, otherwise the ones never refreshed), then reads
+      rental_by_category to check they can be queried
+    - analyze: statistics for the planner and for schema introspection
+    """
+    if psycopg2 is None:
+        raise RuntimeError("The bulk loader needs psycopg2")
+    database = psycopg2.extensions.parse_dsn(dsn)["dbname"]
+    with open(schema_path, encoding="utf-8") as f:
+        pre_data, keys_and_indexes, post_data = parse_schema(f.read())
+    with open(data_path, encoding="utf-8") as f:
+        settings, copies, other = parse_data(f.read())
+
+    with profile_request() as profile:
+        with timed_step("wait"):
+            admin = wait_for_server(dsn)
+
+        with timed_step("checks"):
+            admin.autocommit = True
+            try:
+                with admin.cursor() as cur:
+                    cur.execute(
+                        "SELECT 1 FROM pg_database WHERE datname = %s", (database,)
+                    )
+                    if cur.fetchone() is None:
+                        print(f"Creating database {database}...")
+                        cur.execute(f'CREATE DATABASE "{database}"')
+            finally:
+                admin.close()
+
+            conn = psycopg2.connect(dsn)
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT
+                            (SELECT count(*) FROM pg_tables WHERE schemaname = 'public'),
+                            (SELECT count(*) FROM pg_constraint
+                             WHERE contype = 'p' AND connamespace = 'public'::regnamespace)"""
+                    )
+                    tables, keys = cur.fetchone()
+                    empty = {table for table, _, _ in copies}
+                    if tables:
+                        cur.execute(
+                            " UNION ALL ".join(
+                                f"SELECT '{table}', EXISTS (SELECT 1 FROM {table})"
+                                for table, _, _ in copies
+                            )
+                        )
+                        empty = {table for table, filled in cur.fetchall() if not filled}
+            finally:
+                conn.close()
+
+        if tables:
+            print("Schema already exists, skipping schema load...")
+        else:
+            print("Loading pagila schema...")
+            with timed_step("schema"):
+                _run_in_transaction(dsn, pre_data)
+
+        pending = [copy for copy in copies if copy[0] in empty]
+        if pending:
+            print(f"Loading {len(pending)} tables with {workers} workers...")
+            # Keys created by an earlier load would check every row
+            load_settings = settings + ["SET synchronous_commit = off"]
+            if keys:
+                load_settings.append("SET session_replication_role = replica")
+            with timed_step("data"):
+                # Largest tables first, so they do not finish last
+                pending.sort(key=lambda copy: -len(copy[2]))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(
+                        executor.map(
+                            lambda copy: _copy_table(dsn, load_settings, copy[1], copy[2]),
+                            pending,
+                        )
+                    )
+                _run_in_transaction(dsn, other, settings)
+        else:
+            print("Data already exists, skipping data load...")
+
+        if not keys:
+            print("Building keys, indexes and constraints...")
+            with timed_step("indexes"):
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(
+                        executor.map(
+                            lambda statements: _run_in_transaction(
+                                dsn, statements, settings
+                            ),
+                            keys_and_indexes.values(),
+                        )
+                    )
+            with timed_step("constraints"):
+                _run_in_transaction(dsn, post_data, settings)
+
+        with timed_step("matviews"):
+            conn = psycopg2.connect(dsn)
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(MATVIEWS_QUERY)
+                    for name, populated in cur.fetchall():
+                        if pending or not populated:
+                            cur.execute(f'REFRESH MATERIALIZED VIEW public."{name}"')
+                    cur.execute(MATVIEW_CHECK_QUERY)
+            finally:
+                conn.close()
+
+        if pending or not keys:
+            with timed_step("analyze"):
+                conn = psycopg2.connect(dsn)
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("ANALYZE")
+                finally:
+                    conn.close()
+
+    total = sum(profile.steps.values())
+    for phase, seconds in profile.steps.items():
+        print(f"  {phase:<12} {seconds * 1000:8.0f}ms")
+    print(f"Pagila database ready in {total:.2f}s")
+    return profile.steps
+
+
+if __name__ == "__main__":
+    load_pagila()
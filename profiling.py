@@ -0,0 +1,84 @@
+## Per-request timings of pipeline steps (graph nodes, LLM calls, formatting)
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from tracing import span
+
+
+_current_profile = contextvars.ContextVar("request_profile", default=None)
+
+
+class RequestProfile:
+    """Timings and counters collected while one request runs.
+
+    `steps` maps a step name to the seconds spent in it (summed when a step
+    runs more than once, e.g. execute_sql after a repair) and `calls` to how
+    often it ran; `values` holds other per-request numbers such as prompt
+    sizes.
+    """
+
+    def __init__(self):
+        self.steps = {}
+        self.calls = {}
+        self.values = {}
+
+    def add_step(self, name, seconds):
+        self.steps[name] = self.steps.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def add_value(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+
+@contextmanager
+def profile_request():
+    """Collects the steps timed inside the ``with`` block into a RequestProfile.
+
+    The profile is held in a context variable, so it follows the request into
+    the graph nodes without being passed around. Outside of this block,
+    timing is a no-op.
+    """
+    profile = RequestProfile()
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+
+
+@contextmanager
+def timed_step(name):
+    """Times the block as step `name` of the current profile, and as a span."""
+    with span(name):
+        profile = _current_profile.get()
+        if profile is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.add_step(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorator recording each call of the function as step `name`."""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed_step(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_value(name, value):
+    """Adds `value` to counter `name` of the current request, if profiled."""
+    profile = _current_profile.get()
+    if profile is not None:
+        profile.add_value(name, value)
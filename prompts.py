@@ -0,0 +1,272 @@
+## Prompt registry: templates with a cacheable static prefix, local token counts and budgets
+import hashlib
+import re
+import textwrap
+import threading
+from collections import OrderedDict
+
+from config import PROMPT_TOKEN_BUDGETS
+
+
+# Words count one token per 6 letters, digits one per 3, other symbols one each
+_TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_")
+
+# Distinct schemas (the full one and pruned subsets) whose prefix is kept
+PREFIX_CACHE_SIZE = 64
+
+
+class PromptBudgetExceeded(ValueError):
+    """Raised when a prompt is over its token budget even without its
+    optional sections."""
+
+
+def count_tokens(text):
+    """Local estimate of the number of tokens in `text`, no tokenizer needed."""
+    return sum(
+        1 + (len(token) - 1) // 6 if token[0].isalpha() else 1
+        for token in _TOKEN_PATTERN.findall(text or "")
+    )
+
+
+class Prompt:
+    """A rendered prompt. `text` starts with `prefix`, which is the same for
+    every call with the same template and schema; `prefix_hash` identifies it."""
+
+    def __init__(self, template, text, prefix_hash, prefix_tokens, tokens, dropped):
+        self.template = template
+        self.text = text
+        self.prefix_hash = prefix_hash
+        self.prefix_tokens = prefix_tokens
+        self.tokens = tokens
+        self.dropped = dropped
+
+    def __str__(self):
+        return self.text
+
+
+class PromptTemplate:
+    """A prompt in two parts.
+
+    The prefix is the static instructions followed by the database schema.
+    It is built, hashed and counted once per schema, so every call with the
+    same schema starts with byte-identical text that providers and proxies
+    can cache. The per-call `sections` follow, each given as (name, heading,
+    optional) and ordered from the most to the least stable, and the prompt
+    ends with `cue`.
+
+    When the prompt is over `budget` tokens, optional sections are left out
+    in order; if it still is, PromptBudgetExceeded is raised before anything
+    is sent.
+    """
+
+    def __init__(self, name, instructions, sections, budget, cue=""):
+        self.name = name
+        self.instructions = textwrap.dedent(instructions).strip()
+        self.sections = sections
+        self.budget = PROMPT_TOKEN_BUDGETS.get(name, budget)
+        self.cue = cue
+        self._prefixes = OrderedDict()  # schema -> (text, hash, tokens)
+        self._lock = threading.Lock()
+
+    def prefix(self, schema):
+        """(text, hash, tokens) of the prefix for `schema`, computed once."""
+        with self._lock:
+            cached = self._prefixes.get(schema)
+            if cached is not None:
+                self._prefixes.move_to_end(schema)
+                return cached
+        text = f"{self.instructions}\n\nDatabase Schema:\n{schema.strip()}\n\n"
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+        cached = (text, digest, count_tokens(text))
+        with self._lock:
+            self._prefixes[schema] = cached
+            while len(self._prefixes) > PREFIX_CACHE_SIZE:
+                self._prefixes.popitem(last=False)
+        return cached
+
+    def render(self, schema, **values):
+        prefix, prefix_hash, prefix_tokens = self.prefix(schema)
+        parts = []
+        for name, heading, optional in self.sections:
+            value = values.get(name)
+            if value is None or not str(value).strip():
+                continue  # e.g. no user instructions
+            text = f"{heading}\n{str(value).strip()}"
+            parts.append([name, text, optional, count_tokens(text)])
+        tokens = prefix_tokens + sum(part[3] for part in parts) + count_tokens(self.cue)
+
+        dropped = []
+        for part in parts:
+            if tokens <= self.budget:
+                break
+            if part[2]:
+                dropped.append(part[0])
+                tokens -= part[3]
+        if tokens > self.budget:
+            raise PromptBudgetExceeded(
+                f"{self.name} prompt has {tokens} tokens, over its budget of "
+                f"{self.budget}"
+            )
+
+        body = "\n\n".join(part[1] for part in parts if part[0] not in dropped)
+        text = prefix + body + (f"\n\n{self.cue}" if self.cue else "")
+        return Prompt(self.name, text, prefix_hash, prefix_tokens, tokens, dropped)
+
+
+PROMPTS = {}
+
+
+def register(template):
+    PROMPTS[template.name] = template
+    return template
+
+
+def render_prompt(name, schema, **values):
+    """Renders the registered template `name` for `schema`."""
+    return PROMPTS[name].render(schema, **values)
+
+
+register(
+    PromptTemplate(
+        "sql_generator",
+        """
+        Properly use the Database Schema to properly use the table names and column names for respective tables.
+        Answer Repeating the question and evidence, and generating the SQL with a query plan.
+        Only return the SQL query without ``` backticks, no other text.
+        Ensure the table alias is correctly assigned
+        """,
+        [
+            ("examples", "<---(Example)--->", True),
+            ("values", "Values of the question in the database (use them as stored):", True),
+            ("question", "---------------------------------\nQuestion:", False),
+        ],
+        budget=4000,
+        cue="SQL Query:",
+    )
+)
+
+register(
+    PromptTemplate(
+        "sql_validator",
+        """
+        The following SQL query might have syntax issues. Your task is to analyze it and correct any mistakes
+        so that it works properly in **PostgreSQL**.
+        Properly use the Database Schema to generate the SQL query.
+
+        Return only the corrected SQL query without any explanations or ``` backticks.
+
+        Make sure to use "ILIKE" instead of "=" for case insensitive matching. If not asked to be case sensitive
+        Only while using "ILIKE" make sure to use "::TEXT" to avoid type mismatch errors.
+        Don't use "::TEXT" while using "=" or anyother time
+        """,
+        [("sql_query", "Incorrect SQL:", False)],
+        budget=3000,
+        cue="Corrected SQL Query:",
+    )
+)
+
+register(
+    PromptTemplate(
+        "sql_repair",
+        """
+        The following SQL query failed in **PostgreSQL**. Fix only what causes the error
+        and keep the rest of the query unchanged.
+
+        Return only the corrected SQL query without any explanations or ``` backticks.
+        """,
+        [("sql_query", "Failing SQL:", False), ("error", "Error:", False)],
+        budget=3000,
+        cue="Corrected SQL Query:",
+    )
+)
+
+register(
+    PromptTemplate(
+        "query_validator",
+        """
+        "JUST OUTPUT THE Python DICTIONARY of texts of natural language query"
+        You are a helpful assistant that validates natural language queries for a Database.
+        Your task is to analyze the query for ambiguity, incompleteness, or incorrectness and improve it if needed.
+        You are also allowed to use the database schema to improve the query.
+
+        If the query is clear and complete, return it unchanged.
+        If the query needs improvement, provide the improved version and explain why.
+        Make sure to return the corrected input, the improved query and the feedback.
+        Make sure to not alter the original query too much, if there is no typo or discrepancy with database schema.
+
+        In the following Format - For example:
+        original_query: show moveis with actr smith
+        corrected_input: show movies with actor smith
+        feedback: Fixed typos in 'movies' and 'actor', added specificity about searching by last name
+
+        original_query: show all movies with rating R
+        corrected_input: show all movies with rating R
+        feedback: Query is clear and well-formed, minor rewording for consistency
+
+        original_query: list customer payments
+        corrected_input: list customer payments
+        feedback: Query is clear and grammatically correct
+
+        Output Format (make sure say why we changed what, if changed):
+        ```python
+        {
+            original_query: show moveis with actr smith
+            corrected_input: show movies with actor smith
+            feedback: Fixed typos in 'movies' and 'actor'
+        }
+        ```
+        """,
+        [
+            ("user_instructions", "User Instructions:", False),
+            ("question", "Natural Language Query:", False),
+        ],
+        budget=3000,
+    )
+)
+
+register(
+    PromptTemplate(
+        "judge",
+        """
+        Check if the SQL query below correctly implements the given natural language request,
+        using the provided Database Schema.
+
+        Provide a response indicating if it is logically correct, with reasoning.
+        The scoring breakdown could be as follows:
+        100 for fully correct queries.
+        50 for queries that are logically correct but have minor errors.
+        0 for queries that are incorrect or produce the wrong results
+
+        The response should be in the following format:
+        Score: 100
+        Reasoning: The query is fully correct.
+        Score: 50
+        Reasoning: The query is logically correct but has minor errors. (with proper reasoning and improvements)
+        Score: 0
+        Reasoning: The query is incorrect or produces the wrong results. (with proper reasoning and improvements)
+        """,
+        [("nl_query", "NL Query:", False), ("sql_query", "SQL Query:", False)],
+        budget=3000,
+    )
+)
+
+register(
+    PromptTemplate(
+        "batch_judge",
+        """
+        Check if each SQL query below correctly implements its natural language request,
+        using the provided Database Schema. Judge every item on its own.
+
+        The scoring breakdown could be as follows:
+        100 for fully correct queries.
+        50 for queries that are logically correct but have minor errors.
+        0 for queries that are incorrect or produce the wrong results
+
+        Return only a JSON array with one object per item, in item order, without ``` backticks:
+        [{"id": 1, "score": 100, "reasoning": "The query is fully correct."},
+         {"id": 2, "score": 0, "reasoning": "It counts rentals instead of summing payments."}]
+        """,
+        [("items", "Items:", False)],
+        budget=12000,
+    )
+)
@@ -0,0 +1,183 @@
+## Execution guard for generated SQL: timeouts, cost ceiling and row limits
+import copy
+import json
+
+from config import (
+    QUERY_COST_LIMIT,
+    INTERACTIVE_ROW_LIMIT,
+    INTERACTIVE_STATEMENT_TIMEOUT_MS,
+)
+from query_result import QueryResult
+from result_cache import sql_tokens
+from setup_db import execute_query, execute_query_uncached, fetch_page, is_pageable
+from tracing import span, set_attributes, record_query
+
+
+# SQLSTATE program_limit_exceeded, used when a query is refused
+REFUSED_ERROR_CODE = "54000"
+
+AGGREGATE_FUNCTIONS = {
+    "count", "sum", "avg", "min", "max", "array_agg", "string_agg",
+    "json_agg", "jsonb_agg", "bool_and", "bool_or", "every",
+}
+
+
+def _top_level_tokens(sql):
+    """Tokens outside any parentheses, i.e. of the outermost SELECT (CTE and
+    subquery bodies are skipped)."""
+    depth = 0
+    tokens = []
+    for token in sql_tokens(sql):
+        if token == "(":
+            if depth == 0:
+                tokens.append(token)
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            tokens.append(token)
+    return tokens
+
+
+def needs_limit(sql):
+    """True for a row-returning query without LIMIT whose outer SELECT does
+    not aggregate, i.e. one that may return a whole table."""
+    tokens = _top_level_tokens(sql)
+    if "limit" in tokens or "fetch" in tokens or "group" in tokens:
+        return False
+    return not any(
+        token in AGGREGATE_FUNCTIONS and following == "("
+        for token, following in zip(tokens, tokens[1:])
+    )
+
+
+def add_limit(sql, limit):
+    # The newline keeps a trailing -- comment from swallowing the LIMIT
+    return f"{sql.strip().rstrip(';')}\nLIMIT {int(limit)}"
+
+
+def plan_cost(sql):
+    """Returns (estimated total cost, None), or (None, error result) when the
+    query does not plan."""
+    result = execute_query_uncached(f"EXPLAIN (FORMAT JSON) {sql.strip().rstrip(';')}")
+    if not result.ok:
+        return None, result
+    plan = result.data[0][0]
+    if isinstance(plan, str):  # psql returns the JSON as text
+        plan = json.loads(plan)
+    return float(plan[0]["Plan"]["Total Cost"]), None
+
+
+def _with_notices(result, notices):
+    # Results may be shared with the result cache, so annotate a copy
+    result = copy.copy(result)
+    result.notices = list(notices)
+    return result
+
+
+def execute_guarded(
+    sql,
+    interactive=False,
+    page_size=None,
+    after=None,
+    cost_limit=QUERY_COST_LIMIT,
+    row_limit=INTERACTIVE_ROW_LIMIT,
+    timeout_ms=None,
+):
+    """Runs generated SQL behind the execution guard.
+
+    - In interactive mode, a query that may return a whole table gets a
+      LIMIT of `row_limit` rows and the interactive statement timeout.
+    - Read-only queries are planned first with EXPLAIN; one whose estimated
+      cost is above `cost_limit` is rewritten with a LIMIT when that brings
+      the cost under the limit, and refused otherwise.
+    - Every query runs under a statement_timeout (STATEMENT_TIMEOUT_MS unless
+      `timeout_ms` is given).
+
+    With `page_size`, only one page is fetched: the first, or the one
+    following the page whose `next_key` is `after`. Following pages come
+    from the cursor the first page opened, which already went through the
+    guard, so they are not planned again. The decisions taken are listed
+    in the returned result's `notices`.
+    """
+    with span("execute_guarded", interactive=interactive):
+        result = _execute_guarded(
+            sql, interactive, page_size, after, cost_limit, row_limit, timeout_ms
+        )
+        record_query(sql, result)
+        if result.notices:
+            set_attributes(guard_notices=result.notices)
+        return result
+
+
+def _execute_guarded(
+    sql, interactive, page_size, after, cost_limit, row_limit, timeout_ms
+):
+    if page_size and after is not None:
+        result = fetch_page(sql, page_size, after)
+        if result.truncated:
+            return _with_notices(
+                result, [f"Result truncated to the first {row_limit} rows"]
+            )
+        return result
+
+    notices = []
+    if timeout_ms is None and interactive:
+        timeout_ms = INTERACTIVE_STATEMENT_TIMEOUT_MS
+    limited = False
+    if is_pageable(sql):
+        if interactive and needs_limit(sql):
+            # One extra row tells whether the result was cut off
+            sql = add_limit(sql, row_limit + 1)
+            limited = True
+        if cost_limit:
+            cost, error = plan_cost(sql)
+            if error is not None:
+                return error
+            if cost > cost_limit and not limited and needs_limit(sql):
+                limited_sql = add_limit(sql, row_limit + 1)
+                limited_cost, error = plan_cost(limited_sql)
+                if error is None and limited_cost <= cost_limit:
+                    notices.append(
+                        f"Estimated cost {cost:.0f} is above the limit of "
+                        f"{cost_limit:.0f}, added LIMIT {row_limit}"
+                    )
+                    sql, cost, limited = limited_sql, limited_cost, True
+            set_attributes(estimated_cost=cost)
+            if cost > cost_limit:
+                print(f"Refused query with estimated cost {cost:.0f}")
+                return QueryResult.from_error(
+                    f"ERROR:  query refused: estimated cost {cost:.0f} exceeds "
+                    f"the limit of {cost_limit:.0f}\nHINT:  Filter or aggregate "
+                    "the rows instead of joining or returning whole tables.",
+                    REFUSED_ERROR_CODE,
+                )
+
+    if page_size:
+        # The page stops before the extra row of the LIMIT
+        result = fetch_page(
+            sql,
+            page_size,
+            timeout_ms=timeout_ms,
+            row_limit=row_limit if limited else None,
+        )
+    else:
+        result = execute_query(sql, timeout_ms=timeout_ms)
+    if not result.ok or not limited:
+        return _with_notices(result, notices) if notices else result
+
+    if result.truncated:
+        notices.append(f"Result truncated to the first {row_limit} rows")
+        return _with_notices(result, notices)
+    if result.row_count > row_limit:
+        truncated = QueryResult(
+            result.columns,
+            result.types,
+            [column[:row_limit] for column in result.data],
+            status=result.status,
+        )
+        notices.append(f"Result truncated to the first {row_limit} rows")
+        return _with_notices(truncated, notices)
+    if interactive and not notices:
+        notices.append(f"Added LIMIT {row_limit} (interactive mode)")
+    return _with_notices(result, notices)
@@ -0,0 +1,123 @@
+## Typed, columnar result of a SQL statement
+from decimal import Decimal
+
+
+class QueryResult:
+    """Result of running one SQL statement.
+
+    Data is stored column-wise: ``data[i]`` holds every value of ``columns[i]``,
+    whose PostgreSQL type name is ``types[i]``. Failures are reported through
+    ``error`` / ``error_code`` (the SQLSTATE) instead of being mixed into the
+    data, so callers check ``ok`` rather than scanning text for "ERROR".
+    """
+
+    def __init__(
+        self, columns=None, types=None, data=None, status="", error=None, error_code=None
+    ):
+        self.columns = list(columns or [])
+        self.types = list(types or ["text"] * len(self.columns))
+        self.data = data if data is not None else [[] for _ in self.columns]
+        self.status = status
+        self.error = error
+        self.error_code = error_code
+        # Set on paged results: whether more rows follow, the key to pass to
+        # fetch_page for the next page, the rows of the earlier pages, and
+        # whether the rows stop at a row limit rather than at the end
+        self.has_more = False
+        self.next_key = None
+        self.offset = 0
+        self.truncated = False
+        # Decisions the execution guard took for this query (see query_guard.py)
+        self.notices = []
+
+    @classmethod
+    def from_rows(cls, columns, types, rows, status=""):
+        """Builds a result from row tuples as returned by a DB-API cursor."""
+        data = [list(column) for column in zip(*rows)] if rows else None
+        return cls(columns, types, data, status=status)
+
+    @classmethod
+    def from_error(cls, message, error_code=None):
+        return cls(error=message.strip(), error_code=error_code)
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def row_count(self):
+        return len(self.data[0]) if self.data else 0
+
+    def rows(self):
+        """Iterates over the result row by row."""
+        return zip(*self.data)
+
+    def to_dataframe(self):
+        """Converts to a pandas DataFrame, reusing the column lists as-is."""
+        import pandas as pd
+
+        df = pd.DataFrame(dict(enumerate(self.data)), copy=False)
+        df.columns = self.columns
+        return df
+
+    def preview(self, limit=10):
+        """Short psql-style rendering used for logging."""
+        if not self.ok:
+            return self.error
+        if not self.columns:
+            return self.status
+        rows = list(zip(*(column[:limit] for column in self.data)))
+        return format_psql_table(self.columns, rows, total=self.row_count)
+
+    def __str__(self):
+        if not self.ok:
+            return self.error
+        if not self.columns:
+            return self.status
+        return format_psql_table(self.columns, list(self.rows()))
+
+    def __repr__(self):
+        if not self.ok:
+            return f"QueryResult(error={self.error!r})"
+        return f"QueryResult(columns={self.columns!r}, rows={self.row_count})"
+
+
+def _format_cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value)
+
+
+def format_psql_table(columns, rows, total=None):
+    """Renders rows the way `psql` prints them in its default aligned format."""
+    total = len(rows) if total is None else total
+    cells = [[_format_cell(value) for value in row] for row in rows]
+    numeric = [
+        bool(rows)
+        and all(
+            isinstance(row[i], (int, float, Decimal)) and not isinstance(row[i], bool)
+            for row in rows
+            if row[i] is not None
+        )
+        for i in range(len(columns))
+    ]
+    widths = [
+        max([len(name)] + [len(row[i]) for row in cells])
+        for i, name in enumerate(columns)
+    ]
+
+    lines = ["|".join(f" {name.center(widths[i])} " for i, name in enumerate(columns))]
+    lines.append("+".join("-" * (width + 2) for width in widths))
+    for row in cells:
+        lines.append(
+            "|".join(
+                f" {value.rjust(widths[i]) if numeric[i] else value.ljust(widths[i])} "
+                for i, value in enumerate(row)
+            )
+        )
+    if total > len(rows):
+        lines.append("...")
+    lines.append(f"({total} row{'' if total == 1 else 's'})")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,261 @@
+## Cache of query results keyed on canonicalized SQL
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from config import RESULT_CACHE_MAX_BYTES, RESULT_CACHE_VERSION_INTERVAL
+
+
+# Per-table modification counters; partitions (payment_p2022_01, ...) are
+# folded into their parent table so "payment" changes when any partition does
+TABLE_VERSIONS_QUERY = """SELECT COALESCE(parent.relname, c.relname) AS table_name,
+    SUM(s.n_tup_ins + s.n_tup_upd + s.n_tup_del) AS version
+FROM pg_stat_user_tables s
+JOIN pg_class c ON c.oid = s.relid
+LEFT JOIN pg_inherits i ON i.inhrelid = c.oid
+LEFT JOIN pg_class parent ON parent.oid = i.inhparent
+GROUP BY 1"""
+
+# Tables (and views) each view of the public schema reads, from the
+# dependencies of its rewrite rule
+VIEW_TABLES_QUERY = """SELECT DISTINCT v.relname AS view_name, t.relname AS table_name
+FROM pg_depend d
+JOIN pg_rewrite r ON r.oid = d.objid
+JOIN pg_class v ON v.oid = r.ev_class
+JOIN pg_class t ON t.oid = d.refobjid
+WHERE v.relnamespace = 'public'::regnamespace AND v.relkind IN ('v', 'm')
+    AND t.relkind IN ('r', 'p', 'v', 'm') AND t.oid <> v.oid"""
+
+_TOKEN_RE = re.compile(
+    r"""('(?:[^']|'')*')|("(?:[^"]|"")*")|(--[^\n]*)|(/\*.*?\*/)|(\s+)|(\w+|.)""",
+    re.DOTALL,
+)
+_WRITE_KEYWORDS = {
+    "insert", "update", "delete", "merge", "truncate",
+    "create", "alter", "drop", "grant", "revoke", "copy", "vacuum", "refresh",
+}
+# Functions whose result changes from one call to the next, so queries using
+# them are never cached
+_VOLATILE_WORDS = {
+    "now", "current_date", "current_time", "current_timestamp", "localtime",
+    "localtimestamp", "clock_timestamp", "statement_timestamp",
+    "transaction_timestamp", "timeofday", "random", "gen_random_uuid",
+    "nextval", "currval", "setval", "lastval", "txid_current",
+}
+
+
+def sql_tokens(sql):
+    """Yields SQL tokens with comments and whitespace removed."""
+    for literal, identifier, _, _, _, other in _TOKEN_RE.findall(sql):
+        if literal:
+            yield literal
+        elif identifier:
+            yield identifier
+        elif other:
+            yield other.lower()
+
+
+def canonicalize_sql(sql):
+    """Lowercases keywords and identifiers and drops comments, extra whitespace
+    and trailing semicolons. String literals and quoted identifiers are kept
+    as-is, so queries that only differ in formatting share one cache entry."""
+    tokens = list(sql_tokens(sql))
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    canonical = []
+    for token in tokens:
+        # Only word tokens need a separating space to stay distinct
+        if canonical and (token[0].isalnum() or token[0] in "_'\"") and (
+            canonical[-1][-1].isalnum() or canonical[-1][-1] in "_'\""
+        ):
+            canonical.append(" ")
+        canonical.append(token)
+    return "".join(canonical)
+
+
+def is_read_only(sql):
+    words = {token for token in sql_tokens(sql) if token[0].isalpha()}
+    return words.isdisjoint(_WRITE_KEYWORDS)
+
+
+def is_volatile(sql):
+    """True when the query calls a function such as now() or random()."""
+    return not _VOLATILE_WORDS.isdisjoint(sql_tokens(sql))
+
+
+def referenced_tables(sql, known_tables):
+    words = {token.strip('"').lower() for token in sql_tokens(sql)}
+    return words & set(known_tables)
+
+
+def estimate_size(result):
+    """Rough number of bytes a QueryResult keeps alive."""
+    size = sys.getsizeof(result.data)
+    for column in result.data:
+        size += sys.getsizeof(column) + sum(sys.getsizeof(value) for value in column)
+    return size
+
+
+class ResultCache:
+    """In-memory LRU cache of QueryResults for read-only SQL.
+
+    Each entry remembers the modification counters of the tables its query
+    references, views being resolved to the tables they read through
+    ``view_source``. Counters are fetched through ``version_source`` at most
+    once every ``version_interval`` seconds, outside the lock so lookups
+    never wait on the database; an entry whose tables changed since it was
+    stored is dropped on lookup. Writes that go through the cache invalidate
+    the tables they touch immediately. Queries that read no table or call
+    volatile functions (now(), random()...) are not cached.
+    """
+
+    def __init__(
+        self,
+        version_source,
+        view_source=None,
+        max_bytes=RESULT_CACHE_MAX_BYTES,
+        version_interval=RESULT_CACHE_VERSION_INTERVAL,
+    ):
+        self.version_source = version_source
+        self.view_source = view_source
+        self.max_bytes = max_bytes
+        self.version_interval = version_interval
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._versions = None
+        self._versions_at = 0.0
+        self._views = None
+        self._lock = threading.Lock()
+
+    def _current_versions(self):
+        """(table versions, {view: tables it reads}), refreshed outside the lock."""
+        with self._lock:
+            if (
+                self._versions is not None
+                and time.monotonic() - self._versions_at <= self.version_interval
+            ):
+                return self._versions, self._views
+            views = self._views
+        versions = self.version_source()
+        if views is None and self.view_source is not None:
+            views = self.view_source()
+        with self._lock:
+            self._versions = versions
+            self._versions_at = time.monotonic()
+            self._views = views
+        return versions, views
+
+    def _base_tables(self, sql, versions, views):
+        """Tables the query reads, through any views it selects from."""
+        views = views or {}
+        pending = referenced_tables(sql, set(versions) | set(views))
+        tables, seen = set(), set()
+        while pending:
+            name = pending.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in views:
+                pending |= views[name]
+            else:
+                tables.add(name)
+        return tables
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry["size"]
+
+    def get(self, sql):
+        """Returns the cached QueryResult, or None on a miss or stale entry."""
+        key = canonicalize_sql(sql)
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+        versions, _ = self._current_versions()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if versions is None or any(
+                versions.get(table) != version
+                for table, version in entry["versions"].items()
+            ):
+                self._drop(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["result"]
+
+    def put(self, sql, result):
+        """Caches a successful read-only result, or invalidates after a write."""
+        key = canonicalize_sql(sql)
+        read_only = is_read_only(key)
+        if read_only and (not result.ok or is_volatile(key)):
+            return
+        versions, views = self._current_versions()
+        if versions is None:
+            return
+        tables = self._base_tables(key, versions, views)
+        with self._lock:
+            if not read_only:
+                self._invalidate_tables(tables)
+                # Re-read counters (and views, which the write may have
+                # changed) on the next lookup
+                self._versions = None
+                self._views = None
+                return
+            if not tables:
+                return  # nothing would ever invalidate it
+            size = estimate_size(result)
+            if size > self.max_bytes:
+                return
+            self._drop(key)
+            self._entries[key] = {
+                "result": result,
+                "versions": {table: versions.get(table) for table in tables},
+                "size": size,
+            }
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate_tables(self, tables):
+        """Drops every entry that references one of the given tables."""
+        with self._lock:
+            self._invalidate_tables(tables)
+
+    def _invalidate_tables(self, tables):
+        tables = set(tables)
+        for key in [
+            key
+            for key, entry in self._entries.items()
+            if tables.intersection(entry["versions"])
+        ]:
+            self._drop(key)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
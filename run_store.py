@@ -0,0 +1,316 @@
+## Run store: inference and evaluation runs in one compact, append-only SQLite file
+import argparse
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+
+from config import RUN_STORE_PATH, RUN_PREVIEW_ROWS
+from execution_eval import result_frame, result_hash
+from query_result import QueryResult
+
+
+# Longest preview kept per question, in characters
+PREVIEW_CHARS = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    source TEXT,
+    created_at REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    query_number INTEGER NOT NULL,
+    question TEXT,
+    difficulty TEXT,
+    sql TEXT,
+    result_hash TEXT,
+    row_count INTEGER,
+    preview TEXT,
+    error TEXT,
+    seconds REAL,
+    recorded_at REAL
+);
+CREATE INDEX IF NOT EXISTS results_by_question ON results (run_id, query_number, id);
+CREATE TABLE IF NOT EXISTS scores (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    query_number INTEGER NOT NULL,
+    judge TEXT NOT NULL,
+    score REAL,
+    match TEXT,
+    reasoning TEXT,
+    recorded_at REAL
+);
+CREATE INDEX IF NOT EXISTS scores_by_question ON scores (run_id, query_number, judge, id);
+"""
+
+# Latest result and score of each question of a run, with the column names
+# of the results CSVs
+RUN_QUERY = """SELECT r.query_number AS "Query Number",
+    r.question AS "Natural Language Query", r.difficulty AS "Difficulty",
+    r.sql AS sql_gen_query, r.result_hash, r.row_count, r.preview, r.error,
+    r.seconds, s.score, s.match, s.reasoning
+FROM results r
+LEFT JOIN scores s ON s.id = (
+    SELECT max(id) FROM scores
+    WHERE run_id = r.run_id AND query_number = r.query_number AND judge = ?
+)
+WHERE r.run_id = ? AND r.id = (
+    SELECT max(id) FROM results
+    WHERE run_id = r.run_id AND query_number = r.query_number
+)
+ORDER BY r.query_number"""
+
+_FOOTER_RE = re.compile(r"^\((\d+) rows?\)$")
+_SEPARATOR_RE = re.compile(r"^-+(\+-+)*$")
+
+
+def parse_psql_table(text):
+    """(columns, rows, total rows) of a table printed by psql or
+    QueryResult, or None when the text is not one (e.g. an error). `rows`
+    is shorter than the total when the table was cut with "..."."""
+    lines = text.strip("\n").splitlines()
+    if len(lines) < 3 or not _FOOTER_RE.match(lines[-1].strip()):
+        return None
+    separator = next(
+        (i for i, line in enumerate(lines) if _SEPARATOR_RE.match(line.strip())), None
+    )
+    if separator is None or separator == 0:
+        return None
+    columns = [name.strip() for name in lines[separator - 1].split("|")]
+    rows = [
+        tuple(value.strip() for value in line.split("|"))
+        for line in lines[separator + 1 : -1]
+        if line != "..."
+    ]
+    total = int(_FOOTER_RE.match(lines[-1].strip()).group(1))
+    return columns, rows, total
+
+
+def summarize_result(result, preview_rows=RUN_PREVIEW_ROWS):
+    """(result hash, row count, preview, error) of a QueryResult.
+
+    The hash is execution_eval's order-insensitive hash of the rows, so runs
+    can be compared without keeping their rows.
+    """
+    if result is None:
+        return None, None, None, None
+    if not result.ok:
+        return None, None, None, result.error.splitlines()[0]
+    if not result.columns:  # a statement that returns no rows
+        return None, None, result.status, None
+    preview = result.preview(preview_rows).rstrip("\n")[:PREVIEW_CHARS]
+    return result_hash(result_frame(result)), result.row_count, preview, None
+
+
+def summarize_psql_text(text, preview_rows=RUN_PREVIEW_ROWS):
+    """summarize_result for the psql text of a result, as kept by the
+    results CSVs written before the run store. Only used to import them:
+    the hash is None when the text holds only part of the rows, and text
+    values are hashed as text."""
+    if not isinstance(text, str) or not text.strip():
+        return None, None, None, None
+    table = parse_psql_table(text)
+    if table is None:
+        return None, None, None, text.strip().splitlines()[0]
+    columns, rows, total = table
+    digest = None
+    if len(rows) == total and all(len(row) == len(columns) for row in rows):
+        digest = result_hash(result_frame(QueryResult.from_rows(columns, None, rows)))
+    lines = text.strip("\n").splitlines()
+    start = next(i for i, line in enumerate(lines) if _SEPARATOR_RE.match(line.strip()))
+    preview = lines[: start + 1 + min(preview_rows, len(rows))]
+    if total > preview_rows:
+        preview.append("...")
+    preview.append(lines[-1])
+    return digest, total, "\n".join(preview)[:PREVIEW_CHARS], None
+
+
+def _value(record, key):
+    value = record.get(key)
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    return value
+
+
+class RunStore:
+    """Runs kept in one SQLite file.
+
+    Each question of a run is stored as its SQL, the hash, row count and a
+    short preview of its results (not the rows), the error and the seconds
+    it took; scores are stored apart, per judge ("llm", "execution"...).
+    Both tables are only appended to: writing a question again adds a row,
+    and reads take the latest one, so a resumed run or a new evaluation
+    never rewrites earlier records.
+    """
+
+    def __init__(self, path=RUN_STORE_PATH):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def start_run(self, run_id, source=""):
+        """Registers a run (once) and returns its id."""
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO runs VALUES (?, ?, ?)",
+                (run_id, source, time.time()),
+            )
+            self._db.commit()
+        return run_id
+
+    def has_run(self, run_id):
+        row = self._db.execute("SELECT 1 FROM runs WHERE run_id = ?", (run_id,))
+        return row.fetchone() is not None
+
+    def append_results(self, run_id, records):
+        """Appends results records (dicts with the columns written by
+        batch_eval, or with the psql "results" text of older CSVs)."""
+        rows = []
+        for record in records:
+            if "results" in record and "result_hash" not in record:
+                digest, row_count, preview, error = summarize_psql_text(
+                    _value(record, "results")
+                )
+            else:
+                digest, row_count, preview, error = (
+                    _value(record, "result_hash"),
+                    _value(record, "row_count"),
+                    _value(record, "preview"),
+                    None,
+                )
+            row_count = None if row_count is None else int(row_count)
+            rows.append(
+                (
+                    run_id,
+                    int(record["Query Number"]),
+                    _value(record, "Natural Language Query"),
+                    _value(record, "Difficulty"),
+                    _value(record, "sql_gen_query"),
+                    digest,
+                    row_count,
+                    preview,
+                    _value(record, "error") or error,
+                    _value(record, "seconds"),
+                    time.time(),
+                )
+            )
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO results (run_id, query_number, question, difficulty, "
+                "sql, result_hash, row_count, preview, error, seconds, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def append_scores(self, run_id, df, judge):
+        """Appends the "score" (and "match", "reasoning") of the scored rows
+        of a DataFrame."""
+        scored = df[df["score"].notna()]
+        rows = [
+            (
+                run_id,
+                int(record["Query Number"]),
+                judge,
+                float(record["score"]),
+                _value(record, "match"),
+                _value(record, "reasoning"),
+                time.time(),
+            )
+            for record in scored.to_dict("records")
+        ]
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO scores (run_id, query_number, judge, score, match, "
+                "reasoning, recorded_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+
+    def load_run(self, run_id, judge="llm"):
+        """DataFrame of the latest record of each question of the run, with
+        the latest score of `judge`."""
+        return pd.read_sql_query(RUN_QUERY, self._db, params=(judge, run_id))
+
+    def runs(self):
+        """DataFrame of the runs, with their question, failure and score counts."""
+        return pd.read_sql_query(
+            """SELECT runs.run_id, runs.source,
+                datetime(runs.created_at, 'unixepoch') AS created_at,
+                (SELECT count(DISTINCT query_number) FROM results
+                 WHERE run_id = runs.run_id) AS questions,
+                (SELECT count(DISTINCT query_number) FROM scores
+                 WHERE run_id = runs.run_id) AS scored
+            FROM runs ORDER BY runs.created_at""",
+            self._db,
+        )
+
+    def close(self):
+        self._db.close()
+
+
+def import_csv(store, path, run_id=None, judge="llm"):
+    """Imports an inference or evaluation results CSV (or a batch_eval
+    .jsonl checkpoint) as a run named after the file by default, with its
+    scores if it has any. A run that already exists is left as it is.
+    Returns the run id."""
+    from batch_eval import load_results, read_eval_dataset
+
+    run_id = run_id or os.path.splitext(os.path.basename(path))[0]
+    if store.has_run(run_id):
+        print(f"{run_id} is already in the store, skipping {path}")
+        return run_id
+    if path.lower().endswith(".jsonl"):
+        df = load_results(path)
+    else:
+        df = read_eval_dataset(path)
+    store.start_run(run_id, source=path)
+    store.append_results(run_id, df.to_dict("records"))
+    if "score" in df.columns:
+        store.append_scores(run_id, df, judge)
+    print(f"Imported {len(df)} questions of {path} as {run_id}")
+    return run_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inference and evaluation runs")
+    parser.add_argument("--store", default=RUN_STORE_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser("import", help="import results CSVs as runs")
+    importer.add_argument("paths", nargs="+")
+    commands.add_parser("list", help="list the runs")
+    show = commands.add_parser("show", help="print the questions of a run")
+    show.add_argument("run_id")
+    show.add_argument("--judge", default="llm")
+    args = parser.parse_args()
+
+    store = RunStore(args.store)
+    if args.command == "import":
+        before = sum(os.path.getsize(path) for path in args.paths)
+        for path in args.paths:
+            import_csv(store, path)
+        store.close()
+        size = os.path.getsize(args.store)
+        print(f"{before / 1e6:.2f} MB of CSV, store is {size / 1e6:.2f} MB")
+    elif args.command == "list":
+        print(store.runs().to_string(index=False))
+    else:
+        start = time.perf_counter()
+        df = store.load_run(args.run_id, args.judge)
+        elapsed = time.perf_counter() - start
+        columns = ["Query Number", "row_count", "result_hash", "score", "error"]
+        print(df[columns].to_string(index=False))
+        print(f"\nLoaded {len(df)} questions in {elapsed * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
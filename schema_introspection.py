@@ -0,0 +1,271 @@
+## Schema read from the Pagila catalog, cached on disk under a catalog fingerprint
+import json
+import os
+import threading
+import time
+
+from config import (
+    DATABASE_SCHEMA,
+    SCHEMA_INTROSPECTION,
+    SCHEMA_CACHE_PATH,
+    SCHEMA_LOW_CARDINALITY,
+)
+
+
+# Bump when the cached structure or the queries change, to rebuild old caches
+CACHE_FORMAT_VERSION = "1"
+
+# Changes whenever a table, column, key or enum of the public schema changes,
+# but not when rows do; one cheap query over pg_catalog
+FINGERPRINT_QUERY = """SELECT md5(string_agg(item, ',' ORDER BY item)) FROM (
+    SELECT format('%s.%s %s %s', c.relname, a.attname, format_type(a.atttypid, a.atttypmod), a.attnotnull) AS item
+    FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid
+    WHERE c.relnamespace = 'public'::regnamespace AND c.relkind IN ('r', 'p')
+        AND a.attnum > 0 AND NOT a.attisdropped
+    UNION ALL
+    SELECT format('%s %s', conrelid::regclass, pg_get_constraintdef(oid))
+    FROM pg_constraint
+    WHERE connamespace = 'public'::regnamespace AND contype IN ('p', 'f')
+    UNION ALL
+    SELECT format('%s %s', enumtypid::regtype, enumlabel) FROM pg_enum
+) items"""
+
+# Every query returns its rows as one JSON array, so the pool and the psql
+# fallback (which returns text only) parse the same way
+COLUMNS_QUERY = """SELECT json_agg(t ORDER BY t.table_name, t.position)::text FROM (
+    SELECT c.table_name, c.column_name, c.ordinal_position AS position,
+        format_type(a.atttypid, a.atttypmod) AS type, c.data_type
+    FROM information_schema.columns c
+    JOIN pg_class r ON r.relname = c.table_name
+        AND r.relnamespace = 'public'::regnamespace
+    JOIN pg_attribute a ON a.attrelid = r.oid AND a.attname = c.column_name
+    WHERE c.table_schema = 'public' AND r.relkind IN ('r', 'p')
+        AND NOT r.relispartition
+) t"""
+
+KEYS_QUERY = """SELECT json_agg(t)::text FROM (
+    SELECT con.conrelid::regclass::text AS table_name, con.contype AS kind,
+        a.attname AS column_name, con.confrelid::regclass::text AS ref_table,
+        ra.attname AS ref_column
+    FROM pg_constraint con
+    CROSS JOIN LATERAL unnest(con.conkey, con.confkey) WITH ORDINALITY
+        AS k(attnum, ref_attnum, position)
+    JOIN pg_attribute a ON a.attrelid = con.conrelid AND a.attnum = k.attnum
+    LEFT JOIN pg_attribute ra ON ra.attrelid = con.confrelid AND ra.attnum = k.ref_attnum
+    WHERE con.connamespace = 'public'::regnamespace AND con.contype IN ('p', 'f')
+    ORDER BY 1, con.conname, k.position
+) t"""
+
+ENUMS_QUERY = """SELECT json_object_agg(type_name, labels)::text FROM (
+    SELECT enumtypid::regtype::text AS type_name,
+        json_agg(enumlabel ORDER BY enumsortorder) AS labels
+    FROM pg_enum GROUP BY enumtypid
+) t"""
+
+# reltuples is the planner's estimate (-1 before the first ANALYZE, and
+# always for partitioned tables, which are counted instead)
+ROW_COUNTS_QUERY = """SELECT json_object_agg(relname, reltuples::bigint)::text
+FROM pg_class
+WHERE relnamespace = 'public'::regnamespace AND relkind IN ('r', 'p')
+    AND NOT relispartition"""
+
+# Most common values of the columns ANALYZE found few distinct values in
+COLUMN_VALUES_QUERY = """SELECT json_agg(t)::text FROM (
+    SELECT DISTINCT ON (tablename, attname) tablename AS table_name,
+        attname AS column_name, n_distinct,
+        most_common_vals::text::text[] AS values
+    FROM pg_stats
+    WHERE schemaname = 'public' AND most_common_vals IS NOT NULL
+    ORDER BY tablename, attname, inherited DESC
+) t"""
+
+TEXT_TYPES = {"text", "character varying", "character"}
+# Longer values are not worth listing in the prompt
+MAX_VALUE_LENGTH = 40
+
+
+def _query_value(query):
+    from setup_db import execute_query_uncached
+
+    result = execute_query_uncached(query)
+    if not result.ok:
+        raise RuntimeError(result.error)
+    return result.data[0][0] if result.row_count else None
+
+
+def _query_json(query, default):
+    value = _query_value(query)
+    return json.loads(value) if value else default
+
+
+def catalog_fingerprint():
+    """Fingerprint of the public schema's tables, columns, keys and enums."""
+    return f"{CACHE_FORMAT_VERSION}:{_query_value(FINGERPRINT_QUERY)}"
+
+
+def introspect():
+    """Reads the public schema from the catalog, with row counts, enum labels
+    and the values of low-cardinality text columns."""
+    from setup_db import execute_query_uncached
+
+    columns = _query_json(COLUMNS_QUERY, [])
+    keys = _query_json(KEYS_QUERY, [])
+    enums = _query_json(ENUMS_QUERY, {})
+    row_counts = _query_json(ROW_COUNTS_QUERY, {})
+    statistics = _query_json(COLUMN_VALUES_QUERY, [])
+
+    tables = {}
+    for column in columns:
+        tables.setdefault(column["table_name"], {"rows": None, "columns": []})
+        tables[column["table_name"]]["columns"].append(
+            {
+                "name": column["column_name"],
+                "type": column["type"],
+                "pk": False,
+                "values": enums.get(column["type"]),
+                "text": column["data_type"] in TEXT_TYPES,
+            }
+        )
+
+    refs = []
+    for key in keys:
+        table = tables.get(key["table_name"])
+        if table is None:
+            continue  # partitions repeat their parent's keys
+        if key["kind"] == "p":
+            for column in table["columns"]:
+                if column["name"] == key["column_name"]:
+                    column["pk"] = True
+        elif key["ref_table"] in tables:
+            refs.append(
+                [key["table_name"], key["column_name"], key["ref_table"], key["ref_column"]]
+            )
+
+    for name, table in tables.items():
+        rows = row_counts.get(name, -1)
+        if rows < 0:
+            count = execute_query_uncached(f'SELECT count(*) FROM "{name}"')
+            rows = int(count.data[0][0]) if count.ok else None
+        table["rows"] = rows
+
+    for stats in statistics:
+        table = tables.get(stats["table_name"])
+        if table is None or not table["rows"]:
+            continue
+        distinct = stats["n_distinct"]
+        if distinct < 0:  # a fraction of the rows
+            distinct = -distinct * table["rows"]
+        values = stats["values"] or []
+        for column in table["columns"]:
+            if (
+                column["name"] == stats["column_name"]
+                and column["text"]
+                and column["values"] is None
+                and round(distinct) == len(values) <= SCHEMA_LOW_CARDINALITY
+                and all(len(value) <= MAX_VALUE_LENGTH for value in values)
+            ):
+                column["values"] = sorted(values)
+
+    for table in tables.values():
+        for column in table["columns"]:
+            del column["text"]
+    return {"tables": tables, "refs": refs}
+
+
+def render_schema(schema):
+    """Renders an introspected schema in the DBML-like format of
+    DATABASE_SCHEMA, which schema_linking parses. Row counts and column
+    values are ``//`` comments."""
+    blocks = []
+    for name in sorted(schema["tables"]):
+        table = schema["tables"][name]
+        lines = []
+        if table["rows"] is not None:
+            lines.append(f"  // {table['rows']} rows")
+        for column in table["columns"]:
+            line = f"  {column['name']} {column['type']}"
+            if column["pk"]:
+                line += " [pk]"
+            if column["values"]:
+                # Braces would end the table block for the schema parser
+                values = ", ".join(
+                    value.replace("{", "(").replace("}", ")")
+                    for value in column["values"]
+                )
+                line += f"  // ({values})"
+            lines.append(line)
+        blocks.append(f"Table {name} {{\n" + "\n".join(lines) + "\n}")
+    refs = [
+        f"Ref: {table}.{column} > {ref_table}.{ref_column}"
+        for table, column, ref_table, ref_column in sorted(schema["refs"])
+    ]
+    text = "-- Tables\n" + "\n\n".join(blocks)
+    if refs:
+        text += "\n\n-- Key Relationships\n" + "\n".join(refs)
+    return text
+
+
+def load_schema(path=SCHEMA_CACHE_PATH, refresh=False):
+    """Returns the schema text, introspecting only when the catalog changed.
+
+    The catalog fingerprint is compared with the one stored in `path`; on a
+    match the cached schema is used as is. When the database cannot be
+    reached, a cached schema is used even if it may be stale, and without
+    one the hand-written DATABASE_SCHEMA.
+    """
+    cached = None
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            cached = json.load(f)
+
+    try:
+        fingerprint = catalog_fingerprint()
+    except Exception as e:
+        source = "cached" if cached else "hand-written"
+        print(f"Schema introspection unavailable ({e}), using the {source} schema")
+        return render_schema(cached["schema"]) if cached else DATABASE_SCHEMA
+
+    if cached and cached["fingerprint"] == fingerprint and not refresh:
+        return render_schema(cached["schema"])
+
+    start = time.perf_counter()
+    schema = introspect()
+    print(
+        f"Introspected {len(schema['tables'])} tables in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "fingerprint": fingerprint,
+                    "introspected_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "schema": schema,
+                },
+                f,
+                indent=1,
+            )
+    return render_schema(schema)
+
+
+_database_schema = None
+_database_schema_lock = threading.Lock()
+
+
+def get_database_schema():
+    """Schema text for the prompts: introspected (see load_schema) when
+    SCHEMA_INTROSPECTION is on, the hand-written DATABASE_SCHEMA otherwise.
+    Loaded once per process."""
+    global _database_schema
+    if not SCHEMA_INTROSPECTION:
+        return DATABASE_SCHEMA
+    with _database_schema_lock:
+        if _database_schema is None:
+            _database_schema = load_schema()
+        return _database_schema
+
+
+if __name__ == "__main__":
+    import sys
+
+    print(load_schema(refresh="--refresh" in sys.argv))
@@ -0,0 +1,253 @@
+## Schema linking: prune the schema to the tables a question needs
+import math
+import re
+from collections import deque
+from functools import lru_cache
+
+from schema_introspection import get_database_schema
+
+
+# Question words that refer to a table or column under a different name
+SYNONYMS = {
+    "movie": "film",
+    "rent": "rental",
+    "rented": "rental",
+    "renting": "rental",
+    "borrow": "rental",
+    "borrowed": "rental",
+    "spent": "payment",
+    "spend": "payment",
+    "paid": "payment",
+    "pay": "payment",
+    "revenue": "payment",
+    "sale": "payment",
+    "income": "payment",
+    "genre": "category",
+    "employee": "staff",
+    "member": "staff",
+    "hired": "staff",
+    "acted": "actor",
+    "appeared": "actor",
+    "cast": "actor",
+    "stock": "inventory",
+    "copy": "inventory",
+    "registered": "create",
+    "joined": "create",
+    "released": "release",
+}
+
+# Tokens too common in the schema or the questions to say anything
+STOPWORDS = {
+    "id", "last", "update", "the", "a", "an", "of", "all", "in", "on", "for",
+    "and", "or", "with", "by", "to", "from", "show", "list", "get", "find",
+    "each", "what", "how", "many", "who", "have", "has", "their", "they",
+    "is", "are", "be", "been", "that", "which", "most", "more", "than", "me",
+}
+
+# A table is linked when the question names it (every term of the table
+# name, so "film" alone does not pull in film_actor), or mentions one of its
+# columns that is distinctive enough (idf at least LINK_THRESHOLD, so
+# "title" links film but "name" does not link every table with a name)
+LINK_THRESHOLD = 2.0
+TABLE_NAME_WEIGHT = 3.0
+
+
+def _stem(token):
+    token = token.lower()
+    if token in SYNONYMS:
+        return SYNONYMS[token]
+    if token.endswith("ies") and len(token) > 4:
+        token = token[:-3] + "y"
+    elif token.endswith("s") and not token.endswith("ss") and len(token) > 3:
+        token = token[:-1]
+    return SYNONYMS.get(token, token)
+
+
+def tokenize(text):
+    """Splits text (and snake_case identifiers) into stemmed, non-stopword terms."""
+    terms = []
+    for word in re.findall(r"[A-Za-z]+", text.replace("_", " ")):
+        term = _stem(word)
+        if term not in STOPWORDS:
+            terms.append(term)
+    return terms
+
+
+class SchemaGraph:
+    """Tables, columns and foreign keys parsed from the DBML-style schema."""
+
+    def __init__(self, schema_text):
+        self.tables = {}  # table -> list of raw column lines
+        self.columns = {}  # table -> list of column names
+        self.refs = []  # (table, column, ref_table, ref_column, raw line)
+        self.neighbours = {}
+
+        for match in re.finditer(r"Table\s+(\w+)\s*\{(.*?)\}", schema_text, re.DOTALL):
+            table, body = match.group(1), match.group(2)
+            lines = [line.rstrip() for line in body.splitlines() if line.strip()]
+            self.tables[table] = lines
+            # "//" lines are comments (e.g. introspected row counts)
+            self.columns[table] = [
+                line.split()[0] for line in lines if not line.lstrip().startswith("//")
+            ]
+            self.neighbours[table] = set()
+
+        for match in re.finditer(
+            r"^Ref:\s*(\w+)\.(\w+)\s*[<>-]\s*(\w+)\.(\w+)", schema_text, re.MULTILINE
+        ):
+            table, column, ref_table, ref_column = match.groups()
+            if table in self.tables and ref_table in self.tables:
+                self.refs.append(
+                    (table, column, ref_table, ref_column, match.group(0).strip())
+                )
+                self.neighbours[table].add(ref_table)
+                self.neighbours[ref_table].add(table)
+
+        # Lexical index: table name terms and column terms, with idf weights.
+        # Key columns (*_id) are left out, join paths take care of them.
+        self.name_terms = {table: set(tokenize(table)) for table in self.tables}
+        self.column_terms = {
+            table: {
+                term
+                for column in columns
+                if not column.endswith("_id")
+                for term in tokenize(column)
+            }
+            for table, columns in self.columns.items()
+        }
+        document_count = len(self.tables)
+        self.idf = {}
+        for terms in self.column_terms.values():
+            for term in terms:
+                self.idf[term] = self.idf.get(term, 0) + 1
+        self.idf = {
+            term: math.log(document_count / count) for term, count in self.idf.items()
+        }
+
+    def score_tables(self, question):
+        """Returns {table: score} for every table the question links to."""
+        terms = set(tokenize(question))
+        named_tables = {
+            table for table, name in self.name_terms.items() if name <= terms
+        }
+        # A word that names a table ("rental") is not also evidence for
+        # tables that merely have a column containing it (film.rental_rate)
+        column_terms = terms.difference(
+            *(self.name_terms[table] for table in named_tables)
+        )
+        scores = {}
+        for table in self.tables:
+            column_matches = [
+                self.idf[term] for term in column_terms & self.column_terms[table]
+            ]
+            named = table in named_tables
+            if not named and max(column_matches, default=0) < LINK_THRESHOLD:
+                continue
+            score = TABLE_NAME_WEIGHT * len(self.name_terms[table]) if named else 0
+            scores[table] = score + sum(column_matches)
+        return scores
+
+    def join_path(self, connected, table):
+        """Shortest FK path from any table in `connected` to `table`."""
+        previous = {start: None for start in connected}
+        queue = deque(connected)
+        while queue:
+            current = queue.popleft()
+            if current == table:
+                path = []
+                while current is not None:
+                    path.append(current)
+                    current = previous[current]
+                return path
+            for neighbour in sorted(self.neighbours[current]):
+                if neighbour not in previous:
+                    previous[neighbour] = current
+                    queue.append(neighbour)
+        return [table]
+
+    def link(self, question):
+        """Tables matching the question plus the tables needed to join them."""
+        scores = self.score_tables(question)
+        ranked = sorted(scores, key=lambda table: -scores[table])
+        if not ranked:
+            return list(self.tables)
+        selected = [ranked[0]]
+        for table in ranked[1:]:
+            for step in self.join_path(selected, table):
+                if step not in selected:
+                    selected.append(step)
+        return selected
+
+    def render(self, tables):
+        """Renders the given tables and the refs between them in schema format."""
+        tables = [table for table in self.tables if table in set(tables)]
+        blocks = [
+            "Table {} {{\n{}\n}}".format(table, "\n".join(self.tables[table]))
+            for table in tables
+        ]
+        refs = [
+            ref[4] for ref in self.refs if ref[0] in tables and ref[2] in tables
+        ]
+        text = "-- Tables\n" + "\n\n".join(blocks)
+        if refs:
+            text += "\n\n-- Key Relationships\n" + "\n".join(refs)
+        return text
+
+
+@lru_cache(maxsize=8)
+def _schema_graph(schema_text):
+    return SchemaGraph(schema_text)
+
+
+def get_schema_graph(schema_text=None):
+    """Graph of `schema_text`, by default the schema sent in the prompts
+    (see schema_introspection.get_database_schema)."""
+    return _schema_graph(
+        get_database_schema() if schema_text is None else schema_text
+    )
+
+
+def prune_schema(question, schema_text=None):
+    """Returns the part of the schema (by default the prompts' one) relevant
+    to the question."""
+    graph = get_schema_graph(schema_text)
+    return graph.render(graph.link(question))
+
+
+if __name__ == "__main__":
+    # Report prompt-size reduction, and how many of the tables used by the
+    # verified SQL in evaluation_results.csv survive pruning
+    import pandas as pd
+
+    from result_cache import referenced_tables
+
+    graph = get_schema_graph()
+    evaluated = pd.read_csv("evaluation_results.csv", encoding="ISO-8859-1")
+    verified = evaluated[evaluated["score"] == 100]
+
+    full_size = len(get_database_schema())
+    total_pruned = 0
+    needed_tables = 0
+    kept_tables = 0
+    for _, row in verified.iterrows():
+        question = row["Natural Language Query"]
+        linked = graph.link(question)
+        pruned_size = len(graph.render(linked))
+        total_pruned += pruned_size
+        needed = referenced_tables(row["sql_gen_query"], graph.tables)
+        needed_tables += len(needed)
+        kept_tables += len(needed & set(linked))
+        missing = sorted(needed - set(linked))
+        print(
+            f"#{row['Query Number']:<3} {pruned_size:>5}/{full_size} chars "
+            f"tables={','.join(linked)}" + (f" MISSING={','.join(missing)}" if missing else "")
+        )
+
+    print(
+        f"\nAverage schema size: {total_pruned / len(verified):.0f} chars "
+        f"vs {full_size} ({1 - total_pruned / (len(verified) * full_size):.0%} smaller)"
+    )
+    print(
+        f"Table recall against verified SQL: {kept_tables}/{needed_tables} "
+        f"({kept_tables / needed_tables:.0%})"
+    )
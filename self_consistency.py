@@ -0,0 +1,109 @@
+## Self-consistency: vote between SQL candidates generated and run in parallel
+import contextvars
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+
+from db_engine import CancelScope
+
+
+def _normalize(value):
+    # 3 (count), 3.0 (float) and 3.000 (numeric) count as the same value
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return round(float(value), 6)
+    return value
+
+
+def result_fingerprint(result):
+    """Hash of the result's rows as a multiset. Column names, row order and
+    number types are ignored, so candidates that only differ in aliases,
+    ORDER BY or count(*) vs sum(...) agree.
+
+    >>> from query_result import QueryResult
+    >>> counted = QueryResult.from_rows(["n"], ["int8"], [(3,), (1,)])
+    >>> summed = QueryResult.from_rows(
+    ...     ["total"], ["numeric"], [(Decimal("1"),), (Decimal("3.000"),)]
+    ... )
+    >>> result_fingerprint(counted) == result_fingerprint(summed)
+    True
+    >>> flags = QueryResult.from_rows(["n"], ["bool"], [(True,), (False,)])
+    >>> numbers = QueryResult.from_rows(["n"], ["int4"], [(1,), (0,)])
+    >>> result_fingerprint(flags) == result_fingerprint(numbers)
+    False
+    """
+    rows = sorted(
+        repr(tuple(_normalize(value) for value in row)) for row in result.rows()
+    )
+    text = f"{len(result.columns)}\n" + "\n".join(rows)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class Candidate:
+    def __init__(self, index, sql=None, result=None, error=None):
+        self.index = index
+        self.sql = sql
+        self.result = result
+        self.error = error
+
+
+def run_self_consistency(generate, execute, candidates, quorum=None):
+    """Generates and executes `candidates` SQL candidates concurrently.
+
+    `generate(i)` returns the SQL of candidate i and `execute(sql)` its
+    QueryResult. Successful results vote by fingerprint; as soon as one
+    fingerprint has `quorum` votes (a majority by default) the remaining
+    candidates are abandoned: queued ones never start and running queries
+    are cancelled in Postgres. Without a quorum, the fingerprint with the
+    most votes wins (the earliest to get them on a tie).
+
+    Returns (winning Candidate or None when every candidate failed, stats).
+    """
+    quorum = quorum or candidates // 2 + 1
+    scope = CancelScope()
+
+    def run_candidate(index):
+        sql = generate(index)
+        if scope.cancelled:
+            return Candidate(index, sql)
+        return Candidate(index, sql, execute(sql))
+
+    votes = {}  # fingerprint -> candidates in the order they finished
+    finished = []
+    winner = None
+    executor = ThreadPoolExecutor(max_workers=candidates)
+    try:
+        # Each candidate gets a copy of the caller's context, so tracing and
+        # profiling follow it into the worker thread
+        futures = [
+            executor.submit(contextvars.copy_context().run, scope.run, run_candidate, i)
+            for i in range(candidates)
+        ]
+        for future in as_completed(futures):
+            try:
+                candidate = future.result()
+            except Exception as e:
+                candidate = Candidate(None, error=f"{type(e).__name__}: {e}")
+            finished.append(candidate)
+            if candidate.result is None or not candidate.result.ok:
+                continue
+            group = votes.setdefault(result_fingerprint(candidate.result), [])
+            group.append(candidate)
+            if len(group) >= quorum:
+                winner = group[0]
+                break
+    finally:
+        scope.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if winner is None and votes:
+        winner = max(votes.values(), key=len)[0]
+    stats = {
+        "candidates": candidates,
+        "quorum": quorum,
+        "finished": len(finished),
+        "succeeded": sum(len(group) for group in votes.values()),
+        "votes": sorted((len(group) for group in votes.values()), reverse=True),
+        "quorum_reached": winner is not None
+        and len(votes[result_fingerprint(winner.result)]) >= quorum,
+    }
+    return winner, stats
@@ -1,7 +1,29 @@
 import subprocess
 import os
+import csv
+import io
 import time
+import threading
+import uuid
 import platform  # Add this import at the top
+from collections import OrderedDict
+from config import (
+    DB_BACKEND,
+    DB_READY_TIMEOUT,
+    PAGE_CURSOR_IDLE_SECONDS,
+    PAGE_CURSOR_LIMIT,
+    RESULT_CACHE_ENABLED,
+    STREAM_BATCH_SIZE,
+    STATEMENT_TIMEOUT_MS,
+)
+from db_engine import PoolTimeout, engine_override, get_engine, psycopg2
+from query_result import QueryResult
+from result_cache import (
+    ResultCache,
+    TABLE_VERSIONS_QUERY,
+    VIEW_TABLES_QUERY,
+    is_read_only,
+)
 
 
 # SQL queries
@@ -13,10 +35,42 @@ QUERIES = {
 }
 
 
+def wait_for_docker_postgres(timeout=DB_READY_TIMEOUT):
+    """Polls pg_isready inside the container until the server accepts connections."""
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    while True:
+        ready = subprocess.run(
+            # Over TCP: the server the image runs while initializing only
+            # listens on the Unix socket
+            "docker exec postgres pg_isready -h localhost -U postgres -q",
+            shell=True,
+            capture_output=True,
+        )
+        if ready.returncode == 0:
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"Postgres not ready after {timeout:.0f}s")
+        time.sleep(delay)
+        delay = min(delay * 2, 1.0)
+
+
 def setup_pagila_database():
-    """Sets up the pagila database using SQL files"""
+    """Sets up the pagila database using SQL files.
+
+    With psycopg2 installed, the bulk loader (pagila_loader.py) does it in
+    seconds; otherwise the files are piped through psql in the container.
+    """
+    if psycopg2 is not None:
+        from pagila_loader import load_pagila
+
+        try:
+            load_pagila()
+            return
+        except Exception as e:
+            print(f"Bulk load failed, falling back to psql: {e}")
     try:
-        time.sleep(3)  # Wait for the container to be ready
+        wait_for_docker_postgres()
         # Check if database exists
         check_db = subprocess.run(
             """docker exec -i postgres psql -U postgres -t -c "SELECT datname FROM pg_database WHERE datname='pagila';""",
@@ -109,29 +163,263 @@ def setup_pagila_database():
 
     except subprocess.CalledProcessError as e:
         print(f"Error setting up database: {e}")
+    except TimeoutError as e:
+        print(f"Error setting up database: {e}")
     except FileNotFoundError as e:
         print(f"SQL file not found: {e}")
     except Exception as e:
         print(f"Unexpected error: {e}")
 
 
-def execute_query(query):
+def execute_query(query, use_cache=True, timeout_ms=None):
+    """Runs a SQL query, serving repeated read-only queries from the result cache.
+
+    Queries sent to another database with db_engine.use_engine skip the
+    cache, whose entries belong to the shared database.
+    """
+    if not use_cache or result_cache is None or engine_override() is not None:
+        return execute_query_uncached(query, timeout_ms)
+    cached = result_cache.get(query)
+    if cached is not None:
+        return cached
+    result = execute_query_uncached(query, timeout_ms)
+    result_cache.put(query, result)
+    return result
+
+
+def table_versions():
+    """Returns {table: modification counter} used to invalidate cached results."""
+    result = execute_query_uncached(TABLE_VERSIONS_QUERY)
+    if not result.ok:
+        return None
+    return {table: str(version) for table, version in result.rows()}
+
+
+def view_tables():
+    """Returns {view: tables and views it reads}, to resolve cached queries
+    on views to the tables whose changes invalidate them."""
+    result = execute_query_uncached(VIEW_TABLES_QUERY)
+    if not result.ok:
+        return None
+    views = {}
+    for view, table in result.rows():
+        views.setdefault(view, set()).add(table)
+    return views
+
+
+result_cache = (
+    ResultCache(table_versions, view_tables) if RESULT_CACHE_ENABLED else None
+)
+
+
+def is_pageable(query):
+    first_word = query.strip().split(None, 1)[0].lower() if query.strip() else ""
+    return first_word in ("select", "with", "values", "table") and is_read_only(query)
+
+
+class HeldResult:
+    """Pages of a result already in memory, the docker fallback's stand-in
+    for a server-side cursor."""
+
+    def __init__(self, result):
+        self._result = result
+        self.position = 0
+
+    def fetch(self, size):
+        start, end = self.position, self.position + size
+        page = QueryResult(
+            self._result.columns,
+            self._result.types,
+            [column[start:end] for column in self._result.data],
+            status=self._result.status,
+        )
+        page.offset = start
+        page.has_more = self._result.row_count > end
+        self.position += page.row_count
+        return page
+
+    def close(self):
+        self._result = None
+
+
+# Cursors of the results being paged, by key, least recently used first,
+# with the time they were last used and their row limit
+_page_cursors = OrderedDict()
+_page_cursors_lock = threading.Lock()
+
+
+def close_page_cursor(key):
+    """Closes the cursor of a paged result, e.g. when its pages are no
+    longer shown. Unknown keys are ignored."""
+    with _page_cursors_lock:
+        entry = _page_cursors.pop(key, None)
+    if entry is not None:
+        entry[0].close()
+
+
+def _expire_page_cursors(room=0):
+    """Closes the idle cursors, and the least recently used ones until
+    `room` more fit under PAGE_CURSOR_LIMIT."""
+    now = time.monotonic()
+    with _page_cursors_lock:
+        expired = [
+            key
+            for key, (_, last_used, _) in _page_cursors.items()
+            if now - last_used > PAGE_CURSOR_IDLE_SECONDS
+        ]
+        excess = len(_page_cursors) + room - PAGE_CURSOR_LIMIT
+        expired += list(_page_cursors)[: max(excess, 0)]
+        cursors = [_page_cursors.pop(key)[0] for key in dict.fromkeys(expired)]
+    for cursor in cursors:
+        cursor.close()
+
+
+def _open_page_cursor(query, timeout_ms):
+    """(cursor, None) for a new paged result, or (None, error result)."""
+    engine = get_engine() if DB_BACKEND == "pool" or engine_override() else None
+    if engine is None:
+        result = execute_query(query, timeout_ms=timeout_ms)
+        return (HeldResult(result), None) if result.ok else (None, result)
+    try:
+        return engine.open_cursor(query, timeout_ms), None
+    except psycopg2.Error as e:
+        return None, QueryResult.from_error(e.pgerror or f"ERROR:  {e}", e.pgcode)
+    except PoolTimeout as e:
+        return None, QueryResult.from_error(f"ERROR:  {e}")
+
+
+def _cut(page, rows):
+    """The first `rows` rows of a page, as its last one."""
+    cut = QueryResult(
+        page.columns,
+        page.types,
+        [column[:rows] for column in page.data],
+        status=page.status,
+    )
+    cut.offset = page.offset
+    cut.truncated = True
+    return cut
+
+
+def fetch_page(query, page_size, after=None, timeout_ms=None, row_limit=None):
+    """Fetches the first `page_size` rows of a query or, with `after` set to
+    the previous page's `next_key`, the rows that follow that page.
+
+    The first page opens a server-side cursor that stays open between
+    pages, so every following page is a FETCH from where the last one
+    stopped: the query runs once and a deep page costs as much as the first.
+    `has_more` tells whether there is a next page, and `offset` how many
+    rows came before this one. The cursor holds a pooled connection until
+    its last page is fetched, close_page_cursor() is called, or it is left
+    idle for PAGE_CURSOR_IDLE_SECONDS; past PAGE_CURSOR_LIMIT open cursors,
+    the least recently used one is closed. The docker fallback has no
+    cursors and holds the whole result instead.
+
+    `row_limit` is for a query limited to `row_limit` + 1 rows, the extra
+    row telling whether it was cut: pages stop before that row, and the
+    last one has `truncated` set when it was there. It is kept with the
+    cursor for the following pages.
+    """
+    if after is None:
+        if not is_pageable(query):
+            return execute_query(query, timeout_ms=timeout_ms)
+        _expire_page_cursors(room=1)
+        cursor, error = _open_page_cursor(query, timeout_ms)
+        if error is not None:
+            return error
+        key = uuid.uuid4().hex
+    else:
+        _expire_page_cursors()
+        key = after
+        with _page_cursors_lock:
+            entry = _page_cursors.pop(key, None)
+        if entry is None:
+            return QueryResult.from_error(
+                "ERROR:  the next page is no longer available (the result was "
+                "closed after being idle), run the query again"
+            )
+        cursor, _, row_limit = entry
+    try:
+        page = cursor.fetch(page_size)
+    except psycopg2.Error as e:
+        cursor.close()
+        return QueryResult.from_error(e.pgerror or f"ERROR:  {e}", e.pgcode)
+    end = page.offset + page.row_count
+    if row_limit is not None and (end > row_limit or end == row_limit and page.has_more):
+        # Only the extra row is left, or this page holds it
+        page = _cut(page, row_limit - page.offset)
+    if not page.has_more:
+        cursor.close()
+        return page
+    page.next_key = key
+    with _page_cursors_lock:
+        _page_cursors[key] = (cursor, time.monotonic(), row_limit)
+    return page
+
+
+def stream_query(query, batch_size=STREAM_BATCH_SIZE):
+    """Yields the result in QueryResult batches of up to `batch_size` rows.
+
+    With the connection pool the rows come from a server-side cursor, so
+    memory is bounded by the batch size. The docker fallback has no cursor
+    and runs the whole query before slicing it.
+    """
+    engine = get_engine() if DB_BACKEND == "pool" or engine_override() else None
+    if engine is None:
+        result = execute_query_docker(query)
+        if not result.ok:
+            yield result
+            return
+        for start in range(0, max(result.row_count, 1), batch_size):
+            yield QueryResult(
+                result.columns,
+                result.types,
+                [column[start : start + batch_size] for column in result.data],
+            )
+        return
+    try:
+        yield from engine.stream(query, batch_size)
+    except psycopg2.Error as e:
+        yield QueryResult.from_error(e.pgerror or f"ERROR:  {e}", e.pgcode)
+
+
+def explain_query(query):
+    """Plans a query with EXPLAIN (without running it) to catch parse/bind errors."""
+    return execute_query_uncached(f"EXPLAIN {query.strip().rstrip(';')}")
+
+
+def execute_query_uncached(query, timeout_ms=None):
+    """Runs a SQL query through the connection pool, falling back to Docker.
+
+    `timeout_ms` overrides STATEMENT_TIMEOUT_MS for this query.
+    """
+    if DB_BACKEND == "pool" or engine_override() is not None:
+        engine = get_engine()
+        if engine is not None:
+            return engine.execute(query, timeout_ms)
+    return execute_query_docker(query, timeout_ms)
+
+
+def execute_query_docker(query, timeout_ms=None):
     """Runs a SQL query inside the Docker container."""
     # Escape double quotes in the query and wrap the entire query in double quotes
     escaped_query = query.replace('"', '\\"').strip()
-    docker_command = (
-        f"""docker exec -i postgres psql -U postgres -d pagila -c "{escaped_query}" """
-    )
+    timeout_ms = STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+    docker_command = f"""docker exec -i -e PGOPTIONS=-cstatement_timeout={int(timeout_ms)} postgres psql -U postgres -d pagila --csv -q -c "{escaped_query}" """
 
     try:
         result = subprocess.run(
             docker_command, shell=True, check=True, text=True, capture_output=True
         )
-        # print(result.stdout)
-        return result.stdout
     except subprocess.CalledProcessError as e:
         print(f"Error running query: {e.stderr}")
-        return e.stderr
+        return QueryResult.from_error(e.stderr)
+
+    # psql prints no types in CSV mode, so every column comes back as text
+    rows = list(csv.reader(io.StringIO(result.stdout)))
+    if not rows:
+        return QueryResult()
+    return QueryResult.from_rows(rows[0], None, rows[1:])
 
 
 def restart_postgres_container():
@@ -209,9 +497,8 @@ def restart_postgres_container():
 
 
 if __name__ == "__main__":
-    # First setup the database
+    # First setup the database (it waits for the container to be ready)
     restart_postgres_container()
-    time.sleep(10)  # Wait for the container to be ready
     setup_pagila_database()
 
     print("\n=== Checking current database and schema ===")
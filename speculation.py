@@ -0,0 +1,110 @@
+## Speculative answers: run process_query while the question is still being validated
+import contextvars
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from config import SPECULATION_ENABLED, SPECULATION_MAX_PENDING
+from db_engine import CancelScope
+from setup_db import close_page_cursor
+from sql_cache import normalize_question
+from tracing import span, metrics
+
+
+class Speculator:
+    """Answers questions in the background before they are confirmed.
+
+    ``start`` runs a function for a question on a worker thread; ``take``
+    returns its result when the same question (compared like the SQL cache
+    does) is confirmed, and ``discard`` drops it when the question changed.
+    Discarded work is cancelled: running queries are cancelled in Postgres
+    and no further LLM calls are made. A discarded answer that finishes
+    anyway has the page cursor of its results closed. Only the `max_pending` most recent
+    speculations are kept, older ones are discarded.
+    """
+
+    def __init__(self, max_pending=SPECULATION_MAX_PENDING):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_pending, thread_name_prefix="speculation"
+        )
+        self._pending = OrderedDict()  # normalized question -> (future, scope)
+        self._lock = threading.Lock()
+
+    def start(self, question, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) for `question` unless it already runs."""
+        key = normalize_question(question)
+        evicted = []
+        with self._lock:
+            if key in self._pending:
+                return
+            scope = CancelScope()
+            future = self._executor.submit(
+                contextvars.copy_context().run, scope.run, fn, *args, **kwargs
+            )
+            self._pending[key] = (future, scope)
+            while len(self._pending) > self.max_pending:
+                evicted.append(self._pending.popitem(last=False)[1])
+        for entry in evicted:
+            self._cancel(entry, "evicted")
+
+    def take(self, question):
+        """Result of the speculation for `question`, waiting for it to finish.
+
+        Returns None when there is none, or when it raised (the caller then
+        runs the work itself).
+        """
+        with self._lock:
+            entry = self._pending.pop(normalize_question(question), None)
+        if entry is None:
+            metrics.increment("text2sql_speculations_total", outcome="miss")
+            return None
+        future, _ = entry
+        with span("speculation_wait", done=future.done()):
+            error = future.exception()
+        if error is not None:
+            print(f"Speculative answer failed: {type(error).__name__}: {error}")
+            metrics.increment("text2sql_speculations_total", outcome="failed")
+            return None
+        metrics.increment("text2sql_speculations_total", outcome="hit")
+        return future.result()
+
+    def discard(self, question):
+        with self._lock:
+            entry = self._pending.pop(normalize_question(question), None)
+        if entry is not None:
+            self._cancel(entry, "discarded")
+
+    def _cancel(self, entry, outcome):
+        future, scope = entry
+        future.cancel()
+        scope.cancel()
+        # Runs now if the answer is done, or when it finishes
+        future.add_done_callback(_close_answer_cursor)
+        metrics.increment("text2sql_speculations_total", outcome=outcome)
+
+
+def _close_answer_cursor(future):
+    """Closes the cursor a first page of results (the QueryResult of an
+    (sql, results) answer) keeps open for the next pages."""
+    if future.cancelled() or future.exception() is not None:
+        return
+    answer = future.result()
+    results = answer[1] if isinstance(answer, tuple) and len(answer) == 2 else None
+    if getattr(results, "has_more", False):
+        close_page_cursor(results.next_key)
+
+
+_speculator = None
+_speculator_lock = threading.Lock()
+
+
+def get_speculator():
+    """Returns the shared Speculator, or None when SPECULATION_ENABLED is off."""
+    global _speculator
+    if not SPECULATION_ENABLED:
+        return None
+    with _speculator_lock:
+        if _speculator is None:
+            _speculator = Speculator()
+        return _speculator
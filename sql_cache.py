@@ -0,0 +1,208 @@
+## Cache of validated SQL for natural language questions
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+from config import (
+    PROMPT_VERSION,
+    SQL_CACHE_ENABLED,
+    SQL_CACHE_MAX_ENTRIES,
+    SQL_CACHE_TTL,
+    SQL_CACHE_PATH,
+    SQL_CACHE_SIMILARITY,
+)
+from schema_introspection import get_database_schema
+
+
+def normalize_question(question):
+    """Lowercases the question and strips punctuation and extra whitespace."""
+    question = question.lower()
+    # Curly quotes show up in the evals dataset, treat them like plain quotes
+    question = re.sub(r"[‘’“”\"'`]", "", question)
+    question = re.sub(r"[^\w\s\-.$]", " ", question)
+    question = re.sub(r"(?<!\d)\.|\.(?!\d)", " ", question)
+    return " ".join(question.split())
+
+
+def schema_hash(schema):
+    return hashlib.sha256(schema.encode("utf-8")).hexdigest()[:16]
+
+
+def _literals(normalized):
+    """Numbers must match exactly for two phrasings to count as the same question."""
+    return sorted(re.findall(r"\d+(?:\.\d+)?", normalized))
+
+
+class SQLCache:
+    """LRU/TTL cache mapping questions to the final SQL that answered them.
+
+    Keys combine the normalized question, a hash of the database schema
+    (by default the one sent in the prompts, introspected from the catalog
+    when SCHEMA_INTROSPECTION is on) and the prompt version, so schema or
+    prompt changes never reuse stale SQL.
+    With ``path`` set, entries are also written to a SQLite file and loaded
+    back on start-up. With ``similarity`` > 0, a miss falls back to the most
+    similar cached question (same numbers required) above that ratio.
+    """
+
+    def __init__(
+        self,
+        schema=None,
+        prompt_version=PROMPT_VERSION,
+        max_entries=SQL_CACHE_MAX_ENTRIES,
+        ttl=SQL_CACHE_TTL,
+        path=SQL_CACHE_PATH,
+        similarity=SQL_CACHE_SIMILARITY,
+    ):
+        if schema is None:
+            schema = get_database_schema()
+        self.namespace = f"{prompt_version}:{schema_hash(schema)}"
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS sql_cache (
+                    key TEXT PRIMARY KEY,
+                    namespace TEXT,
+                    question TEXT,
+                    sql TEXT,
+                    latency REAL,
+                    created_at REAL
+                )"""
+            )
+            self._db.commit()
+            self._load()
+
+    def _key(self, normalized):
+        return hashlib.sha256(f"{self.namespace}|{normalized}".encode()).hexdigest()
+
+    def _load(self):
+        rows = self._db.execute(
+            """SELECT key, question, sql, latency, created_at FROM sql_cache
+            WHERE namespace = ? ORDER BY created_at DESC LIMIT ?""",
+            (self.namespace, self.max_entries),
+        ).fetchall()
+        for key, question, sql, latency, created_at in reversed(rows):
+            self._entries[key] = {
+                "question": question,
+                "sql": sql,
+                "latency": latency,
+                "created_at": created_at,
+            }
+
+    def _expired(self, entry):
+        return self.ttl and time.time() - entry["created_at"] > self.ttl
+
+    def _delete(self, key):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM sql_cache WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _find_similar(self, normalized):
+        best_key, best_ratio = None, self.similarity
+        literals = _literals(normalized)
+        for key, entry in self._entries.items():
+            if _literals(entry["question"]) != literals:
+                continue
+            ratio = SequenceMatcher(None, normalized, entry["question"]).ratio()
+            if ratio >= best_ratio:
+                best_key, best_ratio = key, ratio
+        return best_key
+
+    def get(self, question):
+        """Returns the cached SQL for the question, or None on a miss."""
+        normalized = normalize_question(question)
+        key = self._key(normalized)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._delete(key)
+                entry = None
+            if entry is None and self.similarity > 0:
+                key = self._find_similar(normalized)
+                entry = self._entries.get(key) if key else None
+                if entry is not None and self._expired(entry):
+                    self._delete(key)
+                    entry = None
+                if entry is not None:
+                    self.similar_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.saved_seconds += entry["latency"]
+            return entry["sql"]
+
+    def put(self, question, sql, latency=0.0):
+        """Stores the validated SQL together with how long it took to produce."""
+        normalized = normalize_question(question)
+        key = self._key(normalized)
+        entry = {
+            "question": normalized,
+            "sql": sql,
+            "latency": latency,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, self.namespace, normalized, sql, latency, entry["created_at"]),
+                )
+                self._db.commit()
+            while len(self._entries) > self.max_entries:
+                self._delete(next(iter(self._entries)))
+
+    def invalidate(self, question):
+        with self._lock:
+            self._delete(self._key(normalize_question(question)))
+
+    def invalidate_sql(self, sql):
+        """Drops every entry serving `sql`, including those reached through
+        a similar question, e.g. once the SQL stopped running."""
+        with self._lock:
+            for key in [k for k, entry in self._entries.items() if entry["sql"] == sql]:
+                self._delete(key)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+_sql_cache = None
+_sql_cache_lock = threading.Lock()
+
+
+def get_sql_cache():
+    """Returns the shared cache, or None when SQL_CACHE_ENABLED is off."""
+    global _sql_cache
+    if not SQL_CACHE_ENABLED:
+        return None
+    with _sql_cache_lock:
+        if _sql_cache is None:
+            _sql_cache = SQLCache()
+        return _sql_cache
@@ -0,0 +1,196 @@
+## Error classification and deterministic fixes for failing SQL
+import re
+from difflib import get_close_matches
+
+from schema_linking import get_schema_graph
+
+
+# Longest error text passed on to the LLM repair prompt
+MAX_ERROR_CHARS = 600
+
+# SQLSTATE -> error class
+ERROR_CLASSES = {
+    "42703": "undefined_column",
+    "42P01": "undefined_table",
+    "42883": "undefined_function",
+    "42804": "type_mismatch",
+    "42846": "type_mismatch",
+    "22P02": "invalid_literal",
+    "22007": "invalid_literal",
+    "22008": "invalid_literal",
+    "42702": "ambiguous_column",
+    "42P09": "ambiguous_alias",
+    "42712": "duplicate_alias",
+    "42803": "grouping_error",
+    "42601": "syntax_error",
+    "42P10": "invalid_column_reference",
+    "57014": "timeout",
+    "54000": "too_expensive",
+}
+
+# Used when the error code is unknown (e.g. the docker/psql fallback)
+ERROR_PATTERNS = [
+    (r"column .* does not exist", "undefined_column"),
+    (r"relation .* does not exist", "undefined_table"),
+    (r"operator does not exist|function .* does not exist", "undefined_function"),
+    (r"is ambiguous", "ambiguous_column"),
+    (r"must appear in the GROUP BY clause", "grouping_error"),
+    (r"syntax error", "syntax_error"),
+    (r"invalid input syntax", "invalid_literal"),
+    (r"statement timeout", "timeout"),
+    (r"query refused: estimated cost", "too_expensive"),
+]
+
+
+class SQLError:
+    """The latest error of a failing query, reduced to what a fix needs."""
+
+    def __init__(self, error_class, message, hint=None):
+        self.error_class = error_class
+        self.message = message
+        self.hint = hint
+
+    def describe(self):
+        """Bounded error text for the repair prompt."""
+        text = f"{self.error_class}: {self.message}"
+        if self.hint:
+            text += f"\nHINT: {self.hint}"
+        return text[:MAX_ERROR_CHARS]
+
+
+def classify_error(result):
+    """Turns a failed QueryResult into an SQLError."""
+    text = result.error or ""
+    message_match = re.search(r"ERROR:\s*(.*)", text)
+    message = message_match.group(1).strip() if message_match else text.strip()
+    hint_match = re.search(r"HINT:\s*(.*)", text)
+    hint = hint_match.group(1).strip() if hint_match else None
+
+    error_class = ERROR_CLASSES.get(result.error_code)
+    if error_class is None:
+        error_class = next(
+            (name for pattern, name in ERROR_PATTERNS if re.search(pattern, message)),
+            "other",
+        )
+    return SQLError(error_class, message, hint)
+
+
+def _table_aliases(sql, graph):
+    """Maps aliases (and bare table names) used in FROM/JOIN to their tables."""
+    aliases = {}
+    for table, alias in re.findall(
+        r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|LEFT\b|RIGHT\b|INNER\b|FULL\b|CROSS\b|GROUP\b|ORDER\b|LIMIT\b|USING\b)(\w+))?",
+        sql,
+        re.IGNORECASE,
+    ):
+        table = table.lower()
+        if table in graph.tables:
+            aliases[(alias or table).lower()] = table
+    return aliases
+
+
+# Quoted literals and identifiers, never rewritten
+_QUOTED_RE = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def _replace_column(sql, column, replacement):
+    """Replaces `column` where it is an expression: not inside quotes, a
+    USING list, an AS alias, or as a qualified name or a function call.
+
+    >>> _replace_column(
+    ...     "SELECT last_update, 'last_update' AS last_update FROM film "
+    ...     "JOIN film_actor USING (film_id) WHERE film_id > 1",
+    ...     "film_id", "film.film_id")
+    "SELECT last_update, 'last_update' AS last_update FROM film JOIN film_actor USING (film_id) WHERE film.film_id > 1"
+    >>> _replace_column("SELECT last_update AS updated FROM film", "last_update", "film.last_update")
+    'SELECT film.last_update AS updated FROM film'
+    """
+    pattern = re.compile(
+        rf"(\bAS\s+\w+|\bUSING\s*\([^)]*\))|(?<![\w.]){re.escape(column)}\b(?!\s*\()",
+        re.IGNORECASE,
+    )
+    parts = _QUOTED_RE.split(sql)
+    for i in range(0, len(parts), 2):
+        parts[i] = pattern.sub(lambda m: m.group(1) or replacement, parts[i])
+    return "".join(parts)
+
+
+def _fix_undefined_column(sql, error, graph):
+    wrong = re.search(r'column "?([\w.]+)"? does not exist', error.message)
+    if not wrong:
+        return None
+    wrong = wrong.group(1)
+    if error.hint:
+        suggested = re.search(r'column "([\w.]+)"', error.hint)
+        if suggested:
+            return _replace_column(sql, wrong, suggested.group(1))
+
+    # No hint: look for a close column name in the table behind the alias
+    alias, _, column = wrong.rpartition(".")
+    table = _table_aliases(sql, graph).get(alias.lower()) if alias else None
+    candidates = graph.columns.get(table, []) if table else [
+        name for columns in graph.columns.values() for name in columns
+    ]
+    match = get_close_matches(column.lower(), candidates, n=1, cutoff=0.75)
+    if not match:
+        return None
+    replacement = f"{alias}.{match[0]}" if alias else match[0]
+    return _replace_column(sql, wrong, replacement)
+
+
+def _fix_undefined_table(sql, error, graph):
+    wrong = re.search(r'relation "?([\w.]+)"? does not exist', error.message)
+    if not wrong:
+        return None
+    name = wrong.group(1).split(".")[-1]
+    match = get_close_matches(name.lower(), list(graph.tables), n=1, cutoff=0.75)
+    if not match:
+        return None
+    return re.sub(rf"\b{re.escape(name)}\b", match[0], sql)
+
+
+def _fix_like_type_mismatch(sql, error, graph):
+    # e.g. "operator does not exist: mpaa_rating ~~* unknown"
+    if not re.search(r"operator does not exist: .* ~~\*? ", error.message):
+        return None
+    return re.sub(
+        r"(?<![\w.:])([\w.]+)(\s+(?:NOT\s+)?I?LIKE\b)",
+        lambda m: m.group(0)
+        if m.group(1).upper() == "NOT"
+        else f"{m.group(1)}::TEXT{m.group(2)}",
+        sql,
+        flags=re.IGNORECASE,
+    )
+
+
+def _fix_ambiguous_column(sql, error, graph):
+    column = re.search(r'column reference "(\w+)" is ambiguous', error.message)
+    if not column:
+        return None
+    column = column.group(1)
+    aliases = _table_aliases(sql, graph)
+    owner = next(
+        (alias for alias, table in aliases.items() if column in graph.columns[table]),
+        None,
+    )
+    if owner is None:
+        return None
+    return _replace_column(sql, column, f"{owner}.{column}")
+
+
+DETERMINISTIC_FIXES = {
+    "undefined_column": _fix_undefined_column,
+    "undefined_table": _fix_undefined_table,
+    "undefined_function": _fix_like_type_mismatch,
+    "type_mismatch": _fix_like_type_mismatch,
+    "ambiguous_column": _fix_ambiguous_column,
+}
+
+
+def deterministic_fix(sql, error, schema=None):
+    """Tries a rule-based fix for the error; returns None if none applies."""
+    fix = DETERMINISTIC_FIXES.get(error.error_class)
+    if fix is None:
+        return None
+    fixed = fix(sql, error, get_schema_graph(schema))
+    return fixed if fixed and fixed != sql else None
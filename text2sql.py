@@ -1,41 +1,64 @@
 # !pip install -r requirements.txt
 ## 1. Database Schema and Configuration
-import os
-import google.generativeai as genai
-from setup_db import execute_query
+from setup_db import explain_query
+from query_guard import execute_guarded
+from db_engine import Cancelled, cancel_requested
+from query_result import QueryResult
+from sql_cache import get_sql_cache
 from config import (
-    GOOGLE_API_KEY,
     DATABASE_SCHEMA,
     COT_TEXT2SQL_EXAMPLE,
-    LANGCHAIN_API_KEY,
+    SCHEMA_PRUNING,
+    EXPLAIN_FAST_PATH,
+    SELF_CONSISTENCY_CANDIDATES,
+    SELF_CONSISTENCY_QUORUM,
+    INTERACTIVE_STATEMENT_TIMEOUT_MS,
 )
+from schema_linking import prune_schema
+from sql_repair import classify_error, deterministic_fix
+from llm_backend import get_llm_backend, gemini_client
+from profiling import timed, timed_step, record_value
+from tracing import span, set_attributes, record_llm_call, sql_hash, metrics
+from self_consistency import run_self_consistency
+from fewshot_index import fewshot_examples, get_fewshot_index
+from prompts import PromptBudgetExceeded, render_prompt
+from schema_introspection import get_database_schema
+from value_index import value_hints
 
 import re
 import json
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolExecutor
-from langchain.tools import Tool
-from langchain.schema import HumanMessage
+import time
+import threading
 from typing import TypedDict, Annotated, Sequence, Union
 from typing import List, Tuple, Dict, Any
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.schema import SystemMessage, HumanMessage
-
-
-genai.configure(api_key=GOOGLE_API_KEY)
-
-os.environ["LANGCHAIN_API_KEY"] = LANGCHAIN_API_KEY
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_PROJECT"] = "text2sql"
-os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
+# The LLM backend and langgraph are loaded on first use (see llm_backend.py
+# and get_agent_executor), so importing this module stays cheap for batch
+# jobs and tooling that never call an LLM.
 
 ## 2. Core Text-to-SQL Functions
 
-# Load LLMs
-llm_sql_generator = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite-preview-02-05")
-llm_sql_validator = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite-preview-02-05")
+
+def ask_llm(role, prompt, key):
+    """Sends the rendered Prompt to the configured LLM backend and returns the
+    reply text. `key` is the input the reply depends on, used to record and
+    replay calls."""
+    if cancel_requested():
+        raise Cancelled(f"{role} call skipped, the request was cancelled")
+    record_value(f"prompt_chars.{role}", len(prompt.text))
+    record_value(f"prompt_tokens.{role}", prompt.tokens)
+    for section in prompt.dropped:
+        metrics.increment(
+            "text2sql_prompt_sections_dropped_total", role=role, section=section
+        )
+    with timed_step(f"llm.{role}"):
+        set_attributes(
+            prompt_prefix_hash=prompt.prefix_hash,
+            prompt_prefix_tokens=prompt.prefix_tokens,
+        )
+        response = get_llm_backend().complete(role, prompt.text, key)
+        record_llm_call(role, prompt.text, response)
+        return response
 
 
 # Extract SQL from the model response
@@ -49,77 +72,87 @@ def generate_sql(
     natural_language_query,
     DATABASE_SCHEMA=DATABASE_SCHEMA,
     COT_TEXT2SQL_EXAMPLE=COT_TEXT2SQL_EXAMPLE,
+    role="sql_generator",
+    value_hints=None,
 ):
-    """Agent to generate SQL from a natural language question."""
-    prompt = f"""
-    Properly use the Database Schema to properly use the table names and column names for respective tables.
-    
-    Database Schema:
-    {DATABASE_SCHEMA}
-
-    **************************
-    Properly use the Database Schema to generate the SQL query.
-    Answer Repeating the question and evidence, and generating the SQL with a query plan.
-    
-    <---(Example)--->
-    {COT_TEXT2SQL_EXAMPLE}
-    
-    Only return the SQL query without ``` backticks, no other text. 
-    Ensure the table alias is correctly assigned
-    
-    
-    ---------------------------------
-    Question: {natural_language_query}
-
-    SQL Query: 
-    """
-    response = llm_sql_generator.invoke([HumanMessage(content=prompt)])
-    return extract_sql(response.content)
+    """Agent to generate SQL from a natural language question.
+    `role="sql_sampler"` samples at a higher temperature; `value_hints`
+    tells how the question's literals are stored (see value_index.py)."""
+    prompt = render_prompt(
+        "sql_generator",
+        DATABASE_SCHEMA,
+        examples=COT_TEXT2SQL_EXAMPLE,
+        values=value_hints,
+        question=natural_language_query,
+    )
+    return extract_sql(ask_llm(role, prompt, natural_language_query))
 
 
 # Tool 2: Validate and Fix SQL Query for PostgreSQL
 def validate_and_fix_sql(sql_query, DATABASE_SCHEMA=DATABASE_SCHEMA):
     """Agent to validate and correct SQL syntax for PostgreSQL."""
-    prompt = f"""
-    The following SQL query might have syntax issues. Your task is to analyze it and correct any mistakes 
-    so that it works properly in **PostgreSQL**.
-    
-    Properly use the Database Schema to generate the SQL query.
-    Database Schema:
-    {DATABASE_SCHEMA}
-
-    Incorrect SQL:
-    {sql_query}
-
-    Return only the corrected SQL query without any explanations or ``` backticks.
-    
-    Make sure to use "ILIKE" instead of "=" for case insensitive matching. If not asked to be case sensitive
-    Only while using "ILIKE" make sure to use "::TEXT" to avoid type mismatch errors.
-    Don't use "::TEXT" while using "=" or anyother time
-    
-
-    Corrected SQL Query:
-    """
-    response = llm_sql_validator.invoke([HumanMessage(content=prompt)])
-    return extract_sql(response.content)
+    prompt = render_prompt("sql_validator", DATABASE_SCHEMA, sql_query=sql_query)
+    return extract_sql(ask_llm("sql_validator", prompt, sql_query))
+
+
+# Tool 3: Repair a failing SQL Query from its latest error
+def repair_sql(sql_query, error_description, DATABASE_SCHEMA=DATABASE_SCHEMA):
+    """Agent to fix a SQL query that failed in PostgreSQL with the given error."""
+    prompt = render_prompt(
+        "sql_repair", DATABASE_SCHEMA, sql_query=sql_query, error=error_description
+    )
+    return extract_sql(ask_llm("sql_repair", prompt, sql_query))
+
+
+def question_schema(question):
+    """Schema sent in the prompts: pruned to the question when SCHEMA_PRUNING is on."""
+    schema = get_database_schema()
+    return prune_schema(question, schema) if SCHEMA_PRUNING else schema
+
+
+def remember_answer(question, sql_query, latency, sql_cache):
+    """Keeps SQL that ran successfully in the SQL cache (unless None) for
+    reuse. It only becomes a few-shot example once confirmed, see
+    confirm_answer: SQL that runs may still answer another question."""
+    if sql_cache is not None:
+        sql_cache.put(question, sql_query, latency=latency)
+
+
+def confirm_answer(question, sql_query):
+    """Adds an answer the user confirmed as correct to the few-shot index;
+    returns whether it was new."""
+    fewshot_index = get_fewshot_index()
+    if fewshot_index is None or not sql_query:
+        return False
+    return fewshot_index.add(question, sql_query)
 
 
 # Define state type
 class AgentState(TypedDict):
     input: str
+    schema: str
     sql_query: str
     final_query: str
-    query_results: str  # Add this field
+    query_results: QueryResult  # Add this field
+    fast_path: bool  # True when EXPLAIN succeeded and validation was skipped
+    repairs: int  # Repair attempts made so far
+    max_repairs: int
+    error_class: str  # Class of the latest execution error
+    page_size: int  # Only fetch the first page of results when set
+    interactive: bool  # Apply the interactive row limit and timeout
 
 
 # Define nodes with updated configuration
+@timed("generate_sql")
 def generate_sql_node(state: AgentState) -> AgentState:
     """Generate initial SQL query"""
     try:
+        state["schema"] = question_schema(state["input"])
         sql_query = generate_sql(
             natural_language_query=state["input"],
-            DATABASE_SCHEMA=DATABASE_SCHEMA,
-            COT_TEXT2SQL_EXAMPLE=COT_TEXT2SQL_EXAMPLE,
+            DATABASE_SCHEMA=state["schema"],
+            COT_TEXT2SQL_EXAMPLE=fewshot_examples(state["input"]),
+            value_hints=value_hints(state["input"]),
         )
         state["sql_query"] = sql_query
         return state
@@ -128,10 +161,84 @@ def generate_sql_node(state: AgentState) -> AgentState:
         raise
 
 
+class FastPathStats:
+    """Counts how often EXPLAIN lets a request skip validate_sql and
+    estimates the time saved from the average validate_sql latency."""
+
+    def __init__(self):
+        self.planned = 0
+        self.fast_path = 0
+        self.validated = 0
+        self.saved_seconds = 0.0
+        self.avg_validate_seconds = None
+        self._lock = threading.Lock()
+
+    def record_validation(self, seconds):
+        with self._lock:
+            self.validated += 1
+            if self.avg_validate_seconds is None:
+                self.avg_validate_seconds = seconds
+            else:
+                self.avg_validate_seconds = 0.8 * self.avg_validate_seconds + 0.2 * seconds
+
+    def record_plan(self, fast_path, plan_seconds):
+        """Returns the estimated seconds saved by this plan, if it took the fast path."""
+        with self._lock:
+            self.planned += 1
+            if not fast_path:
+                return 0.0
+            self.fast_path += 1
+            saved = max(0.0, (self.avg_validate_seconds or 0.0) - plan_seconds)
+            self.saved_seconds += saved
+            return saved
+
+    def stats(self):
+        return {
+            "planned": self.planned,
+            "fast_path": self.fast_path,
+            "validated": self.validated,
+            "fast_path_rate": self.fast_path / self.planned if self.planned else 0.0,
+            "avg_validate_seconds": self.avg_validate_seconds,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+fast_path_stats = FastPathStats()
+
+
+@timed("plan_sql")
+def plan_sql_node(state: AgentState) -> AgentState:
+    """Plan the generated SQL with EXPLAIN; valid SQL skips the LLM validator.
+    Any EXPLAIN failure (bad SQL, but also a timeout or a lost connection)
+    goes through validation."""
+    state["fast_path"] = False
+    if not EXPLAIN_FAST_PATH:
+        return state
+    start = time.perf_counter()
+    plan = explain_query(state["sql_query"].replace("\n", " "))
+    state["fast_path"] = plan.ok
+    saved = fast_path_stats.record_plan(
+        state["fast_path"], time.perf_counter() - start
+    )
+    if state["fast_path"]:
+        state["final_query"] = state["sql_query"]
+        print(f"EXPLAIN succeeded, skipping validate_sql (~{saved:.2f}s saved)")
+    return state
+
+
+def route_after_plan(state: AgentState) -> str:
+    return "execute_sql" if state["fast_path"] else "validate_sql"
+
+
+@timed("validate_sql")
 def validate_sql_node(state: AgentState) -> AgentState:
     """Validate and fix SQL query"""
     try:
-        final_query = validate_and_fix_sql(state["sql_query"])
+        start = time.perf_counter()
+        final_query = validate_and_fix_sql(
+            state["sql_query"], DATABASE_SCHEMA=state["schema"]
+        )
+        fast_path_stats.record_validation(time.perf_counter() - start)
         state["final_query"] = final_query
         return state
     except Exception as e:
@@ -139,10 +246,26 @@ def validate_sql_node(state: AgentState) -> AgentState:
         raise
 
 
+def run_sql(sql_query, page_size=None, interactive=False):
+    """Runs the query behind the execution guard, returning only its first
+    page when page_size is set."""
+    query_results = execute_guarded(
+        sql_query, interactive=interactive, page_size=page_size
+    )
+    for notice in query_results.notices:
+        print(f"Guard: {notice}")
+    return query_results
+
+
+@timed("execute_sql")
 def execute_sql_node(state: AgentState) -> AgentState:
     """Execute the SQL query and store results"""
     try:
-        query_results = execute_query(state["final_query"].replace("\n", " "))
+        query_results = run_sql(
+            state["final_query"].replace("\n", " "),
+            state.get("page_size"),
+            state.get("interactive", False),
+        )
         state["query_results"] = query_results
         return state
     except Exception as e:
@@ -150,75 +273,297 @@ def execute_sql_node(state: AgentState) -> AgentState:
         raise
 
 
-# Create workflow
-workflow = StateGraph(AgentState)
+@timed("repair_sql")
+def repair_sql_node(state: AgentState) -> AgentState:
+    """Repair the failing SQL using only its latest classified error"""
+    try:
+        error = classify_error(state["query_results"])
+        state["error_class"] = error.error_class
+        state["repairs"] += 1
+        set_attributes(
+            attempt=state["repairs"],
+            error_class=error.error_class,
+            sql_hash=sql_hash(state["final_query"]),
+        )
+        fixed_query = deterministic_fix(
+            state["final_query"], error, get_database_schema()
+        )
+        method = "rule"
+        if fixed_query is None:
+            # A table missing from a pruned schema needs the full one
+            schema = (
+                get_database_schema()
+                if error.error_class == "undefined_table"
+                else state["schema"]
+            )
+            fixed_query = repair_sql(
+                state["final_query"], error.describe(), DATABASE_SCHEMA=schema
+            )
+            method = "llm"
+        print(f"Repair {state['repairs']} ({error.error_class}, {method})")
+        set_attributes(method=method)
+        metrics.increment(
+            "text2sql_repairs_total", error_class=error.error_class, method=method
+        )
+        state["final_query"] = fixed_query
+        return state
+    except Exception as e:
+        print(f"Error in repair_sql_node: {str(e)}")
+        raise
+
+
+def route_after_execute(state: AgentState) -> str:
+    if (
+        state["query_results"].ok
+        or state["repairs"] >= state["max_repairs"]
+        or cancel_requested()
+    ):
+        from langgraph.graph import END
+
+        return END
+    return "repair_sql"
+
+
+def build_workflow():
+    """Builds the (uncompiled) agent graph"""
+    from langgraph.graph import StateGraph, END
+
+    workflow = StateGraph(AgentState)
+
+    # Add nodes
+    workflow.add_node("generate_sql", generate_sql_node)
+    workflow.add_node("plan_sql", plan_sql_node)
+    workflow.add_node("validate_sql", validate_sql_node)
+    workflow.add_node("execute_sql", execute_sql_node)  # Add new node
+    workflow.add_node("repair_sql", repair_sql_node)
 
-# Add nodes
-workflow.add_node("generate_sql", generate_sql_node)
-workflow.add_node("validate_sql", validate_sql_node)
-workflow.add_node("execute_sql", execute_sql_node)  # Add new node
+    # Add edges
+    workflow.add_edge("generate_sql", "plan_sql")
+    workflow.add_conditional_edges(
+        "plan_sql",
+        route_after_plan,
+        {"execute_sql": "execute_sql", "validate_sql": "validate_sql"},
+    )
+    workflow.add_edge("validate_sql", "execute_sql")  # Add edge to new node
+    workflow.add_conditional_edges(
+        "execute_sql", route_after_execute, {"repair_sql": "repair_sql", END: END}
+    )
+    workflow.add_edge("repair_sql", "execute_sql")
 
-# Add edges
-workflow.add_edge("generate_sql", "validate_sql")
-workflow.add_edge("validate_sql", "execute_sql")  # Add edge to new node
-workflow.add_edge("execute_sql", END)  # Update final edge
+    # Set entry point
+    workflow.set_entry_point("generate_sql")
 
-# Set entry point
-workflow.set_entry_point("generate_sql")
+    return workflow
 
-# Compile
-agent_executor = workflow.compile()
+
+_agent_executor = None
+_agent_lock = threading.Lock()
+
+
+def get_agent_executor():
+    """Returns the compiled agent graph, compiling it on first use"""
+    global _agent_executor
+    if _agent_executor is None:
+        with _agent_lock:
+            if _agent_executor is None:
+                _agent_executor = build_workflow().compile()
+    return _agent_executor
+
+
+# Backwards-compatible module attributes (text2sql.agent_executor,
+# text2sql.llm_sql_generator, ...), resolved lazily
+_LAZY_ATTRIBUTES = {
+    "agent_executor": get_agent_executor,
+    "llm_sql_generator": lambda: gemini_client("sql_generator"),
+    "llm_sql_validator": lambda: gemini_client("sql_validator"),
+    "llm_query_validator": lambda: gemini_client("query_validator"),
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 # Update example usage
-def process_query(natural_language_query: str, max_retries=5, show_print=True):
-    attempt = 0
-    error_message = ""
+def process_query(
+    natural_language_query: str,
+    max_retries=5,
+    show_print=True,
+    page_size=None,
+    interactive=False,
+    use_cache=True,
+    candidates=SELF_CONSISTENCY_CANDIDATES,
+):
+    """Runs the agent for one question; returns (sql, QueryResult), or
+    (None, None) when no working SQL was found.
+
+    With `candidates` > 1, that many SQL candidates are generated and run in
+    parallel and the majority result is kept (see self_consistency.py); the
+    agent graph only runs when every candidate fails.
+    """
+    with span("process_query", interactive=interactive):
+        sql_query, query_results = _process_query(
+            natural_language_query,
+            max_retries,
+            show_print,
+            page_size,
+            interactive,
+            use_cache,
+            candidates,
+        )
+        outcome = "ok" if query_results is not None else "failed"
+        set_attributes(outcome=outcome)
+        metrics.increment("text2sql_requests_total", outcome=outcome)
+        return sql_query, query_results
+
+
+def vote_sql(natural_language_query, candidates, page_size=None, interactive=False):
+    """Generates SQL candidates in parallel and votes on their results.
+    The first candidate uses the regular generator, the others are sampled.
+
+    Candidates vote on their whole results: the page size and the
+    interactive row limit would make candidates that only agree on their
+    first rows look the same. Only the winner is then run again for the
+    page (and the limits) the caller asked for.
+    """
+    schema = question_schema(natural_language_query)
+    examples = fewshot_examples(natural_language_query)
+    hints = value_hints(natural_language_query)
+
+    def generate(index):
+        return generate_sql(
+            natural_language_query,
+            DATABASE_SCHEMA=schema,
+            COT_TEXT2SQL_EXAMPLE=examples,
+            role="sql_sampler" if index else "sql_generator",
+            value_hints=hints,
+        )
+
+    def execute(sql_query):
+        # Interactive candidates keep the interactive timeout
+        return execute_guarded(
+            sql_query.replace("\n", " "),
+            timeout_ms=INTERACTIVE_STATEMENT_TIMEOUT_MS if interactive else None,
+        )
+
+    winner, stats = run_self_consistency(
+        generate, execute, candidates, quorum=SELF_CONSISTENCY_QUORUM
+    )
+    if winner is not None and (page_size or interactive):
+        winner.result = run_sql(winner.sql.replace("\n", " "), page_size, interactive)
+    return winner, stats
+
+
+def _process_query(
+    natural_language_query,
+    max_retries,
+    show_print,
+    page_size,
+    interactive,
+    use_cache,
+    candidates,
+):
+    # Reuse previously validated SQL without any LLM calls
+    sql_cache = get_sql_cache() if use_cache else None
+    if sql_cache is not None:
+        with timed_step("sql_cache"):
+            cached_sql = sql_cache.get(natural_language_query)
+        if cached_sql is not None:
+            query_results = run_sql(
+                cached_sql.replace("\n", " "), page_size, interactive
+            )
+            if query_results.ok:
+                if show_print:
+                    print("\nCached SQL:\n", cached_sql)
+                    print("\nQuery results:\n", query_results.preview())
+                set_attributes(sql_cache_hit=True)
+                return cached_sql, query_results
+            # The cached SQL no longer runs, generate it again. It may have
+            # been found through a similar question, stored under its own key
+            sql_cache.invalidate_sql(cached_sql)
+
+    start_time = time.perf_counter()
+    if candidates and candidates > 1:
+        with span("self_consistency", candidates=candidates):
+            winner, stats = vote_sql(
+                natural_language_query, candidates, page_size, interactive
+            )
+            set_attributes(**stats)
+        if show_print:
+            print(f"\nSelf-consistency: {stats}")
+        if winner is not None:
+            if show_print:
+                print("\nGenerated SQL:\n", winner.sql)
+                print("\nQuery results:\n", winner.result.preview())
+            remember_answer(
+                natural_language_query,
+                winner.sql,
+                time.perf_counter() - start_time,
+                sql_cache,
+            )
+            return winner.sql, winner.result
+        print("\nEvery candidate failed, falling back to the repair loop")
 
     state = {
         "input": natural_language_query,
+        "schema": "",
         "sql_query": "",
         "final_query": "",
-        "query_results": "",
+        "query_results": None,
+        "fast_path": False,
+        "repairs": 0,
+        # SQL errors are handled inside the graph by repair_sql
+        "max_repairs": max_retries - 1,
+        "error_class": "",
+        "page_size": page_size,
+        "interactive": interactive,
     }
+    # generate, plan, validate, execute + (repair, execute) per repair
+    config = {"recursion_limit": 5 + 2 * max_retries}
 
-    error_messages = []
-    while attempt < max_retries:
-        # print(f"Attempt {attempt + 1}:{error_messages}")
+    result = None
+    attempt = 0
+    while result is None and attempt < max_retries:
         try:
-            result = agent_executor.invoke(state)
+            with span("graph_attempt", attempt=attempt + 1):
+                result = get_agent_executor().invoke(state, config)
+        except (Cancelled, PromptBudgetExceeded) as e:
+            # Retrying would not change the outcome
+            print(f"Attempt {attempt + 1} stopped: {e}")
+            break
+        except Exception as e:
+            # LLM/API failures (rate limits, timeouts) restart the graph
+            attempt += 1
+            print(f"Attempt {attempt} failed: {type(e).__name__}: {e}")
+            metrics.increment("text2sql_graph_restarts_total")
 
-            # Extract query and results
-            sql_query = result["final_query"]
-            query_results = result["query_results"]
+    record_value("graph_restarts", attempt)
+    if result is None:
+        print("\nMax retries reached.")
+        return None, None
+    record_value("repairs", result["repairs"])
+    set_attributes(repairs=result["repairs"], fast_path=result["fast_path"])
 
-            if show_print:
-                print(f"\nAttempt {attempt + 1}:")
-                print("\nNatural Language Query:\n", state["input"])
-                print("\nGenerated SQL:\n", sql_query)
-                print("\nQuery results:\n", query_results)
-
-            # Check if the result contains an error
-            if "ERROR" in query_results.upper():
-                # Extract the error message
-                error_message = query_results  # Full error message
-                error_messages.append(error_message)
-                # Prepare the retry prompt
-                state["input"] = (
-                    f"""{natural_language_query}\n\nPrevious Error list: {error_messages}"""
-                )
-                attempt += 1
-                continue  # Retry the process
-
-            # If no error, return the successful result
-            return sql_query, query_results
+    # Extract query and results
+    sql_query = result["final_query"]
+    query_results = result["query_results"]
 
-        except Exception as e:
-            # print(f"Unexpected error in attempt {attempt + 1}: {str(e)}")
-            attempt += 1
+    if show_print:
+        print(f"\nRepairs: {result['repairs']}")
+        print("\nNatural Language Query:\n", natural_language_query)
+        print("\nGenerated SQL:\n", sql_query)
+        print("\nQuery results:\n", query_results.preview())
+
+    if not query_results.ok:
+        print(f"\nMax retries reached. Last error: {query_results.error}")
+        return None, None  # Return None if max retries are exceeded
 
-    print(f"\nMax retries reached. Last error: {error_message}")
-    return None, None  # Return None if max retries are exceeded
+    remember_answer(
+        natural_language_query, sql_query, time.perf_counter() - start_time, sql_cache
+    )
+    return sql_query, query_results
 
 
 # # Test the processing
@@ -228,11 +573,6 @@ def process_query(natural_language_query: str, max_retries=5, show_print=True):
 # sql, results = process_query(test_query,show_print=True)
 
 
-llm_query_validator = ChatGoogleGenerativeAI(
-    model="gemini-2.0-flash-lite-preview-02-05"
-)
-
-
 def string_to_dict(text):
     """
     Converts a JSON-like structured string into a dictionary, handling extra formatting.
@@ -260,55 +600,16 @@ def string_to_dict(text):
 
 
 # Validate Natural Language Query
+@timed("validate_nl")
 def validate_nl_query(natural_language_query, user_instructions=None):
     """Agent to validate and improve natural language query."""
-    prompt = f"""
-    
-    "JUST OUTPUT THE Python DICTIONARY of texts of natural language query"
-    You are a helpful assistant that validates natural language queries for a Database.
-    Your task is to analyze the query for ambiguity, incompleteness, or incorrectness and improve it if needed.
-    You are also allowed to use the database schema to improve the query.
-
-    User Instructions:
-    {user_instructions}
-
-    Database Schema:
-    {DATABASE_SCHEMA}
-    
-    Natural Language Query:
-    {natural_language_query}
-    
-    If the query is clear and complete, return it unchanged.
-    If the query needs improvement, provide the improved version and explain why.
-    Make sure to return the corrected input, the improved query and the feedback.
-    Make sure to not alter the original query too much, if there is no typo or discrepancy with database schema. 
-    
-    
-    In the following Format - For example:
-    original_query: show moveis with actr smith
-    corrected_input: show movies with actor smith
-    feedback: Fixed typos in 'movies' and 'actor', added specificity about searching by last name
-    
-    original_query: show all movies with rating R
-    corrected_input: show all movies with rating R
-    feedback: Query is clear and well-formed, minor rewording for consistency
-    
-    original_query: list customer payments
-    corrected_input: list customer payments
-    feedback: Query is clear and grammatically correct   
-    
-    Output Format (make sure say why we changed what, if changed): 
-    ```python
-    {{
-        original_query: show moveis with actr smith
-        corrected_input: show movies with actor smith
-        feedback: Fixed typos in 'movies' and 'actor'
-    }}
-    ```
-    
-
-    """
-    response = llm_query_validator.invoke([HumanMessage(content=prompt)])
-
-    print(response.content)
-    return string_to_dict(response.content)
+    prompt = render_prompt(
+        "query_validator",
+        question_schema(natural_language_query),
+        user_instructions=user_instructions,
+        question=natural_language_query,
+    )
+    response = ask_llm("query_validator", prompt, natural_language_query)
+
+    print(response)
+    return string_to_dict(response)
@@ -0,0 +1,236 @@
+## Local span tracing (JSONL) and Prometheus metrics for the pipeline
+import atexit
+import contextvars
+import hashlib
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import TRACING_ENABLED, TRACE_PATH, METRICS_HOST, METRICS_PORT
+from prompts import count_tokens
+from result_cache import canonicalize_sql
+
+
+# Upper bounds (seconds) of the span duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def sql_hash(sql):
+    """Short hash of the canonicalized SQL, to group spans by query."""
+    return hashlib.sha256(canonicalize_sql(sql).encode("utf-8")).hexdigest()[:16]
+
+
+class Span:
+    """One timed operation of a request; children share its trace_id."""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.duration = None
+        self.status = "ok"
+        self.attributes = dict(attributes or {})
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            **self.attributes,
+        }
+
+
+class JSONLExporter:
+    """Appends finished spans to a JSONL file, one span per line."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+            self._file.write(line)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MetricsRegistry:
+    """Counters and a duration histogram per span name, rendered in the
+    Prometheus text format."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._spans = {}  # (name, status) -> count
+        self._histograms = {}  # name -> [bucket counts..., sum, count]
+        self._counters = {}  # (metric, labels) -> value
+        self._lock = threading.Lock()
+
+    def observe_span(self, span):
+        with self._lock:
+            key = (span.name, span.status)
+            self._spans[key] = self._spans.get(key, 0) + 1
+            histogram = self._histograms.setdefault(
+                span.name, [0] * len(self.buckets) + [0.0, 0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    histogram[i] += 1
+            histogram[-2] += span.duration
+            histogram[-1] += 1
+
+    def increment(self, metric, value=1, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        def label_text(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+        lines = [
+            "# HELP text2sql_spans_total Finished spans by name and status",
+            "# TYPE text2sql_spans_total counter",
+        ]
+        with self._lock:
+            for (name, status), count in sorted(self._spans.items()):
+                lines.append(
+                    f'text2sql_spans_total{{span="{name}",status="{status}"}} {count}'
+                )
+            lines += [
+                "# HELP text2sql_span_duration_seconds Span durations",
+                "# TYPE text2sql_span_duration_seconds histogram",
+            ]
+            for name, histogram in sorted(self._histograms.items()):
+                for bound, count in zip(self.buckets, histogram):
+                    lines.append(
+                        f'text2sql_span_duration_seconds_bucket{{span="{name}",le="{bound}"}} {count}'
+                    )
+                lines.append(
+                    f'text2sql_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram[-1]}'
+                )
+                lines.append(
+                    f'text2sql_span_duration_seconds_sum{{span="{name}"}} {histogram[-2]:.6f}'
+                )
+                lines.append(
+                    f'text2sql_span_duration_seconds_count{{span="{name}"}} {histogram[-1]}'
+                )
+            metrics = sorted({metric for metric, _ in self._counters})
+            for metric in metrics:
+                lines.append(f"# TYPE {metric} counter")
+                for (name, labels), value in sorted(self._counters.items()):
+                    if name == metric:
+                        lines.append(f"{metric}{label_text(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+exporter = JSONLExporter(TRACE_PATH) if TRACING_ENABLED and TRACE_PATH else None
+metrics = MetricsRegistry()
+atexit.register(lambda: exporter and exporter.close())
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the ``with`` block as a child of the current span.
+
+    The span is written to TRACE_PATH and counted in the metrics when it
+    ends; an exception marks it as an error (with its type) and propagates.
+    """
+    if not TRACING_ENABLED:
+        yield None
+        return
+    current = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        metrics.observe_span(current)
+        if exporter is not None:
+            exporter.export(current)
+
+
+def set_attributes(**attributes):
+    """Adds attributes to the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def record_llm_call(role, prompt, response):
+    """Token counts of an LLM call, on the current span and in the metrics."""
+    prompt_tokens = count_tokens(prompt)
+    response_tokens = count_tokens(response)
+    set_attributes(
+        role=role, prompt_tokens=prompt_tokens, response_tokens=response_tokens
+    )
+    metrics.increment("text2sql_llm_tokens_total", prompt_tokens, role=role, kind="prompt")
+    metrics.increment(
+        "text2sql_llm_tokens_total", response_tokens, role=role, kind="response"
+    )
+
+
+def record_query(sql, result):
+    """SQL hash, rows returned and error class of an executed query."""
+    attributes = {"sql_hash": sql_hash(sql)}
+    if result.ok:
+        attributes["rows"] = result.row_count
+        metrics.increment("text2sql_rows_returned_total", result.row_count)
+    else:
+        from sql_repair import classify_error
+
+        attributes["error_class"] = classify_error(result).error_class
+        metrics.increment(
+            "text2sql_query_errors_total", error_class=attributes["error_class"]
+        )
+    set_attributes(**attributes)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep scrapes out of the console
+
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serves /metrics on `host`:`port` from a daemon thread; returns the server."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,254 @@
+## Index of stored text values (names, cities, titles...) to ground question literals
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from config import (
+    VALUE_INDEX_ENABLED,
+    VALUE_INDEX_COLUMNS,
+    VALUE_MATCH_THRESHOLD,
+)
+
+
+# Seconds to wait before trying to load the values again after a failure
+VALUE_INDEX_RETRY_INTERVAL = 30
+# Fuzzy matches reported per literal
+MAX_MATCHES = 3
+
+# Quoted literals, with straight or curly quotes
+_QUOTED_RE = re.compile(r"\"([^\"]+)\"|“([^”]+)”|‘([^’]+)’|(?<!\w)'([^']+)'(?!\w)")
+# Runs of capitalized words or codes such as PG-13
+_CAPITALIZED_RE = re.compile(r"\b[A-Z][\w'-]*(?:\s+[A-Z][\w'-]*)*")
+# Capitalized words that are not literals of the database
+_NOT_LITERALS = {
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december", "monday", "tuesday",
+    "wednesday", "thursday", "friday", "saturday", "sunday", "i", "sql",
+}
+
+
+def normalize_value(value):
+    """Case-, accent- and punctuation-insensitive form used for lookups
+    ("Café" and "cafe" are the same)."""
+    decomposed = unicodedata.normalize("NFKD", value.lower())
+    value = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(re.findall(r"[^\W_]+", value))
+
+
+def trigrams(text):
+    """Trigrams of each word, padded like pg_trgm ("  a", " ab", "abc", "bc ")."""
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class ValueIndex:
+    """Distinct values of some text columns, for exact and trigram lookups.
+
+    Values are keyed by their normalized form, so "new york", "New York."
+    and "NEW YORK" all find the stored "New York" (in every column holding
+    it).
+    """
+
+    def __init__(self):
+        self.values = {}  # normalized value -> [(table.column, stored value)]
+        self.keys = []  # normalized values, by id
+        self.postings = {}  # trigram -> ids of the values containing it
+        self.key_trigrams = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, column, value):
+        key = normalize_value(value)
+        if not key:
+            return
+        if key not in self.values:
+            self.values[key] = []
+            grams = trigrams(key)
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(len(self.keys))
+            self.keys.append(key)
+            self.key_trigrams.append(grams)
+        self.values[key].append((column, value))
+
+    def exact(self, literal):
+        """[(table.column, stored value)] equal to the literal once normalized."""
+        return self.values.get(normalize_value(literal), [])
+
+    def similar(self, literal, threshold=VALUE_MATCH_THRESHOLD, limit=MAX_MATCHES):
+        """[(similarity, normalized value)] of the closest values by trigram
+        similarity (shared / all trigrams, as in pg_trgm)."""
+        grams = trigrams(normalize_value(literal))
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            shared.update(self.postings.get(gram, ()))
+        matches = []
+        for value_id, count in shared.items():
+            similarity = count / len(grams | self.key_trigrams[value_id])
+            if similarity >= threshold:
+                matches.append((similarity, self.keys[value_id]))
+        matches.sort(key=lambda match: (-match[0], match[1]))
+        return matches[:limit]
+
+    def resolve(self, question):
+        """Grounds the literals of a question.
+
+        Returns [(literal, matches, exact)] where matches are (table.column,
+        stored value) pairs. Quoted literals are always reported, so one
+        with no match is flagged as not in the database; capitalized words
+        are only reported when they match, as they may just be capitalized.
+        """
+        resolved = []
+        seen = set()
+        for literal, quoted in extract_literals(question):
+            key = normalize_value(literal)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            matches = self.exact(literal)
+            if matches:
+                resolved.append((literal, matches, True))
+                continue
+            matches = [
+                pair
+                for _, similar in self.similar(literal)
+                for pair in self.values[similar]
+            ]
+            if matches or quoted:
+                resolved.append((literal, matches, False))
+            if " " in literal:
+                # "John Doe" may still hold a stored first or last name
+                for word in literal.split():
+                    if normalize_value(word) not in seen and self.exact(word):
+                        seen.add(normalize_value(word))
+                        resolved.append((word, self.exact(word), True))
+        return resolved
+
+
+def extract_literals(question):
+    """(literal, quoted) pairs: quoted strings first, then runs of
+    capitalized words other than the first word of the question."""
+    literals = []
+    for match in _QUOTED_RE.finditer(question):
+        text = next(group for group in match.groups() if group)
+        literals.append((text.strip().rstrip(".,;:!?"), True))
+    unquoted = _QUOTED_RE.sub(" ", question)
+    for match in _CAPITALIZED_RE.finditer(unquoted):
+        words = match.group(0).split()
+        if match.start() == len(unquoted) - len(unquoted.lstrip()):
+            words = words[1:]  # "Show", "List"... start the question
+        words = [word for word in words if word.lower() not in _NOT_LITERALS]
+        if words:
+            literals.append((" ".join(words).rstrip(".,;:!?'"), False))
+    return literals
+
+
+def values_query(columns=VALUE_INDEX_COLUMNS):
+    """One query returning the distinct values of `columns` ("table.column")
+    as a JSON array of [column, value] pairs."""
+    selects = [
+        f"SELECT DISTINCT '{column}' AS source, {column.split('.')[1]}::text AS value "
+        f"FROM {column.split('.')[0]}"
+        for column in columns
+    ]
+    return (
+        "SELECT json_agg(json_build_array(source, value))::text FROM (\n    "
+        + "\n    UNION ALL ".join(selects)
+        + "\n) v WHERE value IS NOT NULL"
+    )
+
+
+def load_value_index(columns=VALUE_INDEX_COLUMNS):
+    from setup_db import execute_query_uncached
+
+    start = time.perf_counter()
+    result = execute_query_uncached(values_query(columns))
+    if not result.ok:
+        raise RuntimeError(result.error)
+    index = ValueIndex()
+    for column, value in json.loads(result.data[0][0] or "[]"):
+        index.add(column, value)
+    print(
+        f"Indexed {len(index)} values of {len(columns)} columns in "
+        f"{time.perf_counter() - start:.2f}s"
+    )
+    return index
+
+
+def render_hints(resolved):
+    """Formats resolved literals for the generate_sql prompt."""
+    lines = []
+    for literal, matches, exact in resolved:
+        if not matches:
+            lines.append(
+                f'- "{literal}" is not a value of '
+                f"{', '.join(VALUE_INDEX_COLUMNS)}"
+            )
+            continue
+        stored = ", ".join(
+            "{} = '{}'".format(column, value.replace("'", "''"))
+            for column, value in matches
+        )
+        if exact:
+            lines.append(f'- "{literal}" is stored as {stored}')
+        else:
+            lines.append(f'- "{literal}" is not stored as written, closest: {stored}')
+    return "\n".join(lines)
+
+
+_value_index = None
+_value_index_failed_at = None
+_value_index_lock = threading.Lock()
+
+
+def get_value_index():
+    """Returns the shared ValueIndex, built on first use, or None when
+    VALUE_INDEX_ENABLED is off or the values could not be loaded."""
+    global _value_index, _value_index_failed_at
+    if not VALUE_INDEX_ENABLED:
+        return None
+    with _value_index_lock:
+        if _value_index is not None:
+            return _value_index
+        if (
+            _value_index_failed_at is not None
+            and time.monotonic() - _value_index_failed_at < VALUE_INDEX_RETRY_INTERVAL
+        ):
+            return None
+        try:
+            _value_index = load_value_index()
+            _value_index_failed_at = None
+        except Exception as e:
+            print(f"Could not load the value index: {e}")
+            _value_index_failed_at = time.monotonic()
+        return _value_index
+
+
+def value_hints(question):
+    """Hints on the question's literals for the generate_sql prompt ("" when
+    there are none or the index is unavailable)."""
+    index = get_value_index()
+    return render_hints(index.resolve(question)) if index is not None else ""
+
+
+if __name__ == "__main__":
+    # Time the lookups for the questions of the evals dataset
+    from batch_eval import EVAL_DATASET_PATH, read_eval_dataset
+
+    index = load_value_index()
+    questions = read_eval_dataset(EVAL_DATASET_PATH)["Natural Language Query"]
+    start = time.perf_counter()
+    resolved = [index.resolve(question) for question in questions]
+    elapsed = time.perf_counter() - start
+    for question, literals in zip(questions, resolved):
+        if literals:
+            print(f"{question}\n{render_hints(literals)}\n")
+    print(f"Resolved {len(questions)} questions in {elapsed * 1e6 / len(questions):.0f}us each")